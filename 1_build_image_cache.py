@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 生成训练集解码后图片的缓存（tools/image_cache.py）。
+#                 生成后把配置文件里decodeImage的image_cache改成缓存目录即可。
+#
+# ================================================================
+import os
+import argparse
+
+from config import *
+from tools.image_cache import build_image_cache
+from pycocotools.coco import COCO
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Build Decoded Image Cache')
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--cache_dir', type=str, default='./image_cache', help='缓存目录')
+parser.add_argument('--shrink', type=int, default=1, help='1表示预先缩小到ResizeImage可能用到的最大尺寸，0表示保存原图。')
+parser.add_argument('--num_workers', type=int, default=4, help='解码的进程数')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    cfg = None
+    if args.config == 0:
+        cfg = FCOS_R50_FPN_Multiscale_2x_Config()
+    elif args.config == 1:
+        cfg = FCOS_RT_R50_FPN_4x_Config()
+    elif args.config == 2:
+        cfg = FCOS_RT_DLA34_FPN_4x_Config()
+
+    # 和train.py里data_clean()给出的im_file一致
+    train_dataset = COCO(cfg.train_path)
+    im_files = []
+    for img_id in train_dataset.getImgIds():
+        img_anno = train_dataset.loadImgs(img_id)[0]
+        im_fname = img_anno['file_name']
+        im_files.append(os.path.join(cfg.train_pre_path, im_fname) if cfg.train_pre_path else im_fname)
+
+    target_size = 0
+    max_size = 0
+    if args.shrink:
+        target_size = cfg.resizeImage['target_size']
+        max_size = cfg.resizeImage['max_size']
+    build_image_cache(im_files, args.cache_dir,
+                      to_rgb=cfg.decodeImage['to_rgb'],
+                      target_size=target_size,
+                      max_size=max_size,
+                      num_workers=args.num_workers)
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 导出ONNX模型（model/onnx_backend.py），包括骨干网络、FPN、head和解码，批大小、高、宽都是动态的。
+#                 读eval_cfg的model_path；fuse_conv_bn=True时先合并bn。导出后把配置文件里eval_cfg、test_cfg的onnx_path
+#                 改成导出的文件即可，用onnxruntime在CPU上推理，matrix_nms用NumPy做。
+#
+# ================================================================
+import argparse
+
+from config import *
+from model.fcos import *
+from model.onnx_backend import export_onnx
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Export ONNX')
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--save_path', type=str, default='fcos.onnx', help='导出的文件')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    cfg = None
+    if args.config == 0:
+        cfg = FCOS_R50_FPN_Multiscale_2x_Config()
+    elif args.config == 1:
+        cfg = FCOS_RT_R50_FPN_4x_Config()
+    elif args.config == 2:
+        cfg = FCOS_RT_DLA34_FPN_4x_Config()
+
+    # 创建模型
+    Backbone = select_backbone(cfg.backbone_type)
+    backbone = Backbone(**cfg.backbone)
+    Fpn = select_fpn(cfg.fpn_type)
+    fpn = Fpn(**cfg.fpn)
+    Head = select_head(cfg.head_type)
+    head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
+    fcos = FCOS(backbone, fpn, head)
+    fcos.load_state_dict(torch.load(cfg.eval_cfg['model_path'], map_location='cpu'))
+    fcos.eval()
+    if cfg.eval_cfg['fuse_conv_bn']:
+        fcos.fuse_for_inference()   # bn、AffineChannel合并进卷积
+
+    # 用验证时的尺寸导出，批大小、高、宽是动态的
+    export_onnx(fcos, args.save_path, cfg.eval_cfg['target_size'], cfg.eval_cfg['max_size'])
+    logger.info('Saved ONNX model to {}'.format(args.save_path))
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 训练集打包成少数几个大的分片文件（tools/packed_dataset.py）。
+#                 图片文件原样写进分片，清洗过的注解和索引写进index.json。
+#                 生成后把配置文件里的train_pack_dir改成打包目录即可。
+#
+# ================================================================
+import argparse
+
+from config import *
+from tools.data_process import data_clean
+from tools.packed_dataset import pack_dataset
+from pycocotools.coco import COCO
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Pack Dataset')
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--pack_dir', type=str, default='./train_pack', help='打包目录')
+parser.add_argument('--shard_size', type=int, default=1024, help='每个分片文件的大致大小，单位MB')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    cfg = None
+    if args.config == 0:
+        cfg = FCOS_R50_FPN_Multiscale_2x_Config()
+    elif args.config == 1:
+        cfg = FCOS_RT_R50_FPN_4x_Config()
+    elif args.config == 2:
+        cfg = FCOS_RT_DLA34_FPN_4x_Config()
+
+    train_dataset = COCO(cfg.train_path)
+    train_img_ids = train_dataset.getImgIds()
+    # 打包时保存COCO的category_id，训练时再转换成类别id，所以这里用恒等映射。
+    catid2catid = {catid: catid for catid in train_dataset.getCatIds()}
+    train_records = data_clean(train_dataset, train_img_ids, catid2catid, cfg.train_pre_path)
+    pack_dataset(train_records, args.pack_dir, shard_size=args.shard_size * 1024 * 1024)
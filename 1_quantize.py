@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 骨干网络的训练后int8静态量化（model/quantization.py）。读eval_cfg的model_path，
+#                 从验证集随机取num_images张图片，用验证时的预处理校准，保存量化后的state_dict。
+#                 保存后把配置文件里eval_cfg、test_cfg的quant_path改成保存的文件即可，只在CPU上推理。
+#
+# ================================================================
+import argparse
+import random
+
+from config import *
+from model.fcos import *
+from model.decode_np import Decode
+from model.quantization import quantize_fcos
+from tools.cocotools import get_classes
+
+import logging
+FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Post-training Quantization')
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--num_images', type=int, default=100, help='校准用的验证集图片数')
+parser.add_argument('--batch_size', type=int, default=4, help='校准时的批大小')
+parser.add_argument('--save_path', type=str, default='fcos_int8.pt', help='保存的文件')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    cfg = None
+    if args.config == 0:
+        cfg = FCOS_R50_FPN_Multiscale_2x_Config()
+    elif args.config == 1:
+        cfg = FCOS_RT_R50_FPN_4x_Config()
+    elif args.config == 2:
+        cfg = FCOS_RT_DLA34_FPN_4x_Config()
+
+    # 校准用的图片，从验证集里随机取（固定种子，结果可复现）
+    from pycocotools.coco import COCO
+    val_dataset = COCO(cfg.val_path)
+    images = val_dataset.loadImgs(val_dataset.getImgIds())
+    random.Random(0).shuffle(images)
+    im_paths = [cfg.val_pre_path + im['file_name'] for im in images[:args.num_images]]
+
+    # 创建模型
+    Backbone = select_backbone(cfg.backbone_type)
+    backbone = Backbone(**cfg.backbone)
+    Fpn = select_fpn(cfg.fpn_type)
+    fpn = Fpn(**cfg.fpn)
+    Head = select_head(cfg.head_type)
+    head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
+    fcos = FCOS(backbone, fpn, head)
+    fcos.load_state_dict(torch.load(cfg.eval_cfg['model_path'], map_location='cpu'))
+    fcos.eval()
+
+    _decode = Decode(fcos, get_classes(cfg.classes_path), False, cfg, for_test=False)
+    fcos = quantize_fcos(fcos, _decode, im_paths, args.batch_size)
+    torch.save(fcos.state_dict(), args.save_path)
+    logger.info('Calibrated on {} images, saved int8 model to {}'.format(len(im_paths), args.save_path))
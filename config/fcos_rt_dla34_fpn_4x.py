@@ -27,14 +27,23 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
         self.train_pre_path = '../COCO/train2017/'  # 训练集图片相对路径
         self.val_pre_path = '../COCO/val2017/'      # 验证集图片相对路径
         self.num_classes = 80                       # 数据集类别数
+        self.train_pack_dir = None   # 1_pack_dataset.py打包的训练集目录。不是None时训练集从分片里读，不再用pycocotools读train_path、打开train_pre_path下的图片。
+        self.anno_cache_dir = './anno_cache'   # 训练集注解清洗后的缓存目录，注解文件或类别映射变了会自动重新生成。None表示不用缓存。
 
 
         # ========= 一些设置 =========
         self.train_cfg = dict(
             lr=0.001,
             batch_size=3,
-            num_threads=4,   # 读数据的线程数
-            max_batch=2,     # 最大读多少个批
+            num_workers=4,   # 读数据的进程数。0表示不开进程，在读数据的线程里处理。
+            seed=None,       # 读数据的随机种子（洗乱、mixup、多尺度、数据增强）。None表示随机选一个，选的种子会存进检查点。
+            prefetch_depth=2,   # 预读队列的容量，即最多预读多少个批
+            group_by_aspect_ratio=True,   # 宽高比相近的图片凑成一批，减少PadBatch填充的像素。
+            aspect_ratio_bins=[0.75, 1.0, 1.333],   # 按宽高比w/h分组的边界
+            batch_multiscale=True,   # 多尺度训练时每一批随机选一个尺度，这一批的所有图片都用它；False表示每张图片各自随机选，一批图片填充到其中最大的尺度。
+            shuffle_buffer=1000,   # 训练集是打包的数据集时，每个epoch先洗乱分片，再在这么大的缓冲区里洗乱。
+            target_on_device=False,   # True表示在模型所在的设备上批量计算FCOS的target（FCOSTargetAssigner），读数据的进程只传图片和gt。
+            sparse_targets=True,   # 读数据的进程算target时，只传int16的类别图和正样本的下标、lrtb、centerness，不传稠密的reg_target、centerness。
             model_path='fcos_rt_dla34_fpn_4x.pt',
             # model_path='./weights/step00001000.pt',
             save_iter=1000,   # 每隔几步保存一次模型
@@ -52,6 +61,12 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
             draw_image=False,    # 是否画出验证集图片
             draw_thresh=0.15,    # 如果draw_image==True，那么只画出分数超过draw_thresh的物体的预测框。
             eval_batch_size=1,   # 验证时的批大小。
+            prefetch_depth=3,    # 预读队列的容量，即最多预读多少个批
+            fuse_conv_bn=True,   # 推理前把bn、AffineChannel合并进卷积（FCOS.fuse_for_inference()）
+            torchscript_path=None,   # 1_export_torchscript.py导出的模型。不是None时直接加载它，不再创建模型、读model_path
+            onnx_path=None,   # 1_export_onnx.py导出的模型。不是None时用onnxruntime在CPU上推理，nms用NumPy做
+            quant_path=None,   # 1_quantize.py保存的int8量化模型。不是None时加载它、不再读model_path，只在CPU上推理
+            precision='fp32',   # 推理精度。'fp32'；'bf16'：autocast下用bfloat16算，激活的内存减半；'fp16'：卷积权重用float16存。解码、nms总是fp32
         )
 
         # 测试。用于demo.py
@@ -62,6 +77,19 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
             max_size=736,
             draw_image=True,
             draw_thresh=0.15,   # 如果draw_image==True，那么只画出分数超过draw_thresh的物体的预测框。
+            prefetch_depth=3,   # 预读队列的容量，即最多预读多少张图片
+            fuse_conv_bn=True,   # 推理前把bn、AffineChannel合并进卷积（FCOS.fuse_for_inference()）
+            torchscript_path=None,   # 1_export_torchscript.py导出的模型。不是None时直接加载它，不再创建模型、读model_path
+            onnx_path=None,   # 1_export_onnx.py导出的模型。不是None时用onnxruntime在CPU上推理，nms用NumPy做
+            quant_path=None,   # 1_quantize.py保存的int8量化模型。不是None时加载它、不再读model_path，只在CPU上推理
+            precision='fp32',   # 推理精度。'fp32'；'bf16'：autocast下用bfloat16算，激活的内存减半；'fp16'：卷积权重用float16存。解码、nms总是fp32
+        )
+
+        # 预处理算子的耗时统计。用于train.py、eval.py、demo.py
+        self.op_stats_cfg = dict(
+            enable=False,       # 是否统计每个预处理算子的耗时、调用次数、输出数组的字节数（工作进程的统计随批传回主进程累加）。
+            print_iter=100,     # 读数据时每隔几批打印一次汇总
+            json_path=None,     # 打印汇总时同时写到这个json文件。None表示不写
         )
 
 
@@ -99,6 +127,7 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
             post_threshold=0.01,
             nms_top_k=500,
             keep_top_k=100,
+            pre_nms_top_n=1000,   # 每个fpn层先在logit空间取阈值、按分数预选这么多个候选，只解码它们。>=nms_top_k时结果和不预选相同。0表示不预选
             use_gaussian=False,
             gaussian_sigma=2.,
         )
@@ -110,6 +139,12 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
         self.decodeImage = dict(
             to_rgb=False,   # AdelaiDet里使用了BGR格式
             with_mixup=False,
+            image_cache=None,   # 解码后图片的缓存目录，用1_build_image_cache.py生成。None表示不用缓存，每次都解码jpg。
+            reduced_decode=False,   # True表示缩放后的尺寸远小于原图时，直接按1/2、1/4、1/8分辨率解码jpg，gt坐标跟着缩放。更快，但解码出的像素不同、gt最多偏0.4像素，默认不开。输入尺寸小的RT配置可以打开。
+        )
+        # PhotometricDistort
+        self.photometricDistort = dict(
+            use_lut=False,   # True表示用PhotometricDistortLUT，在uint8上用查找表做颜色扭曲，更快，但和原来的只是统计上等价（逐像素有差别）；False表示原来的float32版本。
         )
         # RandomFlipImage
         self.randomFlipImage = dict(
@@ -145,6 +180,7 @@ class FCOS_RT_DLA34_FPN_4x_Config(object):
             center_sampling_radius=1.5,
             downsample_ratios=[8, 16, 32],
             norm_reg_targets=True,
+            gt_chunk_size=16,   # gt分块处理，每块最多16个gt，限制中间数组的大小。
         )
 
 
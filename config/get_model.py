@@ -12,6 +12,7 @@ from model.losses import *
 from model.head import *
 from model.neck import *
 from model.resnet import *
+from model.fcos_target import *
 
 
 def select_backbone(name):
@@ -16,8 +16,13 @@ import threading
 import argparse
 
 from config import *
+from tools import op_stats
 from model.decode_np import Decode
 from model.fcos import *
+from model.export import load_torchscript
+from model.onnx_backend import OnnxFCOS
+from model.quantization import load_quantized
+from tools.prefetch import PrefetchQueue
 
 from tools.cocotools import get_classes
 
@@ -37,34 +42,18 @@ use_gpu = args.use_gpu
 
 
 def read_test_data(path_dir,
-                   _decode,
-                   test_dic):
+                   _decode):
     for k, filename in enumerate(path_dir):
-        key_list = list(test_dic.keys())
-        key_len = len(key_list)
-        while key_len >= 3:
-            time.sleep(0.01)
-            key_list = list(test_dic.keys())
-            key_len = len(key_list)
-
         image = cv2.imread('images/test/' + filename)
         sample = _decode.process_image(np.copy(image))
 
-        samples = [sample]
-        coarsest_stride = _decode.pad_to_stride
-        max_shape = np.array([data['image'].shape for data in samples]).max(
-            axis=0)    # max_shape=[3, max_h, max_w]
-        max_shape[1] = int(   # max_h增加到最小的能被coarsest_stride=128整除的数
-            np.ceil(max_shape[1] / coarsest_stride) * coarsest_stride)
-        max_shape[2] = int(   # max_w增加到最小的能被coarsest_stride=128整除的数
-            np.ceil(max_shape[2] / coarsest_stride) * coarsest_stride)
-
-        pimage, im_info = _decode.process_image_batch_transforms(sample, max_shape)
+        pimage, im_info = _decode.process_batch([sample])
         dic = {}
         dic['image'] = image
         dic['pimage'] = pimage
         dic['im_info'] = im_info
-        test_dic['%.8d' % k] = dic
+        op_stats.report(k + 1, 'test')
+        yield dic
 
 def save_img(filename, image):
     cv2.imwrite('images/res/' + filename, image)
@@ -77,6 +66,7 @@ if __name__ == '__main__':
         cfg = FCOS_RT_R50_FPN_4x_Config()
     elif config_file == 2:
         cfg = FCOS_RT_DLA34_FPN_4x_Config()
+    op_stats.configure(**cfg.op_stats_cfg)
 
 
     # 读取的模型
@@ -91,41 +81,44 @@ if __name__ == '__main__':
 
 
     # 创建模型
-    Backbone = select_backbone(cfg.backbone_type)
-    backbone = Backbone(**cfg.backbone)
-    Fpn = select_fpn(cfg.fpn_type)
-    fpn = Fpn(**cfg.fpn)
-    Head = select_head(cfg.head_type)
-    head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
-    fcos = FCOS(backbone, fpn, head)
-    if use_gpu:
-        fcos = fcos.cuda()
-    fcos.load_state_dict(torch.load(model_path))
-    fcos.eval()  # 必须调用model.eval()来设置dropout和batch normalization layers在运行推理前，切换到评估模式。
+    if cfg.test_cfg['torchscript_path'] is not None:
+        fcos = load_torchscript(cfg.test_cfg['torchscript_path'], use_gpu)   # 导出的TorchScript模型
+    elif cfg.test_cfg['onnx_path'] is not None:
+        fcos = OnnxFCOS(cfg.test_cfg['onnx_path'], cfg.nms_cfg)   # onnxruntime，只用CPU
+    else:
+        Backbone = select_backbone(cfg.backbone_type)
+        backbone = Backbone(**cfg.backbone)
+        Fpn = select_fpn(cfg.fpn_type)
+        fpn = Fpn(**cfg.fpn)
+        Head = select_head(cfg.head_type)
+        head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
+        fcos = FCOS(backbone, fpn, head)
+        if cfg.test_cfg['quant_path'] is not None:
+            use_gpu = False   # int8的骨干网络只能在CPU上跑
+            fcos = load_quantized(fcos, cfg.test_cfg['quant_path'])   # 1_quantize.py保存的量化模型
+        else:
+            if use_gpu:
+                fcos = fcos.cuda()
+            fcos.load_state_dict(torch.load(model_path))
+            fcos.eval()  # 必须调用model.eval()来设置dropout和batch normalization layers在运行推理前，切换到评估模式。
+            if cfg.test_cfg['fuse_conv_bn']:
+                fcos.fuse_for_inference()   # bn、AffineChannel合并进卷积
 
     _decode = Decode(fcos, all_classes, use_gpu, cfg, for_test=True)
 
     if not os.path.exists('images/res/'): os.mkdir('images/res/')
     path_dir = os.listdir('images/test')
 
-    # 读数据的线程
-    test_dic = {}
-    thr = threading.Thread(target=read_test_data,
-                           args=(path_dir,
-                                 _decode,
-                                 test_dic))
-    thr.start()
-
-    key_list = list(test_dic.keys())
-    key_len = len(key_list)
-    while key_len == 0:
-        time.sleep(0.01)
-        key_list = list(test_dic.keys())
-        key_len = len(key_list)
-    dic = test_dic['%.8d' % 0]
-    image = dic['image']
-    pimage = dic['pimage']
-    im_info = dic['im_info']
+    # 读数据的线程。读好的图片放进有界阻塞队列。
+    test_queue = PrefetchQueue(read_test_data,
+                               args=(path_dir,
+                                     _decode),
+                               depth=cfg.test_cfg['prefetch_depth'])
+
+    first_dic = test_queue.get()
+    image = first_dic['image']
+    pimage = first_dic['pimage']
+    im_info = first_dic['im_info']
 
 
     # warm up
@@ -140,13 +133,7 @@ if __name__ == '__main__':
     num_imgs = len(path_dir)
     start = time.time()
     for k, filename in enumerate(path_dir):
-        key_list = list(test_dic.keys())
-        key_len = len(key_list)
-        while key_len == 0:
-            time.sleep(0.01)
-            key_list = list(test_dic.keys())
-            key_len = len(key_list)
-        dic = test_dic.pop('%.8d' % k)
+        dic = first_dic if k == 0 else test_queue.get()
         image = dic['image']
         pimage = dic['pimage']
         im_info = dic['im_info']
@@ -169,5 +156,6 @@ if __name__ == '__main__':
     cost = time.time() - start
     logger.info('total time: {0:.6f}s'.format(cost))
     logger.info('Speed: %.6fs per image,  %.1f FPS.'%((cost / num_imgs), (num_imgs / cost)))
+    op_stats.report(num_imgs, 'test', force=True)
 
 
@@ -10,6 +10,7 @@
 import copy
 
 from config import *
+from tools import op_stats
 from tools.cocotools import get_classes, catid2clsid, clsid2catid
 import json
 import os
@@ -18,6 +19,9 @@ import argparse
 from tools.cocotools import eval
 from model.decode_np import Decode
 from model.fcos import *
+from model.export import load_torchscript
+from model.onnx_backend import OnnxFCOS
+from model.quantization import load_quantized
 from tools.cocotools import get_classes
 
 import logging
@@ -30,6 +34,8 @@ parser.add_argument('--use_gpu', type=bool, default=True)
 parser.add_argument('--config', type=int, default=2,
                     choices=[0, 1, 2],
                     help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                    help='推理精度。不是None时代替配置文件里eval_cfg的precision')
 args = parser.parse_args()
 config_file = args.config
 use_gpu = args.use_gpu
@@ -42,6 +48,9 @@ if __name__ == '__main__':
         cfg = FCOS_RT_R50_FPN_4x_Config()
     elif config_file == 2:
         cfg = FCOS_RT_DLA34_FPN_4x_Config()
+    op_stats.configure(**cfg.op_stats_cfg)
+    if args.precision is not None:
+        cfg.eval_cfg['precision'] = args.precision
 
 
     # 读取的模型
@@ -73,17 +82,28 @@ if __name__ == '__main__':
 
 
     # 创建模型
-    Backbone = select_backbone(cfg.backbone_type)
-    backbone = Backbone(**cfg.backbone)
-    Fpn = select_fpn(cfg.fpn_type)
-    fpn = Fpn(**cfg.fpn)
-    Head = select_head(cfg.head_type)
-    head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
-    fcos = FCOS(backbone, fpn, head)
-    if use_gpu:
-        fcos = fcos.cuda()
-    fcos.load_state_dict(torch.load(model_path))
-    fcos.eval()  # 必须调用model.eval()来设置dropout和batch normalization layers在运行推理前，切换到评估模式。
+    if cfg.eval_cfg['torchscript_path'] is not None:
+        fcos = load_torchscript(cfg.eval_cfg['torchscript_path'], use_gpu)   # 导出的TorchScript模型
+    elif cfg.eval_cfg['onnx_path'] is not None:
+        fcos = OnnxFCOS(cfg.eval_cfg['onnx_path'], cfg.nms_cfg)   # onnxruntime，只用CPU
+    else:
+        Backbone = select_backbone(cfg.backbone_type)
+        backbone = Backbone(**cfg.backbone)
+        Fpn = select_fpn(cfg.fpn_type)
+        fpn = Fpn(**cfg.fpn)
+        Head = select_head(cfg.head_type)
+        head = Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head)
+        fcos = FCOS(backbone, fpn, head)
+        if cfg.eval_cfg['quant_path'] is not None:
+            use_gpu = False   # int8的骨干网络只能在CPU上跑
+            fcos = load_quantized(fcos, cfg.eval_cfg['quant_path'])   # 1_quantize.py保存的量化模型
+        else:
+            if use_gpu:
+                fcos = fcos.cuda()
+            fcos.load_state_dict(torch.load(model_path))
+            fcos.eval()  # 必须调用model.eval()来设置dropout和batch normalization layers在运行推理前，切换到评估模式。
+            if cfg.eval_cfg['fuse_conv_bn']:
+                fcos.fuse_for_inference()   # bn、AffineChannel合并进卷积
 
     _clsid2catid = copy.deepcopy(clsid2catid)
     if num_classes != 80:   # 如果不是COCO数据集，而是自定义数据集
@@ -92,5 +112,5 @@ if __name__ == '__main__':
             _clsid2catid[k] = k
 
     _decode = Decode(fcos, all_classes, use_gpu, cfg, for_test=False)
-    box_ap = eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image, draw_thresh)
+    box_ap = eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image, draw_thresh, cfg.eval_cfg['prefetch_depth'])
 
@@ -104,6 +104,28 @@ class Conv2dUnit(torch.nn.Module):
             self.af.weight.requires_grad = False
             self.af.bias.requires_grad = False
 
+    @torch.no_grad()
+    def fuse(self):
+        '''
+        推理时把bn（用running_mean、running_var）或af的缩放、平移合并进卷积的权重和偏移，然后去掉bn、af。
+        conv(x)*scale + shift = conv'(x)，其中 W' = W*scale，b' = b*scale + shift。合并后不能再训练。
+        '''
+        if self.bn is not None:
+            std = torch.sqrt(self.bn.running_var + self.bn.eps)
+            scale = self.bn.weight / std
+            shift = self.bn.bias - self.bn.running_mean * scale
+        elif self.af is not None:
+            scale = self.af.weight
+            shift = self.af.bias
+        else:
+            return
+        weight = self.conv.weight
+        self.conv.weight = torch.nn.Parameter(weight * scale.reshape((-1, 1, 1, 1)), requires_grad=False)
+        bias = self.conv.bias if self.conv.bias is not None else torch.zeros_like(scale)
+        self.conv.bias = torch.nn.Parameter(bias * scale + shift, requires_grad=False)
+        self.bn = None
+        self.af = None
+
     def forward(self, x):
         x = self.conv(x)
         if self.bn:
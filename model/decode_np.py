@@ -16,6 +16,12 @@ import torch
 import numpy as np
 
 from tools.transform import *
+from model.fcos import FCOS
+from model.onnx_backend import OnnxFCOS
+from model.precision import check_precision, store_weights_fp16, autocast
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class Decode(object):
@@ -29,20 +35,44 @@ class Decode(object):
         self.context = cfg.context
         # sample_transforms
         self.to_rgb = cfg.decodeImage['to_rgb']
-        self.normalizeImage = NormalizeImage(**cfg.normalizeImage)  # 先除以255归一化，再减均值除以标准差
         target_size = cfg.eval_cfg['target_size']
         max_size = cfg.eval_cfg['max_size']
+        prefetch_depth = cfg.eval_cfg['prefetch_depth']
+        precision = cfg.eval_cfg['precision']
         if for_test:
             target_size = cfg.test_cfg['target_size']
             max_size = cfg.test_cfg['max_size']
+            prefetch_depth = cfg.test_cfg['prefetch_depth']
+            precision = cfg.test_cfg['precision']
         self.resizeImage = ResizeImage(target_size=target_size,
                                        max_size=max_size,
                                        interp=cfg.resizeImage['interp'],
                                        use_cv2=cfg.resizeImage['use_cv2'])  # 多尺度训练，随机选一个尺度，不破坏原始宽高比地缩放。具体见代码。
-        self.permute = Permute(**cfg.permute)  # 图片从HWC格式变成CHW格式
         # batch_transforms
-        self.pad_to_stride = cfg.padBatch['pad_to_stride']
-        self.padBatch = PadBatchSingle(use_padded_im_info=cfg.padBatch['use_padded_im_info'])  # 由于ResizeImage()的机制特殊，这一批所有的图片的尺度不一定全相等，所以这里对齐。
+        # 先除以255归一化，再减均值除以标准差；图片从HWC格式变成CHW格式；由于ResizeImage()的机制特殊，这一批所有的图片的尺度不一定全相等，所以这里对齐。
+        # 三步合成一步，直接写进复用的批数组。预读队列里的批、读数据的线程正在做的批、正在预测的批不能共用缓冲区。
+        self.normalizePermutePad = NormalizePermutePadBatch(to_bgr=cfg.permute['to_bgr'],
+                                                            pad_to_stride=cfg.padBatch['pad_to_stride'],
+                                                            use_padded_im_info=cfg.padBatch['use_padded_im_info'],
+                                                            num_buffers=prefetch_depth + 2,
+                                                            **cfg.normalizeImage)
+        # 耗时统计时和训练用的算子分开
+        stats_scope = 'test' if for_test else 'eval'
+        self.resizeImage.stats_scope = stats_scope
+        self.normalizePermutePad.stats_scope = stats_scope
+
+        # 推理精度。只对eager的FCOS生效，导出的TorchScript、ONNX模型总是fp32
+        self.device_type = 'cuda' if use_gpu else 'cpu'
+        self.precision = check_precision(precision, self.device_type)
+        if self.precision != 'fp32' and not isinstance(_model, FCOS):
+            logger.warning('precision={} only applies to the eager FCOS model, using fp32.'.format(self.precision))
+            self.precision = 'fp32'
+        if self.precision == 'fp16':
+            if _model.training:   # train.py里验证用的是正在训练的模型，不能改成float16存
+                logger.warning('precision=fp16 needs a model in eval mode, using fp32.')
+                self.precision = 'fp32'
+            else:
+                store_weights_fp16(_model)
 
 
     # 处理一张图片
@@ -56,6 +86,10 @@ class Decode(object):
             boxes = pred[0, :, 2:]
             scores = pred[0, :, 1]
             classes = pred[0, :, 0].astype(np.int32)
+            pos = np.where(scores >= 0.0)   # 去掉填充的-1（TorchScript模型的输出固定是keep_top_k个）
+            boxes = boxes[pos]
+            scores = scores[pos]
+            classes = classes[pos]
         if len(scores) > 0 and draw_image:
             pos = np.where(scores >= draw_thresh)
             boxes2 = boxes[pos]         # [M, 4]
@@ -143,25 +177,28 @@ class Decode(object):
         sample['h'] = img.shape[0]
         sample['w'] = img.shape[1]
 
-        sample = self.normalizeImage(sample, context)
-        sample = self.resizeImage(sample, context)
-        sample = self.permute(sample, context)
+        sample = self.resizeImage(sample, context)   # 缩放的还是uint8图片，归一化在process_batch()里
         return sample
 
-    def process_image_batch_transforms(self, sample, max_shape):
-        sample = self.padBatch(max_shape, sample, self.context)
-
-        pimage = np.expand_dims(sample['image'], axis=0)
-        im_info = np.expand_dims(sample['im_info'], axis=0)
+    def process_batch(self, samples):
+        '''
+        process_image()处理过的一批图片写进批数组。
+        :return: pimage [N, 3, max_h, max_w]，im_info [N, 3]
+        '''
+        pimage = self.normalizePermutePad(samples, self.context)
+        im_info = np.stack([s['im_info'] for s in samples], 0)
         return pimage, im_info
 
     def predict(self, image, im_info):
-        image = torch.Tensor(image)
-        im_info = torch.Tensor(im_info)
+        if isinstance(self._model, OnnxFCOS):   # onnxruntime，输入输出都是ndarray
+            return self._model(image, im_info)
+        image = torch.from_numpy(image)   # 和批数组共用内存，不复制
+        im_info = torch.from_numpy(im_info)
         if self.use_gpu:
             image = image.cuda()
             im_info = im_info.cuda()
-        pred = self._model(image, im_info)
+        with autocast(self.precision, self.device_type):
+            pred = self._model(image, im_info)
         pred = pred.cpu().detach().numpy()   # [bs, M, 6]
         return pred
 
@@ -10,6 +10,7 @@
 import torch
 from torch import nn
 import math
+from torch.ao.nn.quantized import FloatFunctional
 
 from model.custom_layers import Conv2dUnit
 
@@ -33,7 +34,7 @@ class BasicBlock(nn.Module):
         bn, gn, af = get_norm(norm_type)
         self.conv1 = Conv2dUnit(inplanes, planes, 3, stride=stride, bias_attr=False, bn=bn, gn=gn, af=af, act='relu')
         self.conv2 = Conv2dUnit(planes, planes, 3, stride=1, bias_attr=False, bn=bn, gn=gn, af=af, act=None)
-        self.relu = nn.ReLU(inplace=True)
+        self.skip_add = FloatFunctional()   # 相加再relu。量化时换成int8的add_relu
         self.stride = stride
 
     def forward(self, x, residual=None):
@@ -41,8 +42,7 @@ class BasicBlock(nn.Module):
             residual = x
         out = self.conv1(x)
         out = self.conv2(out)
-        out += residual
-        out = self.relu(out)
+        out = self.skip_add.add_relu(out, residual)
         return out
 
     def freeze(self):
@@ -58,14 +58,18 @@ class Root(nn.Module):
         self.conv = Conv2dUnit(in_channels, out_channels, kernel_size, stride=1, bias_attr=False, bn=bn, gn=gn, af=af, act=None)
         self.relu = nn.ReLU(inplace=True)
         self.residual = residual
+        # 拼接、相加用FloatFunctional，量化时换成int8的cat、add_relu
+        self.skip_cat = FloatFunctional()
+        self.skip_add = FloatFunctional()
 
     def forward(self, *x):
         children = x
-        x = torch.cat(x, 1)
+        x = self.skip_cat.cat(list(x), 1)
         x = self.conv(x)
         if self.residual:
-            x += children[0]
-        x = self.relu(x)
+            x = self.skip_add.add_relu(x, children[0])
+        else:
+            x = self.relu(x)
         return x
 
     def freeze(self):
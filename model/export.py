@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 导出TorchScript。骨干网络、FPN、head、解码用torch.jit.trace，matrix_nms用torch.jit.script，
+#                 保存成一个文件，部署时不需要这个仓库的模型代码。
+#
+# ================================================================
+import torch
+
+from model.matrix_nms import matrix_nms_batch
+
+
+class FCOSInference(torch.nn.Module):
+    """
+    FCOS的推理路径，forward(x, im_info)直接给出nms之后的结果 [N, keep_top_k, 6]，不足keep_top_k个的位置填-1。
+    with_nms=False时只给出解码后的 pred_boxes [N, 所有格子数, 4]、pred_scores [N, 所有格子数, 80]，nms在外面做（导出ONNX时）。
+    - 格子中心点坐标从特征图用ones_like、cumsum得到，trace之后仍然跟着输入的高宽、设备变化（arange的设备会被trace成常量）。
+    - matrix_nms依赖数据的控制流不能trace，用torch.jit.script编译后调用，trace时保留为函数调用。
+    nms的参数（nms_cfg）在导出时固定。
+    """
+
+    def __init__(self, fcos, with_nms=True):
+        super(FCOSInference, self).__init__()
+        self.backbone = fcos.backbone
+        self.neck = fcos.neck
+        self.head = fcos.head
+        self.nms_cfg = fcos.head.nms_cfg
+        self.with_nms = with_nms
+        if with_nms:
+            self.matrix_nms = torch.jit.script(matrix_nms_batch)
+
+    def _locations(self, features):
+        locations = []
+        for feature, fpn_stride in zip(features, self.head.fpn_stride):
+            ones = torch.ones_like(feature[0, 0])   # [h, w]
+            shift_x = (torch.cumsum(ones, dim=1) - 1.0) * fpn_stride   # 生成x偏移 [0, 1*fpn_stride, 2*fpn_stride, ...]
+            shift_y = (torch.cumsum(ones, dim=0) - 1.0) * fpn_stride   # 生成y偏移
+            location = torch.stack([shift_x.reshape((-1, )), shift_y.reshape((-1, ))], dim=1)   # [h*w, 2]  格子左上角的坐标
+            locations.append(location + fpn_stride // 2)   # [h*w, 2]  格子中心点的坐标
+        return locations
+
+    def forward(self, x, im_info):
+        body_feats = self.backbone(x)
+        body_feats, _ = self.neck(body_feats)
+        cls_logits, bboxes_reg, centerness = self.head._get_output(body_feats, is_training=False)
+        locations = self._locations(body_feats)
+        pred_boxes, pred_scores = self.head._decode_predictions(locations, cls_logits, bboxes_reg, centerness, im_info)
+        if not self.with_nms:
+            return pred_boxes, pred_scores
+        return self.matrix_nms(pred_boxes, pred_scores,
+                               float(self.nms_cfg['score_threshold']),
+                               float(self.nms_cfg['post_threshold']),
+                               int(self.nms_cfg['nms_top_k']),
+                               int(self.nms_cfg['keep_top_k']),
+                               bool(self.nms_cfg['use_gaussian']),
+                               float(self.nms_cfg['gaussian_sigma']))
+
+
+def export_torchscript(fcos, save_path, target_size=512, max_size=736, use_gpu=False):
+    '''
+    :param fcos: 加载好权重的FCOS
+    :param target_size max_size: trace用的输入尺寸。导出之后也能输入其他尺寸（边长是pad_to_stride的倍数）。
+    :return: 导出的ScriptModule
+    '''
+    model = FCOSInference(fcos).eval()
+    h = (target_size + 31) // 32 * 32
+    w = (max_size + 31) // 32 * 32
+    x = torch.zeros((1, 3, h, w))
+    im_info = torch.Tensor([[h, w, 1.0]])
+    if use_gpu:
+        model = model.cuda()
+        x = x.cuda()
+        im_info = im_info.cuda()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (x, im_info), check_trace=False)
+    torch.jit.save(traced, save_path)
+    return traced
+
+
+def load_torchscript(path, use_gpu=False):
+    '''
+    加载export_torchscript()导出的模型。调用方式和FCOS推理时一样：model(x, im_info)。
+    '''
+    model = torch.jit.load(path, map_location='cuda' if use_gpu else 'cpu')
+    model.eval()
+    return model
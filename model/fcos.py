@@ -9,6 +9,9 @@
 # ================================================================
 import torch
 
+from model.custom_layers import Conv2dUnit
+
+
 class FCOS(torch.nn.Module):
     def __init__(self, backbone, neck, head):
         super(FCOS, self).__init__()
@@ -16,15 +19,25 @@ class FCOS(torch.nn.Module):
         self.neck = neck
         self.head = head
 
-    def forward(self, x, im_info, eval=True, tag_labels=None, tag_bboxes=None, tag_centerness=None):
+    def forward(self, x, im_info, eval=True, tag_labels=None, tag_bboxes=None, tag_centerness=None, tag_pos_ind=None):
         body_feats = self.backbone(x)
         body_feats, spatial_scale = self.neck(body_feats)
         if eval:
             out = self.head.get_prediction(body_feats, im_info)
         else:
-            out = self.head.get_loss(body_feats, tag_labels, tag_bboxes, tag_centerness)
+            out = self.head.get_loss(body_feats, tag_labels, tag_bboxes, tag_centerness, tag_pos_ind)
         return out
 
+    def fuse_for_inference(self):
+        '''
+        把所有Conv2dUnit里的bn、af合并进卷积，推理时少一遍逐元素的缩放、平移。只用于推理，合并之后不能再训练、保存后不能再用原来的方式加载。
+        '''
+        self.eval()
+        for m in self.modules():
+            if isinstance(m, Conv2dUnit):
+                m.fuse()
+        return self
+
 
 
 
@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 在模型所在的设备上批量计算FCOS的target。和tools/transform.py里的Gt2FCOSTargetSingle算法相同，
+#                 但是一次处理一整批图片，读数据的进程只需要传图片和gt。
+#
+# ================================================================
+import torch
+
+from tools.lru_cache import LRUCache
+
+
+# 格子中心点坐标、每个格子的stride和回归值区间只和(对齐后的高宽, device)有关，缓存起来各批复用
+_points_cache = LRUCache('assigner_points', capacity=64)
+
+
+class FCOSTargetAssigner(torch.nn.Module):
+    """
+    一批图片的Gt2FCOSTarget。参数和Gt2FCOSTargetSingle相同，直接用cfg.gt2FCOSTarget创建。
+    Args:
+        object_sizes_boundary (list): 各感受野负责的最大回归值的边界
+        center_sampling_radius (float): 中心采样半径，单位是格子边长。<=0表示不做中心采样。
+        downsample_ratios (list): 各感受野的下采样倍率，从小感受野到大感受野
+        norm_reg_targets (bool): reg目标是否除以下采样倍率
+        gt_chunk_size (int): gt分块处理，每块最多gt_chunk_size个gt，中间张量最大是[N, 所有格子数, gt_chunk_size]
+    """
+
+    def __init__(self,
+                 object_sizes_boundary,
+                 center_sampling_radius,
+                 downsample_ratios,
+                 norm_reg_targets=False,
+                 gt_chunk_size=16):
+        super(FCOSTargetAssigner, self).__init__()
+        self.center_sampling_radius = center_sampling_radius
+        self.downsample_ratios = downsample_ratios
+        self.INF = float('inf')
+        self.object_sizes_boundary = [-1] + object_sizes_boundary + [self.INF]
+        object_sizes_of_interest = []
+        for i in range(len(self.object_sizes_boundary) - 1):
+            object_sizes_of_interest.append([
+                self.object_sizes_boundary[i], self.object_sizes_boundary[i + 1]
+            ])
+        self.object_sizes_of_interest = object_sizes_of_interest
+        self.norm_reg_targets = norm_reg_targets
+        self.gt_chunk_size = gt_chunk_size
+
+    def _compute_points(self, w, h, device):
+        """
+        compute the corresponding points in each feature map
+        :return: points [所有格子数, 2]，每个格子的stride [所有格子数, ]，
+                 每个格子的回归值下限、上限 [所有格子数, ]，num_points_each_level
+        """
+        key = (w, h, tuple(self.downsample_ratios), tuple(map(tuple, self.object_sizes_of_interest)), torch.float32, str(device))
+        return _points_cache.get(key, lambda: self._build_points(w, h, device))
+
+    def _build_points(self, w, h, device):
+        locations = []
+        strides = []
+        lower_bounds = []
+        high_bounds = []
+        num_points_each_level = []
+        for lvl, stride in enumerate(self.downsample_ratios):
+            shift_x = torch.arange(0, w, stride, dtype=torch.float32, device=device)
+            shift_y = torch.arange(0, h, stride, dtype=torch.float32, device=device)
+            grid_h, grid_w = shift_y.shape[0], shift_x.shape[0]
+            shift_x = shift_x.unsqueeze(0).repeat((grid_h, 1)).reshape((-1, ))   # 格子顺序是第一行从左到右，第二行从左到右，...
+            shift_y = shift_y.unsqueeze(1).repeat((1, grid_w)).reshape((-1, ))
+            location = torch.stack([shift_x, shift_y], dim=1) + stride // 2
+            num_pts = location.shape[0]
+            locations.append(location)
+            strides.append(torch.full((num_pts, ), stride, dtype=torch.float32, device=device))
+            lower_bounds.append(torch.full((num_pts, ), self.object_sizes_of_interest[lvl][0], dtype=torch.float32, device=device))
+            high_bounds.append(torch.full((num_pts, ), self.object_sizes_of_interest[lvl][1], dtype=torch.float32, device=device))
+            num_points_each_level.append(num_pts)
+        locations = torch.cat(locations, dim=0)
+        strides = torch.cat(strides, dim=0)
+        lower_bounds = torch.cat(lower_bounds, dim=0)
+        high_bounds = torch.cat(high_bounds, dim=0)
+        return locations, strides, lower_bounds, high_bounds, num_points_each_level
+
+    def _match_gt_chunk(self, bboxes, gt_area, valid, xs, ys, strides, lower_bounds, high_bounds):
+        """
+        一块gt的正负样本判断。
+        :param bboxes: [N, 1, gt数, 4]
+        :param gt_area: [N, 1, gt数]
+        :param valid: [N, 1, gt数]   False表示是填充的gt
+        :param xs ys strides lower_bounds high_bounds: [1, 所有格子数, 1]
+        :return: points2gtarea, [N, 所有格子数, gt数]。格子是这个gt的候选正样本时为gt的面积，否则为无穷。
+        """
+        x1, y1, x2, y2 = bboxes[..., 0], bboxes[..., 1], bboxes[..., 2], bboxes[..., 3]
+        l_res = xs - x1   # [N, 所有格子数, gt数]
+        t_res = ys - y1
+        r_res = x2 - xs
+        b_res = y2 - ys
+        if self.center_sampling_radius > 0:
+            # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长。(1)第1个正负样本判断依据
+            ct_x = (x1 + x2) / 2
+            ct_y = (y1 + y2) / 2
+            stride_exp = self.center_sampling_radius * strides
+            clipped_x1 = torch.max(x1, ct_x - stride_exp)
+            clipped_y1 = torch.max(y1, ct_y - stride_exp)
+            clipped_x2 = torch.min(x2, ct_x + stride_exp)
+            clipped_y2 = torch.min(y2, ct_y + stride_exp)
+            is_inside_box = (xs - clipped_x1 > 0) & (ys - clipped_y1 > 0) & \
+                            (clipped_x2 - xs > 0) & (clipped_y2 - ys > 0)
+        else:
+            is_inside_box = (l_res > 0) & (t_res > 0) & (r_res > 0) & (b_res > 0)
+        # 最大回归值如果位于区间内，就为True。(2)第2个正负样本判断依据
+        max_reg_targets = torch.max(torch.max(l_res, t_res), torch.max(r_res, b_res))
+        is_match_current_level = (max_reg_targets > lower_bounds) & (max_reg_targets < high_bounds)
+        inf = torch.full_like(max_reg_targets, self.INF)
+        points2gtarea = torch.where(is_inside_box & is_match_current_level & valid, gt_area.expand_as(inf), inf)
+        return points2gtarea
+
+    @torch.no_grad()
+    def forward(self, gt_bbox, gt_class, gt_num, h, w):
+        """
+        :param gt_bbox: [N, G, 4]  缩放后图片中的gt坐标(x1, y1, x2, y2)，填充的gt是0
+        :param gt_class: [N, G]    gt的类别id
+        :param gt_num: [N, ]       每张图片的gt数
+        :param h w: 这一批所有图片对齐后的高宽
+        :return: tag_labels, tag_bboxes, tag_center。都是list，从小感受野到大感受野，
+                 里面每个元素分别是[N, 格子行数, 格子列数, 1]、[N, 格子行数, 格子列数, 4]、[N, 格子行数, 格子列数, 1]
+        """
+        assert len(self.object_sizes_of_interest) == len(self.downsample_ratios), \
+            "object_sizes_of_interest', and 'downsample_ratios' should have same length."
+        device = gt_bbox.device
+        gt_bbox = gt_bbox.float()
+        batch_size, num_gts = gt_bbox.shape[0], gt_bbox.shape[1]
+        points, strides, lower_bounds, high_bounds, num_points_each_level = self._compute_points(w, h, device)
+        num_points = points.shape[0]
+        xs = points[:, 0].reshape((1, num_points, 1))   # [1, 所有格子数, 1]
+        ys = points[:, 1].reshape((1, num_points, 1))
+        strides = strides.reshape((1, num_points, 1))
+        lower_bounds = lower_bounds.reshape((1, num_points, 1))
+        high_bounds = high_bounds.reshape((1, num_points, 1))
+
+        gt_area = (gt_bbox[:, :, 2] - gt_bbox[:, :, 0]) * (gt_bbox[:, :, 3] - gt_bbox[:, :, 1])   # [N, G]
+        gt_ids = torch.arange(num_gts, device=device).unsqueeze(0)   # [1, G]
+        valid = gt_ids < gt_num.to(device).reshape((batch_size, 1))   # [N, G]
+
+        # 分块遍历gt，每个格子记录 目前为止 面积的最小值、最小值的下标。面积严格更小才替换，相同时取下标最小的gt。
+        points2min_area = torch.full((batch_size, num_points), self.INF, dtype=torch.float32, device=device)
+        points2min_area_ind = torch.zeros((batch_size, num_points), dtype=torch.int64, device=device)
+        chunk_size = self.gt_chunk_size if self.gt_chunk_size > 0 else max(num_gts, 1)
+        for beg in range(0, num_gts, chunk_size):
+            end = min(beg + chunk_size, num_gts)
+            points2gtarea = self._match_gt_chunk(gt_bbox[:, beg:end].unsqueeze(1), gt_area[:, beg:end].unsqueeze(1),
+                                                 valid[:, beg:end].unsqueeze(1), xs, ys, strides, lower_bounds, high_bounds)
+            chunk_min_area, chunk_min_area_ind = points2gtarea.min(dim=2)
+            better = chunk_min_area < points2min_area
+            points2min_area = torch.where(better, chunk_min_area, points2min_area)
+            points2min_area_ind = torch.where(better, chunk_min_area_ind + beg, points2min_area_ind)
+
+        positive = points2min_area != self.INF   # [N, 所有格子数]
+        labels = torch.gather(gt_class.to(device).float(), 1, points2min_area_ind) + 1
+        labels = torch.where(positive, labels, torch.zeros_like(labels))   # [N, 所有格子数]
+
+        ind = points2min_area_ind.unsqueeze(2).expand((batch_size, num_points, 4))
+        matched_bboxes = torch.gather(gt_bbox, 1, ind)   # [N, 所有格子数, 4]
+        xs = xs[:, :, 0]
+        ys = ys[:, :, 0]
+        reg_targets = torch.stack([xs - matched_bboxes[:, :, 0],
+                                   ys - matched_bboxes[:, :, 1],
+                                   matched_bboxes[:, :, 2] - xs,
+                                   matched_bboxes[:, :, 3] - ys], dim=2)   # [N, 所有格子数, 4]
+        lr = reg_targets[:, :, [0, 2]]
+        tb = reg_targets[:, :, [1, 3]]
+        ctn_targets = torch.sqrt((lr.min(dim=2)[0] / lr.max(dim=2)[0]) * (tb.min(dim=2)[0] / tb.max(dim=2)[0]))
+        ctn_targets = torch.where(positive, ctn_targets, torch.zeros_like(ctn_targets))   # 负样本需要学习的centerness置为0
+
+        # 切分成各个感受野，reshape成和格子的位置对应上。
+        tag_labels = []
+        tag_bboxes = []
+        tag_center = []
+        beg = 0
+        for lvl, stride in enumerate(self.downsample_ratios):
+            end = beg + num_points_each_level[lvl]
+            grid_w = (w + stride - 1) // stride   # 格子列数
+            grid_h = (h + stride - 1) // stride   # 格子行数
+            reg_target = reg_targets[:, beg:end]
+            if self.norm_reg_targets:   # 归一化方式是除以格子边长（即下采样倍率）
+                reg_target = reg_target / stride
+            tag_labels.append(labels[:, beg:end].reshape((batch_size, grid_h, grid_w, 1)))
+            tag_bboxes.append(reg_target.reshape((batch_size, grid_h, grid_w, 4)))
+            tag_center.append(ctn_targets[:, beg:end].reshape((batch_size, grid_h, grid_w, 1)))
+            beg = end
+        return tag_labels, tag_bboxes, tag_center
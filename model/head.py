@@ -12,7 +12,12 @@ import torch
 import math
 
 from model.custom_layers import Conv2dUnit
-from model.matrix_nms import matrix_nms
+from model.matrix_nms import matrix_nms, matrix_nms_batch, matrix_nms_candidates, matrix_nms_batch_candidates
+from tools.lru_cache import LRUCache
+
+
+# 各感受野格子中心点的坐标只和特征图的高宽、stride、device有关，缓存起来各批复用
+_locations_cache = LRUCache('head_locations', capacity=32)
 
 
 class FCOSHead(torch.nn.Module):
@@ -142,14 +147,17 @@ class FCOSHead(torch.nn.Module):
         Return:
             Anchor points for each feature map pixel
         """
+        shapes = tuple((feature.shape[2], feature.shape[3]) for feature in features)
+        device = features[0].device
+        key = (shapes, tuple(self.fpn_stride[:len(shapes)]), torch.float32, str(device))
+        return _locations_cache.get(key, lambda: self._build_locations(shapes, device))
+
+    def _build_locations(self, shapes, device):
         locations = []
-        for lvl, feature in enumerate(features):
-            shape_fm = feature.size()
-            h = shape_fm[2]
-            w = shape_fm[3]
+        for lvl, (h, w) in enumerate(shapes):
             fpn_stride = self.fpn_stride[lvl]
-            shift_x = torch.arange(0, w, dtype=torch.float32, device=feature.device) * fpn_stride   # 生成x偏移 [0, 1*fpn_stride, 2*fpn_stride, ...]
-            shift_y = torch.arange(0, h, dtype=torch.float32, device=feature.device) * fpn_stride   # 生成y偏移 [0, 1*fpn_stride, 2*fpn_stride, ...]
+            shift_x = torch.arange(0, w, dtype=torch.float32, device=device) * fpn_stride   # 生成x偏移 [0, 1*fpn_stride, 2*fpn_stride, ...]
+            shift_y = torch.arange(0, h, dtype=torch.float32, device=device) * fpn_stride   # 生成y偏移 [0, 1*fpn_stride, 2*fpn_stride, ...]
             shift_x = shift_x.unsqueeze(0)   # [1, w]
             shift_y = shift_y.unsqueeze(1)   # [h, 1]
             shift_x = shift_x.repeat((h, 1))   # [h, w]
@@ -209,8 +217,107 @@ class FCOSHead(torch.nn.Module):
             box_cls_ch_last = box_cls_ch_last * box_ctn_ch_last  # [N, 80, H*W]，最终分数=类别概率*centerness
         return box_cls_ch_last, box_reg_decoding
 
-    def _post_processing(self, locations, cls_logits, bboxes_reg, centerness,
-                         im_info):
+    def _preselect_by_level(self, locations, box_cls, box_reg, box_ctn, im_info, logit_threshold):
+        """
+        一个fpn层的候选预选（原版FCOS的pre_nms_top_n）。先在logit空间里取阈值，被去掉的不算sigmoid()；
+        每张图片再按最终分数取前pre_nms_top_n个，只解码留下来的预测框。
+        Args:
+            locations (Variables): anchor points for current layer, [H*W, 2]
+            box_cls   (Variables): [N, 80, H, W]
+            box_reg   (Variables): [N, 4, H, W]
+            box_ctn   (Variables): [N, 1, H, W]
+            im_info   (Variables): [h, w, scale] for input images
+            logit_threshold (float): 类别logit的阈值
+        Return:
+            cand_boxes  [N, K, 4]，最终坐标
+            cand_scores [N, K]，最终分数，不足K个的位置是-inf
+            cand_labels [N, K]，类别id
+        """
+        batch_size, num_classes, h, w = box_cls.shape
+        num_points = h * w
+        device = box_cls.device
+
+        # 在logit空间里取阈值。sigmoid()单调，logit不超过阈值的分数一定不超过score_threshold。
+        # 在[N, H*W, 80]的视图上nonzero()，候选按(图片, 格子, 类别)排，和不预选时matrix_nms()里nonzero()的顺序一致，分数相同时的先后也一样
+        box_cls = box_cls.reshape((batch_size, num_classes, num_points))   # [N, 80, H*W]
+        cand = (box_cls.permute(0, 2, 1) > logit_threshold).nonzero()   # [n, 3]，(图片id, 格子id, 类别id)
+        img_ids, point_ids, cate_labels = cand[:, 0], cand[:, 1], cand[:, 2]
+        cate_scores = torch.sigmoid(box_cls.reshape((-1, ))[(img_ids * num_classes + cate_labels) * num_points + point_ids])   # 只对留下来的算sigmoid()
+        if self.thresh_with_ctr:
+            ctn = box_ctn.reshape((-1, ))[img_ids * num_points + point_ids]
+            cate_scores = cate_scores * torch.sigmoid(ctn)   # 最终分数=类别概率*centerness
+        keep = (cate_scores > self.nms_cfg['score_threshold']).nonzero()[:, 0]   # 用最终分数再取一次阈值，和matrix_nms()相同
+        img_ids, point_ids, cate_labels, cate_scores = img_ids[keep], point_ids[keep], cate_labels[keep], cate_scores[keep]
+        if len(img_ids) == 0:
+            return torch.zeros((batch_size, 0, 4), device=device), torch.zeros((batch_size, 0), device=device), \
+                   torch.zeros((batch_size, 0), dtype=torch.int64, device=device)
+
+        # 每张图片的候选填充成[N, max_count]，填充的位置分数是-inf
+        counts = torch.bincount(img_ids, minlength=batch_size)   # [N]
+        offsets = torch.cumsum(counts, 0) - counts
+        pos = torch.arange(len(img_ids), device=device) - offsets[img_ids]
+        max_count = int(counts.max())
+        cand_scores = torch.full((batch_size, max_count), float('-inf'), device=device)
+        cand_scores[img_ids, pos] = cate_scores
+        cand_labels = torch.zeros((batch_size, max_count), dtype=torch.int64, device=device)
+        cand_labels[img_ids, pos] = cate_labels
+        cand_points = torch.zeros((batch_size, max_count), dtype=torch.int64, device=device)
+        cand_points[img_ids, pos] = point_ids
+
+        # 候选超过pre_nms_top_n个时，每张图片取分数最高的pre_nms_top_n个。稳定排序，分数相同时仍是原来的先后
+        K = max_count
+        if K > self.nms_cfg['pre_nms_top_n']:
+            K = self.nms_cfg['pre_nms_top_n']
+            cand_scores, sort_inds = torch.sort(cand_scores, dim=1, descending=True, stable=True)
+            cand_scores = cand_scores[:, :K]   # [N, K]
+            sort_inds = sort_inds[:, :K]
+            cand_labels = cand_labels.gather(1, sort_inds)   # [N, K]
+            cand_points = cand_points.gather(1, sort_inds)   # [N, K]
+
+        # 只解码留下来的预测框
+        reg = box_reg.reshape((batch_size, 4, num_points)).gather(2, cand_points.unsqueeze(1).expand(batch_size, 4, K))   # [N, 4, K]
+        loc = locations[cand_points]   # [N, K, 2]
+        cand_boxes = torch.stack(
+            [
+                loc[:, :, 0] - reg[:, 0],  # 左上角x坐标
+                loc[:, :, 1] - reg[:, 1],  # 左上角y坐标
+                loc[:, :, 0] + reg[:, 2],  # 右下角x坐标
+                loc[:, :, 1] + reg[:, 3]   # 右下角y坐标
+            ],
+            dim=-1)   # [N, K, 4]
+        im_scale = im_info[:, 2]  # [N, ]
+        im_scale = im_scale[:, np.newaxis, np.newaxis]  # [N, 1, 1]
+        cand_boxes = cand_boxes / im_scale  # [N, K, 4]，最终坐标=坐标*图片缩放因子
+        return cand_boxes, cand_scores, cand_labels
+
+    def _preselect(self, locations, cls_logits, bboxes_reg, centerness, im_info):
+        """
+        所有fpn层的候选预选后拼接起来。
+        Return:
+            cand_boxes [N, 所有层的K之和, 4]，cand_scores [N, 所有层的K之和]，cand_labels [N, 所有层的K之和]
+        """
+        score_threshold = self.nms_cfg['score_threshold']
+        if score_threshold <= 0.0:
+            logit_threshold = float('-inf')
+        elif score_threshold >= 1.0:
+            logit_threshold = float('inf')
+        else:
+            # 减去一点余量，sigmoid()的舍入误差不会漏掉候选。之后会用最终分数再取一次阈值
+            logit_threshold = math.log(score_threshold / (1.0 - score_threshold)) - 1e-3
+        cand_boxes = []
+        cand_scores = []
+        cand_labels = []
+        for pts, cls, box, ctn in zip(locations, cls_logits, bboxes_reg, centerness):
+            boxes_lvl, scores_lvl, labels_lvl = self._preselect_by_level(pts, cls, box, ctn, im_info, logit_threshold)
+            cand_boxes.append(boxes_lvl)
+            cand_scores.append(scores_lvl)
+            cand_labels.append(labels_lvl)
+        cand_boxes = torch.cat(cand_boxes, dim=1)
+        cand_scores = torch.cat(cand_scores, dim=1)
+        cand_labels = torch.cat(cand_labels, dim=1)
+        return cand_boxes, cand_scores, cand_labels
+
+    def _decode_predictions(self, locations, cls_logits, bboxes_reg, centerness, im_info):
         """
         Args:
             locations   (list): List of Variables composed by center of each anchor point
@@ -219,8 +326,8 @@ class FCOSHead(torch.nn.Module):
             centerness  (list): List of Variables for centerness prediction
             im_info(Variables): [h, w, scale] for input images
         Return:
-            pred (LoDTensor): predicted bounding box after nms,
-                the shape is n x 6, last dimension is [label, score, xmin, ymin, xmax, ymax]
+            pred_boxes  [N, 所有格子, 4]，最终坐标
+            pred_scores [N, 所有格子, 80]，最终分数
         """
         pred_boxes_ = []
         pred_scores_ = []
@@ -233,12 +340,47 @@ class FCOSHead(torch.nn.Module):
             pred_scores_.append(pred_scores_lvl)   # [N, 80, H*W]，最终分数
         pred_boxes = torch.cat(pred_boxes_, dim=1)    # [N, 所有格子, 4]，最终坐标
         pred_scores = torch.cat(pred_scores_, dim=2)  # [N, 80, 所有格子]，最终分数
+        pred_scores = pred_scores.permute(0, 2, 1)    # [N, 所有格子, 80]
+        return pred_boxes, pred_scores
 
+    def _post_processing(self, locations, cls_logits, bboxes_reg, centerness,
+                         im_info):
+        """
+        Args:
+            locations   (list): List of Variables composed by center of each anchor point
+            cls_logits  (list): List of Variables for class prediction
+            bboxes_reg  (list): List of Variables for bounding box prediction
+            centerness  (list): List of Variables for centerness prediction
+            im_info(Variables): [h, w, scale] for input images
+        Return:
+            pred (LoDTensor): predicted bounding box after nms,
+                the shape is n x 6, last dimension is [label, score, xmin, ymin, xmax, ymax]
+        """
         # nms
         preds = None
         nms_type = self.nms_cfg['nms_type']
-        if nms_type == 'matrix_nms':
-            pred_scores = pred_scores.permute(0, 2, 1)
+        if nms_type == 'matrix_nms' and self.nms_cfg['pre_nms_top_n'] > 0:
+            # 每层先预选pre_nms_top_n个候选，不再对所有格子算sigmoid()、解码
+            cand_boxes, cand_scores, cand_labels = self._preselect(locations, cls_logits, bboxes_reg, centerness, im_info)
+            batch_size = cand_boxes.shape[0]
+            if batch_size == 1:
+                valid = cand_scores[0] > float('-inf')
+                pred = matrix_nms_candidates(cand_boxes[0][valid], cand_scores[0][valid], cand_labels[0][valid],
+                                             post_threshold=self.nms_cfg['post_threshold'],
+                                             nms_top_k=self.nms_cfg['nms_top_k'],
+                                             keep_top_k=self.nms_cfg['keep_top_k'],
+                                             use_gaussian=self.nms_cfg['use_gaussian'],
+                                             gaussian_sigma=self.nms_cfg['gaussian_sigma'])
+                preds = pred.unsqueeze(0)
+            else:
+                preds = matrix_nms_batch_candidates(cand_boxes, cand_scores, cand_labels,
+                                                    post_threshold=self.nms_cfg['post_threshold'],
+                                                    nms_top_k=self.nms_cfg['nms_top_k'],
+                                                    keep_top_k=self.nms_cfg['keep_top_k'],
+                                                    use_gaussian=self.nms_cfg['use_gaussian'],
+                                                    gaussian_sigma=self.nms_cfg['gaussian_sigma'])
+        elif nms_type == 'matrix_nms':
+            pred_boxes, pred_scores = self._decode_predictions(locations, cls_logits, bboxes_reg, centerness, im_info)
             batch_size = pred_boxes.shape[0]
             if batch_size == 1:
                 pred = matrix_nms(pred_boxes[0], pred_scores[0],
@@ -250,19 +392,16 @@ class FCOSHead(torch.nn.Module):
                                   gaussian_sigma=self.nms_cfg['gaussian_sigma'])
                 preds = pred.unsqueeze(0)
             else:
-                preds = torch.zeros((batch_size, self.nms_cfg['keep_top_k'], 6), device=pred_scores.device) - 1.0
-                for i in range(batch_size):
-                    pred = matrix_nms(pred_boxes[i], pred_scores[i],
-                                      score_threshold=self.nms_cfg['score_threshold'],
-                                      post_threshold=self.nms_cfg['post_threshold'],
-                                      nms_top_k=self.nms_cfg['nms_top_k'],
-                                      keep_top_k=self.nms_cfg['keep_top_k'],
-                                      use_gaussian=self.nms_cfg['use_gaussian'],
-                                      gaussian_sigma=self.nms_cfg['gaussian_sigma'])
-                    preds[i, :pred.shape[0], :] = pred
+                preds = matrix_nms_batch(pred_boxes, pred_scores,
+                                         score_threshold=self.nms_cfg['score_threshold'],
+                                         post_threshold=self.nms_cfg['post_threshold'],
+                                         nms_top_k=self.nms_cfg['nms_top_k'],
+                                         keep_top_k=self.nms_cfg['keep_top_k'],
+                                         use_gaussian=self.nms_cfg['use_gaussian'],
+                                         gaussian_sigma=self.nms_cfg['gaussian_sigma'])
         return preds
 
-    def get_loss(self, input, tag_labels, tag_bboxes, tag_centerness):
+    def get_loss(self, input, tag_labels, tag_bboxes, tag_centerness, tag_pos_ind=None):
         """
         Calculate the loss for FCOS
         Args:
@@ -270,6 +409,7 @@ class FCOSHead(torch.nn.Module):
             tag_labels     (Variables): category targets for each anchor point
             tag_bboxes     (Variables): bounding boxes  targets for positive samples
             tag_centerness (Variables): centerness targets for positive samples
+            tag_pos_ind    (Variables): 稀疏的target时正样本的下标，tag_bboxes、tag_centerness只有正样本的。None表示稠密的target
         Return:
             loss (dict): loss composed by classification loss, bounding box
                 regression loss and centerness regression loss
@@ -277,7 +417,7 @@ class FCOSHead(torch.nn.Module):
         cls_logits, bboxes_reg, centerness = self._get_output(
             input, is_training=True)
         loss = self.fcos_loss(cls_logits, bboxes_reg, centerness, tag_labels,
-                              tag_bboxes, tag_centerness)
+                              tag_bboxes, tag_centerness, tag_pos_ind)
         return loss
 
     def get_prediction(self, input, im_info):
@@ -294,9 +434,14 @@ class FCOSHead(torch.nn.Module):
         # centerness里面每个元素是[N,  1, 格子行数, 格子列数]
         cls_logits, bboxes_reg, centerness = self._get_output(
             input, is_training=False)
-        locations = self._compute_locations(input)
-        preds = self._post_processing(locations, cls_logits, bboxes_reg,
-                                     centerness, im_info)
+        # bf16推理时卷积的输出是bf16，解码、nms关掉autocast，用fp32
+        with torch.autocast(device_type=im_info.device.type, enabled=False):
+            cls_logits = [t.float() for t in cls_logits]
+            bboxes_reg = [t.float() for t in bboxes_reg]
+            centerness = [t.float() for t in centerness]
+            locations = self._compute_locations(input)
+            preds = self._post_processing(locations, cls_logits, bboxes_reg,
+                                         centerness, im_info)
         return preds
 
 
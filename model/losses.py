@@ -54,6 +54,24 @@ class FCOSLoss(torch.nn.Module):
         input_channel_last = input_channel_last.reshape((N*H*W, C))
         return input_channel_last
 
+    def _flatten_levels(self, tensors, channel_first=False):
+        """
+        各感受野的张量flatten后拼接起来，顺序是从 小感受野 到 大感受野。稠密、稀疏的损失都用它，格子的顺序一致。
+        Args:
+            tensors (list): channel_first时是预测结果，里面每个元素是[N, C, 格子行数, 格子列数]，从 大感受野 到 小感受野；
+                            否则是真实标签，里面每个元素是[N, 格子行数, 格子列数, C]，从 小感受野 到 大感受野
+        Return:
+            [批大小*所有格子数, C]
+        """
+        num_lvl = len(tensors)
+        flatten_list = []
+        for lvl in range(num_lvl):
+            if channel_first:
+                flatten_list.append(self.__flatten_tensor(tensors[num_lvl - 1 - lvl], True))   # 从 小感受野 到 大感受野 遍历预测结果
+            else:
+                flatten_list.append(self.__flatten_tensor(tensors[lvl], False))
+        return torch.cat(flatten_list, dim=0)
+
     def __iou_loss(self, pred, targets, positive_mask, weights=None):
         """
         Calculate the loss for location prediction
@@ -126,7 +144,7 @@ class FCOSLoss(torch.nn.Module):
         return bce_loss
 
     def __call__(self, cls_logits, bboxes_reg, centerness, tag_labels,
-                 tag_bboxes, tag_center):
+                 tag_bboxes, tag_center, tag_pos_ind=None):
         """
         Calculate the loss for classification, location and centerness
         Args:
@@ -135,44 +153,23 @@ class FCOSLoss(torch.nn.Module):
             centerness (list): 预测结果list。里面每个元素是[N,  1, 格子行数, 格子列数]     从 大感受野 到 小感受野
             tag_labels (list): 真实标签list。里面每个元素是[N, 格子行数, 格子列数,  1]     从 小感受野 到 大感受野
             tag_bboxes (list): 真实标签list。里面每个元素是[N, 格子行数, 格子列数,  4]     从 小感受野 到 大感受野
+                               tag_pos_ind不是None时是正样本的lrtb，[正样本数, 4]
             tag_center (list): 真实标签list。里面每个元素是[N, 格子行数, 格子列数,  1]     从 小感受野 到 大感受野
+                               tag_pos_ind不是None时是正样本的centerness，[正样本数, 1]
+            tag_pos_ind (Variables): 稀疏的target。[正样本数, ]，正样本在 批大小*所有格子数 里的下标，顺序同下面的flatten
         Return:
             loss (dict): loss composed by classification loss, bounding box
         """
-        cls_logits_flatten_list = []
-        bboxes_reg_flatten_list = []
-        centerness_flatten_list = []
-        tag_labels_flatten_list = []
-        tag_bboxes_flatten_list = []
-        tag_center_flatten_list = []
-        num_lvl = len(cls_logits)
-        for lvl in range(num_lvl):
-            cls_logits_flatten_list.append(
-                self.__flatten_tensor(cls_logits[num_lvl - 1 - lvl], True))   # 从 小感受野 到 大感受野 遍历cls_logits
-            bboxes_reg_flatten_list.append(
-                self.__flatten_tensor(bboxes_reg[num_lvl - 1 - lvl], True))
-            centerness_flatten_list.append(
-                self.__flatten_tensor(centerness[num_lvl - 1 - lvl], True))
-            tag_labels_flatten_list.append(
-                self.__flatten_tensor(tag_labels[lvl], False))   # 从 小感受野 到 大感受野 遍历tag_labels
-            tag_bboxes_flatten_list.append(
-                self.__flatten_tensor(tag_bboxes[lvl], False))
-            tag_center_flatten_list.append(
-                self.__flatten_tensor(tag_center[lvl], False))
-
+        if tag_pos_ind is not None:
+            return self._sparse_loss(cls_logits, bboxes_reg, centerness, tag_labels,
+                                     tag_bboxes, tag_center, tag_pos_ind)
         # 顺序都是从 小感受野 到 大感受野
-        cls_logits_flatten = torch.cat(   # [批大小*所有格子数, 80]， 预测的类别
-            cls_logits_flatten_list, dim=0)
-        bboxes_reg_flatten = torch.cat(   # [批大小*所有格子数,  4]， 预测的lrtb
-            bboxes_reg_flatten_list, dim=0)
-        centerness_flatten = torch.cat(   # [批大小*所有格子数,  1]， 预测的centerness
-            centerness_flatten_list, dim=0)
-        tag_labels_flatten = torch.cat(   # [批大小*所有格子数,  1]， 真实的类别id
-            tag_labels_flatten_list, dim=0)
-        tag_bboxes_flatten = torch.cat(   # [批大小*所有格子数,  4]， 真实的lrtb
-            tag_bboxes_flatten_list, dim=0)
-        tag_center_flatten = torch.cat(   # [批大小*所有格子数,  1]， 真实的centerness
-            tag_center_flatten_list, dim=0)
+        cls_logits_flatten = self._flatten_levels(cls_logits, True)   # [批大小*所有格子数, 80]， 预测的类别
+        bboxes_reg_flatten = self._flatten_levels(bboxes_reg, True)   # [批大小*所有格子数,  4]， 预测的lrtb
+        centerness_flatten = self._flatten_levels(centerness, True)   # [批大小*所有格子数,  1]， 预测的centerness
+        tag_labels_flatten = self._flatten_levels(tag_labels)   # [批大小*所有格子数,  1]， 真实的类别id
+        tag_bboxes_flatten = self._flatten_levels(tag_bboxes)   # [批大小*所有格子数,  4]， 真实的lrtb
+        tag_center_flatten = self._flatten_levels(tag_center)   # [批大小*所有格子数,  1]， 真实的centerness
 
         mask_positive = tag_labels_flatten > 0        # [批大小*所有格子数,  1]， 正样本处为True
         mask_positive_float = mask_positive.float()   # [批大小*所有格子数,  1]， 正样本处为1
@@ -192,6 +189,36 @@ class FCOSLoss(torch.nn.Module):
         }
         return loss_all
 
+    def _sparse_loss(self, cls_logits, bboxes_reg, centerness, tag_labels,
+                     tag_pos_bboxes, tag_pos_center, tag_pos_ind):
+        """
+        稀疏的target的损失，和__call__()的稠密版本相等。
+        类别损失在所有格子上算；回归损失、centerness损失只在正样本上算，按tag_pos_ind取出正样本处的预测。
+        """
+        # 顺序都是从 小感受野 到 大感受野，和__call__()相同
+        cls_logits_flatten = self._flatten_levels(cls_logits, True)   # [批大小*所有格子数, 80]， 预测的类别
+        bboxes_reg_flatten = self._flatten_levels(bboxes_reg, True)   # [批大小*所有格子数,  4]， 预测的lrtb
+        centerness_flatten = self._flatten_levels(centerness, True)   # [批大小*所有格子数,  1]， 预测的centerness
+        tag_labels_flatten = self._flatten_levels(tag_labels)   # [批大小*所有格子数,  1]， 真实的类别id
+
+        bboxes_reg_pos = bboxes_reg_flatten[tag_pos_ind]   # [正样本数, 4]， 正样本处预测的lrtb
+        centerness_pos = centerness_flatten[tag_pos_ind]   # [正样本数, 1]， 正样本处预测的centerness
+        mask_positive_float = torch.ones((tag_pos_ind.shape[0], 1), device=bboxes_reg_pos.device)
+        num_positive_fp32 = mask_positive_float.sum()   # 这一批的正样本数
+        normalize_sum = tag_pos_center.sum()   # 正样本的centerness求和
+
+        cls_loss = self.sigmoid_focal_loss(cls_logits_flatten, tag_labels_flatten, num_positive_fp32, gamma=self.loss_gamma, alpha=self.loss_alpha)
+        reg_loss = self.__iou_loss(bboxes_reg_pos, tag_pos_bboxes, mask_positive_float, tag_pos_center) / (normalize_sum + 1e-9)
+        ctn_loss = self.sigmoid_cross_entropy_with_logits(
+            x=centerness_pos,
+            label=tag_pos_center) / (num_positive_fp32 + 1e-9)
+        loss_all = {
+            "loss_centerness": ctn_loss.sum(),
+            "loss_cls": cls_loss.sum(),
+            "loss_box": reg_loss.sum()
+        }
+        return loss_all
+
 
 
 
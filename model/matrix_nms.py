@@ -13,6 +13,7 @@ import torch
 
 # 相交矩形的面积
 def intersect(box_a, box_b):
+    # type: (Tensor, Tensor) -> Tensor
     """计算两组矩形两两之间相交区域的面积
     Args:
         box_a: (tensor) bounding boxes, Shape: [A, 4].
@@ -31,6 +32,7 @@ def intersect(box_a, box_b):
 
 
 def jaccard(box_a, box_b):
+    # type: (Tensor, Tensor) -> Tensor
     """计算两组矩形两两之间的iou
     Args:
         box_a: (tensor) bounding boxes, Shape: [A, 4].
@@ -47,8 +49,30 @@ def jaccard(box_a, box_b):
     return inter / union  # [A, B]
 
 
+def batch_jaccard(boxes):
+    # type: (Tensor) -> Tensor
+    """一批图片，每张图片里的矩形两两之间的iou，逐元素的计算和jaccard()相同
+    Args:
+        boxes: (tensor) bounding boxes, Shape: [N, A, 4].
+    Return:
+        ious: (tensor) Shape: [N, A, A]
+    """
+    # x、y方向分开算，避免[N, A, A, 2]的中间结果；尽量原地计算，少分配[N, A, A]的临时张量
+    x1 = boxes[:, :, 0]
+    y1 = boxes[:, :, 1]
+    x2 = boxes[:, :, 2]
+    y2 = boxes[:, :, 3]
+    inter = torch.min(x2.unsqueeze(2), x2.unsqueeze(1)).sub_(torch.max(x1.unsqueeze(2), x1.unsqueeze(1))).clamp_(min=0)
+    inter_h = torch.min(y2.unsqueeze(2), y2.unsqueeze(1)).sub_(torch.max(y1.unsqueeze(2), y1.unsqueeze(1))).clamp_(min=0)
+    inter.mul_(inter_h)   # [N, A, A]
+    area = (x2 - x1) * (y2 - y1)   # [N, A]
+    union = (area.unsqueeze(2) + area.unsqueeze(1)).sub_(inter)
+    return inter.div_(union)  # [N, A, A]
+
+
 
 def _matrix_nms(bboxes, cate_labels, cate_scores, kernel='gaussian', sigma=2.0):
+    # type: (Tensor, Tensor, Tensor, str, float) -> Tensor
     """Matrix NMS for multi-class bboxes.
     Args:
         bboxes (Tensor): shape (n, 4)
@@ -61,7 +85,7 @@ def _matrix_nms(bboxes, cate_labels, cate_scores, kernel='gaussian', sigma=2.0):
     """
     n_samples = len(cate_labels)
     if n_samples == 0:
-        return []
+        return cate_scores
 
     # 计算一个n×n的IOU矩阵，两组矩形两两之间的IOU
     iou_matrix = jaccard(bboxes, bboxes)   # shape: [n_samples, n_samples]
@@ -107,17 +131,38 @@ def matrix_nms(bboxes,
                keep_top_k,
                use_gaussian=False,
                gaussian_sigma=2.):
+    # type: (Tensor, Tensor, float, float, int, int, bool, float) -> Tensor
+    # 类型注释是给torch.jit.script用的，导出TorchScript时matrix_nms_batch()及其调用的函数都被编译。
     inds = (scores > score_threshold)
     cate_scores = scores[inds]
-    if len(cate_scores) == 0:
-        return torch.zeros((1, 6), device=bboxes.device) - 1.0
-
     inds = inds.nonzero()
     cate_labels = inds[:, 1]
     bboxes = bboxes[inds[:, 0]]
+    return matrix_nms_candidates(bboxes, cate_scores, cate_labels, post_threshold, nms_top_k, keep_top_k,
+                                 use_gaussian=use_gaussian, gaussian_sigma=gaussian_sigma)
+
+
+def matrix_nms_candidates(bboxes,
+                          cate_scores,
+                          cate_labels,
+                          post_threshold,
+                          nms_top_k,
+                          keep_top_k,
+                          use_gaussian=False,
+                          gaussian_sigma=2.):
+    # type: (Tensor, Tensor, Tensor, float, int, int, bool, float) -> Tensor
+    """
+    一张图片已经取过阈值的候选做matrix_nms。分数相同的候选按传入的顺序排。
+    :param bboxes: [n, 4]
+    :param cate_scores: [n]
+    :param cate_labels: [n]
+    :return: [M, 6]，没有预测框时是[[-1, -1, -1, -1, -1, -1]]
+    """
+    if len(cate_scores) == 0:
+        return torch.zeros((1, 6), device=bboxes.device) - 1.0
 
-    # sort and keep top nms_top_k
-    sort_inds = torch.argsort(cate_scores, descending=True)
+    # sort and keep top nms_top_k。稳定排序，分数相同时保持原来的顺序，和matrix_nms_batch()的结果逐位相同
+    _, sort_inds = torch.sort(cate_scores, descending=True, stable=True)
     if nms_top_k > 0 and len(sort_inds) > nms_top_k:
         sort_inds = sort_inds[:nms_top_k]
     bboxes = bboxes[sort_inds, :]
@@ -137,7 +182,7 @@ def matrix_nms(bboxes,
     cate_labels = cate_labels[keep]
 
     # sort and keep keep_top_k
-    sort_inds = torch.argsort(cate_scores, descending=True)
+    _, sort_inds = torch.sort(cate_scores, descending=True, stable=True)
     if len(sort_inds) > keep_top_k:
         sort_inds = sort_inds[:keep_top_k]
     bboxes = bboxes[sort_inds, :]
@@ -151,4 +196,111 @@ def matrix_nms(bboxes,
     return pred
 
 
+def matrix_nms_batch(bboxes,
+                     scores,
+                     score_threshold,
+                     post_threshold,
+                     nms_top_k,
+                     keep_top_k,
+                     use_gaussian=False,
+                     gaussian_sigma=2.):
+    # type: (Tensor, Tensor, float, float, int, int, bool, float) -> Tensor
+    """
+    一批图片一起做matrix_nms，结果和逐张调用matrix_nms()相同。
+    每张图片的候选框数不同，填充到同样的个数K，用掩码去掉填充的部分，iou、类别、衰减矩阵都是[N, K, K]，整批一起算。
+    :param bboxes: [N, 所有格子数, 4]
+    :param scores: [N, 所有格子数, 80]
+    :return: [N, keep_top_k, 6]，不足keep_top_k个的位置填-1
+    """
+    batch_size = bboxes.shape[0]
+    num_classes = scores.shape[2]
+    device = bboxes.device
+
+    # 分数超过score_threshold的(格子, 类别)是候选。nonzero()按行优先，每张图片的候选按原来的顺序排在一起
+    flat_scores = scores.reshape((batch_size, -1))   # [N, 所有格子数*80]
+    cand = (flat_scores > score_threshold).nonzero()   # [所有图片的候选数, 2]，(图片id, 格子id*80+类别id)
+    if cand.shape[0] == 0:
+        return torch.zeros((batch_size, keep_top_k, 6), device=device) - 1.0
+    img_ids = cand[:, 0]
+    counts = torch.bincount(img_ids, minlength=batch_size)   # [N]  每张图片的候选数
+    offsets = torch.cumsum(counts, 0) - counts
+    pos = torch.arange(cand.shape[0], device=device) - offsets[img_ids]   # 在本图片候选里的位置
+    max_count = int(counts.max())
+
+    # 填充成[N, max_count]，填充的位置分数是-inf，排序后在最后面
+    cand_scores = torch.full((batch_size, max_count), float('-inf'), device=device)
+    cand_scores[img_ids, pos] = flat_scores[img_ids, cand[:, 1]]
+    cand_labels = torch.zeros((batch_size, max_count), dtype=torch.int64, device=device)
+    cand_labels[img_ids, pos] = cand[:, 1] % num_classes
+    cand_bboxes = torch.zeros((batch_size, max_count, 4), device=device)
+    cand_bboxes[img_ids, pos] = bboxes[img_ids, torch.div(cand[:, 1], num_classes, rounding_mode='floor')]
+    return matrix_nms_batch_candidates(cand_bboxes, cand_scores, cand_labels, post_threshold, nms_top_k, keep_top_k,
+                                       use_gaussian=use_gaussian, gaussian_sigma=gaussian_sigma)
+
+
+def matrix_nms_batch_candidates(bboxes,
+                                cate_scores,
+                                cate_labels,
+                                post_threshold,
+                                nms_top_k,
+                                keep_top_k,
+                                use_gaussian=False,
+                                gaussian_sigma=2.):
+    # type: (Tensor, Tensor, Tensor, float, int, int, bool, float) -> Tensor
+    """
+    一批图片已经取过阈值的候选一起做matrix_nms，每张图片的结果和matrix_nms_candidates()相同。
+    :param bboxes: [N, K0, 4]
+    :param cate_scores: [N, K0]，填充的位置是-inf，可以在任意位置
+    :param cate_labels: [N, K0]
+    :return: [N, keep_top_k, 6]，不足keep_top_k个的位置填-1
+    """
+    batch_size = bboxes.shape[0]
+    device = bboxes.device
+    preds = torch.zeros((batch_size, keep_top_k, 6), device=device) - 1.0
+    if cate_scores.shape[1] == 0:
+        return preds
+
+    # sort and keep top nms_top_k。填充的-inf排在最后面
+    cate_scores, sort_inds = torch.sort(cate_scores, dim=1, descending=True, stable=True)
+    K = cate_scores.shape[1]
+    if nms_top_k > 0 and K > nms_top_k:
+        K = nms_top_k
+    cate_scores = cate_scores[:, :K]   # [N, K]
+    sort_inds = sort_inds[:, :K]
+    cate_labels = cate_labels.gather(1, sort_inds)   # [N, K]
+    bboxes = bboxes.gather(1, sort_inds.unsqueeze(2).expand(batch_size, K, 4))   # [N, K, 4]
+    valid = cate_scores > float('-inf')   # [N, K]  不是填充的
+
+    # Matrix NMS。第n张图片第i行第j列：分数更高的第i个框对第j个框的iou，只保留同类的、都不是填充的
+    iou_matrix = batch_jaccard(bboxes).triu_(diagonal=1)   # [N, K, K]
+    label_matrix = (cate_labels.unsqueeze(2) == cate_labels.unsqueeze(1)).float().triu_(diagonal=1)   # [N, K, K]
+    valid_matrix = valid.unsqueeze(2) & valid.unsqueeze(1)   # [N, K, K]
+    decay_iou = iou_matrix.mul_(label_matrix).masked_fill_(~valid_matrix, 0.0)
+    # 逐列取最大iou。填充的行衰减系数是1，不影响逐列取最小（第0行总是<=1）
+    compensate_iou, _ = decay_iou.max(1)   # [N, K]
+    compensate_iou = compensate_iou.unsqueeze(2)   # [N, K, 1]
+    if use_gaussian:
+        decay_matrix = torch.exp_(decay_iou.pow(2).mul_(-1 * gaussian_sigma))
+        compensate_matrix = torch.exp(-1 * gaussian_sigma * (compensate_iou ** 2))
+        decay_coefficient, _ = decay_matrix.div_(compensate_matrix).min(1)
+    else:
+        decay_matrix = (1 - decay_iou).div_(1 - compensate_iou)
+        decay_coefficient, _ = decay_matrix.min(1)
+    cate_scores = cate_scores * decay_coefficient   # [N, K]
+
+    # filter. 去掉的、填充的分数置为-inf，稳定排序后在最后面
+    keep = valid & (cate_scores >= post_threshold)
+    cate_scores = torch.where(keep, cate_scores, torch.full_like(cate_scores, float('-inf')))
+
+    # sort and keep keep_top_k
+    k = min(keep_top_k, K)
+    cate_scores, sort_inds = torch.sort(cate_scores, dim=1, descending=True, stable=True)
+    cate_scores = cate_scores[:, :k]
+    sort_inds = sort_inds[:, :k]
+    keep = keep.gather(1, sort_inds)
+    cate_labels = cate_labels.gather(1, sort_inds)
+    bboxes = bboxes.gather(1, sort_inds.unsqueeze(2).expand(batch_size, k, 4))
 
+    pred = torch.cat([cate_labels.unsqueeze(2).float(), cate_scores.unsqueeze(2), bboxes], 2)   # [N, k, 6]
+    preds[:, :k, :] = torch.where(keep.unsqueeze(2), pred, preds[:, :k, :])
+    return preds
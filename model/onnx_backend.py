@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 导出ONNX（骨干网络、FPN、head、解码，批大小、高、宽都是动态的），用onnxruntime在CPU上推理。
+#                 matrix_nms用NumPy实现（和model/matrix_nms.py相同），nms_cfg在推理时读，不固定在图里。
+#                 onnxruntime是可选的依赖，只有用到OnnxFCOS时才需要安装。
+#
+# ================================================================
+import numpy as np
+import torch
+
+from model.export import FCOSInference
+
+
+def export_onnx(fcos, save_path, target_size=512, max_size=736, opset_version=13):
+    '''
+    :param fcos: 加载好权重的FCOS
+    :param target_size max_size: 导出用的输入尺寸。批大小、高、宽都是动态的，导出后其他尺寸也能用（边长是pad_to_stride的倍数）。
+    '''
+    model = FCOSInference(fcos, with_nms=False).eval()
+    h = (target_size + 31) // 32 * 32
+    w = (max_size + 31) // 32 * 32
+    x = torch.zeros((1, 3, h, w))
+    im_info = torch.Tensor([[h, w, 1.0]])
+    with torch.no_grad():
+        torch.onnx.export(model, (x, im_info), save_path,
+                          input_names=['image', 'im_info'],
+                          output_names=['boxes', 'scores'],
+                          dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'im_info': {0: 'batch'},
+                                        'boxes': {0: 'batch', 1: 'points'},
+                                        'scores': {0: 'batch', 1: 'points'}},
+                          opset_version=opset_version,
+                          dynamo=False)
+
+
+def jaccard_np(boxes):
+    '''
+    一组矩形两两之间的iou。boxes: [n, 4]，返回 [n, n]
+    '''
+    max_xy = np.minimum(boxes[:, np.newaxis, 2:], boxes[np.newaxis, :, 2:])
+    min_xy = np.maximum(boxes[:, np.newaxis, :2], boxes[np.newaxis, :, :2])
+    inter = np.clip(max_xy - min_xy, 0, None)
+    inter = inter[:, :, 0] * inter[:, :, 1]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area[:, np.newaxis] + area[np.newaxis, :] - inter
+    return inter / union
+
+
+def matrix_nms_np(bboxes,
+                  scores,
+                  score_threshold,
+                  post_threshold,
+                  nms_top_k,
+                  keep_top_k,
+                  use_gaussian=False,
+                  gaussian_sigma=2.):
+    '''
+    一张图片的matrix_nms，和model/matrix_nms.py的matrix_nms()相同。
+    :param bboxes: [所有格子数, 4]
+    :param scores: [所有格子数, 80]
+    :return: [M, 6]，没有预测框时是[[-1, -1, -1, -1, -1, -1]]
+    '''
+    empty = np.zeros((1, 6), dtype=np.float32) - 1.0
+    point_inds, cate_labels = np.nonzero(scores > score_threshold)
+    if len(point_inds) == 0:
+        return empty
+    cate_scores = scores[point_inds, cate_labels]
+    bboxes = bboxes[point_inds]
+
+    # sort and keep top nms_top_k
+    sort_inds = np.argsort(-cate_scores, kind='stable')
+    if nms_top_k > 0:
+        sort_inds = sort_inds[:nms_top_k]
+    bboxes = bboxes[sort_inds]
+    cate_scores = cate_scores[sort_inds]
+    cate_labels = cate_labels[sort_inds]
+
+    # Matrix NMS。上三角部分：第i行第j列是分数更高的第i个框对第j个框的iou，只保留同类的
+    iou_matrix = np.triu(jaccard_np(bboxes), k=1)
+    label_matrix = np.triu(cate_labels[:, np.newaxis] == cate_labels[np.newaxis, :], k=1).astype(np.float32)
+    decay_iou = iou_matrix * label_matrix
+    compensate_iou = decay_iou.max(axis=0)[:, np.newaxis]   # 每个框被同类的、分数更高的框覆盖的最大iou
+    if use_gaussian:
+        decay_matrix = np.exp(-1 * gaussian_sigma * (decay_iou ** 2))
+        compensate_matrix = np.exp(-1 * gaussian_sigma * (compensate_iou ** 2))
+        decay_coefficient = (decay_matrix / compensate_matrix).min(axis=0)
+    else:
+        decay_matrix = (1 - decay_iou) / (1 - compensate_iou)
+        decay_coefficient = decay_matrix.min(axis=0)
+    cate_scores = cate_scores * decay_coefficient
+
+    # filter.
+    keep = cate_scores >= post_threshold
+    if keep.sum() == 0:
+        return empty
+    bboxes = bboxes[keep]
+    cate_scores = cate_scores[keep]
+    cate_labels = cate_labels[keep]
+
+    # sort and keep keep_top_k
+    sort_inds = np.argsort(-cate_scores, kind='stable')[:keep_top_k]
+    pred = np.concatenate([cate_labels[sort_inds, np.newaxis].astype(np.float32),
+                           cate_scores[sort_inds, np.newaxis],
+                           bboxes[sort_inds]], axis=1)
+    return pred.astype(np.float32)
+
+
+class OnnxFCOS(object):
+    """
+    用onnxruntime跑export_onnx()导出的模型，再用NumPy做matrix_nms。
+    调用方式和FCOS推理时一样，只是输入输出都是ndarray：model(image, im_info)，返回 [N, M, 6]。
+    批大小为1时M是预测框数，否则填充到keep_top_k，和FCOSHead._post_processing()一致。
+    Args:
+        onnx_path (str): export_onnx()导出的文件
+        nms_cfg (dict): 和配置文件里的nms_cfg相同
+        num_threads (int): onnxruntime的线程数。0表示由onnxruntime决定
+    """
+
+    def __init__(self, onnx_path, nms_cfg, num_threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.nms_cfg = nms_cfg
+
+    def __call__(self, image, im_info):
+        pred_boxes, pred_scores = self.session.run(None, {'image': image, 'im_info': im_info})
+        batch_size = pred_boxes.shape[0]
+        keep_top_k = self.nms_cfg['keep_top_k']
+        preds = []
+        for i in range(batch_size):
+            preds.append(matrix_nms_np(pred_boxes[i], pred_scores[i],
+                                       score_threshold=self.nms_cfg['score_threshold'],
+                                       post_threshold=self.nms_cfg['post_threshold'],
+                                       nms_top_k=self.nms_cfg['nms_top_k'],
+                                       keep_top_k=keep_top_k,
+                                       use_gaussian=self.nms_cfg['use_gaussian'],
+                                       gaussian_sigma=self.nms_cfg['gaussian_sigma']))
+        if batch_size == 1:
+            return preds[0][np.newaxis]
+        batch_preds = np.zeros((batch_size, keep_top_k, 6), dtype=np.float32) - 1.0
+        for i, pred in enumerate(preds):
+            batch_preds[i, :len(pred)] = pred
+        return batch_preds
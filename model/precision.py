@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 推理精度。fp32；bf16：卷积等在autocast下用bfloat16算，激活的内存减半；
+#                 fp16：卷积权重用float16存，计算时临时转回float32，只省权重的内存，结果几乎不变（只用于推理）。
+#                 解码、matrix_nms总是fp32（FCOSHead.get_prediction()里关掉autocast）。
+#
+# ================================================================
+import contextlib
+import torch
+import torch.nn.functional as F
+
+import logging
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ('fp32', 'bf16', 'fp16')
+
+
+class HalfWeightConv2d(torch.nn.Module):
+    """
+    代替torch.nn.Conv2d，权重用float16存，前向时转回float32再卷积。偏移很小，仍用float32存。
+    """
+
+    def __init__(self, conv):
+        super(HalfWeightConv2d, self).__init__()
+        assert conv.padding_mode == 'zeros'
+        self.register_buffer('weight', conv.weight.detach().half())
+        self.register_buffer('bias', None if conv.bias is None else conv.bias.detach())
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x):
+        return F.conv2d(x, self.weight.float(), self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+def store_weights_fp16(model):
+    '''
+    所有卷积换成HalfWeightConv2d。只用于推理，要在fuse_for_inference()之后调用，合并bn需要原来的conv。
+    '''
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if type(child) is torch.nn.Conv2d:
+                setattr(module, name, HalfWeightConv2d(child))
+    return model
+
+
+def bf16_supported(device_type):
+    if device_type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()   # CPU要有avx512bw等指令，否则bf16比fp32还慢
+
+
+def check_precision(precision, device_type):
+    '''
+    :return: 实际使用的精度。硬件不支持bf16时退回fp32。
+    '''
+    assert precision in PRECISIONS, 'precision must be one of {}'.format(PRECISIONS)
+    if precision == 'bf16' and not bf16_supported(device_type):
+        logger.warning('bf16 is not supported on this {}, falling back to fp32.'.format(device_type))
+        return 'fp32'
+    return precision
+
+
+def autocast(precision, device_type):
+    if precision == 'bf16':
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 骨干网络（ResNet、DLA34）的训练后int8静态量化（eager模式）。只在CPU上推理。
+#                 Conv2dUnit先合并bn/AffineChannel，再和relu融合；残差相加、拼接已经用FloatFunctional写好。
+#                 FPN、head仍然是float，骨干网络的输出在DeQuantStub处转回float。
+#
+# ================================================================
+import cv2
+import warnings
+import torch
+from torch.ao import quantization as tq
+
+from model.custom_layers import Conv2dUnit
+
+
+class QuantBackbone(torch.nn.Module):
+    """
+    骨干网络输入前量化、输出的每个特征图反量化，外面的FPN、head看到的仍然是float。
+    """
+
+    def __init__(self, backbone):
+        super(QuantBackbone, self).__init__()
+        self.quant = tq.QuantStub()
+        self.backbone = backbone
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        outs = self.backbone(x)
+        return [self.dequant(out) for out in outs]
+
+
+def fuse_backbone(backbone):
+    '''
+    把每个Conv2dUnit的bn、af合并进卷积（Conv2dUnit.fuse()），act是relu的再把conv+relu融合成一个模块。
+    '''
+    for m in backbone.modules():
+        if isinstance(m, Conv2dUnit):
+            assert m.gn is None, 'quantization does not support gn in the backbone'
+            m.fuse()
+            if isinstance(m.act, torch.nn.ReLU):
+                tq.fuse_modules(m, [['conv', 'act']], inplace=True)
+    return backbone
+
+
+def prepare_quant(fcos, backend='x86'):
+    '''
+    融合、插入量化/反量化节点和observer，之后跑校准数据收集各层输出的范围。fcos的骨干网络原地换成QuantBackbone。
+    FPN、head的bn也合并掉，和fuse_for_inference()之后的float模型一样。
+    '''
+    torch.backends.quantized.engine = backend
+    fcos.eval()
+    fcos.fuse_for_inference()
+    quant_backbone = QuantBackbone(fuse_backbone(fcos.backbone))
+    quant_backbone.qconfig = tq.get_default_qconfig(backend)
+    fcos.backbone = tq.prepare(quant_backbone, inplace=False)
+    return fcos
+
+
+def convert_quant(fcos):
+    '''
+    按校准得到的范围把骨干网络换成int8的模块。
+    '''
+    fcos.backbone = tq.convert(fcos.backbone, inplace=False)
+    return fcos
+
+
+@torch.no_grad()
+def calibrate(fcos, _decode, im_paths, batch_size=1):
+    '''
+    用Decode的预处理（和验证、测试时相同）读图片，跑一遍前向，observer记下各层输出的范围。
+    '''
+    for i in range(0, len(im_paths), batch_size):
+        samples = []
+        for im_path in im_paths[i:i + batch_size]:
+            img = cv2.imread(im_path)
+            samples.append(_decode.process_image(img))
+        pimage, im_info = _decode.process_batch(samples)
+        fcos(torch.from_numpy(pimage), torch.from_numpy(im_info))
+
+
+def quantize_fcos(fcos, _decode, im_paths, batch_size=1, backend='x86'):
+    '''
+    训练后静态量化：融合、插入observer、在im_paths上校准、转换。返回的模型只能在CPU上跑。
+    '''
+    fcos = prepare_quant(fcos.cpu(), backend)
+    calibrate(fcos, _decode, im_paths, batch_size)
+    return convert_quant(fcos)
+
+
+def load_quantized(fcos, path, backend='x86'):
+    '''
+    加载quantize_fcos()之后保存的state_dict。fcos是刚创建、还没加载权重的FCOS，先建出同样结构的量化模型再加载。
+    '''
+    with warnings.catch_warnings():   # 没有校准就转换，observer会警告，量化参数马上被state_dict覆盖
+        warnings.simplefilter('ignore')
+        fcos = convert_quant(prepare_quant(fcos.cpu(), backend))
+    fcos.load_state_dict(torch.load(path, map_location='cpu'))
+    fcos.eval()
+    return fcos
@@ -8,6 +8,7 @@
 #
 # ================================================================
 import torch
+from torch.ao.nn.quantized import FloatFunctional
 
 from model.custom_layers import Conv2dUnit
 
@@ -29,7 +30,7 @@ class ConvBlock(torch.nn.Module):
 
         self.conv4 = Conv2dUnit(in_c, filters3, 1, stride=stride, bn=bn, gn=gn, af=af, act=None)
 
-        self.act = torch.nn.ReLU()
+        self.skip_add = FloatFunctional()   # 相加再relu。量化时换成int8的add_relu
 
     def freeze(self):
         self.conv1.freeze()
@@ -42,8 +43,7 @@ class ConvBlock(torch.nn.Module):
         x = self.conv2(x)
         x = self.conv3(x)
         shortcut = self.conv4(input_tensor)
-        x = x + shortcut
-        x = self.act(x)
+        x = self.skip_add.add_relu(x, shortcut)
         return x
 
 
@@ -56,7 +56,7 @@ class IdentityBlock(torch.nn.Module):
         self.conv2 = Conv2dUnit(filters1, filters2, 3, stride=1, bn=bn, gn=gn, af=af, act='relu', use_dcn=use_dcn)
         self.conv3 = Conv2dUnit(filters2, filters3, 1, stride=1, bn=bn, gn=gn, af=af, act=None)
 
-        self.act = torch.nn.ReLU()
+        self.skip_add = FloatFunctional()   # 相加再relu。量化时换成int8的add_relu
 
     def freeze(self):
         self.conv1.freeze()
@@ -67,8 +67,7 @@ class IdentityBlock(torch.nn.Module):
         x = self.conv1(input_tensor)
         x = self.conv2(x)
         x = self.conv3(x)
-        x = x + input_tensor
-        x = self.act(x)
+        x = self.skip_add.add_relu(x, input_tensor)
         return x
 
 class Resnet(torch.nn.Module):
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 整批一起做的matrix_nms_batch()和逐张调用matrix_nms()再填充（原来的做法）的对比：结果是否逐位相同、CPU上的耗时。
+#                 输入是512x736的图片在5个fpn层上的格子数，预测框、分数随机生成，批大小1~32。用法：python test_code/batch_nms_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import torch
+
+from config import *
+from model.matrix_nms import matrix_nms, matrix_nms_batch
+
+
+def matrix_nms_loop(bboxes, scores, nms_cfg):
+    batch_size = bboxes.shape[0]
+    preds = torch.zeros((batch_size, nms_cfg['keep_top_k'], 6)) - 1.0
+    for i in range(batch_size):
+        pred = matrix_nms(bboxes[i], scores[i],
+                          score_threshold=nms_cfg['score_threshold'],
+                          post_threshold=nms_cfg['post_threshold'],
+                          nms_top_k=nms_cfg['nms_top_k'],
+                          keep_top_k=nms_cfg['keep_top_k'],
+                          use_gaussian=nms_cfg['use_gaussian'],
+                          gaussian_sigma=nms_cfg['gaussian_sigma'])
+        preds[i, :pred.shape[0], :] = pred
+    return preds
+
+
+def matrix_nms_batched(bboxes, scores, nms_cfg):
+    return matrix_nms_batch(bboxes, scores,
+                            score_threshold=nms_cfg['score_threshold'],
+                            post_threshold=nms_cfg['post_threshold'],
+                            nms_top_k=nms_cfg['nms_top_k'],
+                            keep_top_k=nms_cfg['keep_top_k'],
+                            use_gaussian=nms_cfg['use_gaussian'],
+                            gaussian_sigma=nms_cfg['gaussian_sigma'])
+
+
+def fake_predictions(batch_size, score_shift, h=512, w=736, num_classes=80):
+    num_points = sum(((h + s - 1) // s) * ((w + s - 1) // s) for s in [8, 16, 32, 64, 128])
+    xy = torch.rand(batch_size, num_points, 2) * torch.Tensor([w, h])
+    wh = torch.rand(batch_size, num_points, 2) * 200 + 4
+    bboxes = torch.cat([xy - wh / 2, xy + wh / 2], 2)
+    scores = torch.sigmoid(torch.randn(batch_size, num_points, num_classes) * 1.5 + score_shift)   # 大部分格子分数很低
+    return bboxes, scores
+
+
+def timeit(fn, runs):
+    fn()   # 预热
+    start = time.time()
+    for _ in range(runs):
+        out = fn()
+    return out, (time.time() - start) / runs
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    runs = 5
+    base_cfg = FCOS_RT_DLA34_FPN_4x_Config().nms_cfg
+    # 候选数很多（超过nms_top_k）和很少两种情况，后者耗时主要在每次调用的开销上
+    for nms_cfg, score_shift in [(base_cfg, -7.0), (dict(base_cfg, use_gaussian=True), -7.0), (base_cfg, -10.5)]:
+        print('use_gaussian=%s, score_shift=%.1f' % (nms_cfg['use_gaussian'], score_shift))
+        print('%6s %12s %10s %10s %10s %9s' % ('batch', 'candidates', 'same', 'loop ms', 'batch ms', 'speedup'))
+        for batch_size in [1, 2, 4, 8, 16, 32]:
+            bboxes, scores = fake_predictions(batch_size, score_shift)
+            num_cand = int((scores > nms_cfg['score_threshold']).sum()) // batch_size
+            preds, cost = timeit(lambda: matrix_nms_loop(bboxes, scores, nms_cfg), runs)
+            preds_b, cost_b = timeit(lambda: matrix_nms_batched(bboxes, scores, nms_cfg), runs)
+            print('%6d %12d %10s %10.2f %10.2f %8.2fx' % (batch_size, num_cand, torch.equal(preds, preds_b),
+                                                          cost * 1000, cost_b * 1000, cost / cost_b))
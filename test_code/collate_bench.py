@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : NormalizeImage+ResizeImage+Permute+PadBatchSingle+np.concatenate（原来的做法）
+#                 和 ResizeImage(uint8)+NormalizePermutePadBatch 的速度对比，以及两者输出的差别。
+#                 用法：python test_code/collate_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import cv2
+import numpy as np
+
+from config import *
+from tools.transform import NormalizeImage, ResizeImage, Permute, PadBatchSingle, NormalizePermutePadBatch
+
+
+def old_collate(ims, cfg, resizeImage):
+    normalizeImage = NormalizeImage(**cfg.normalizeImage)
+    permute = Permute(**cfg.permute)
+    padBatch = PadBatchSingle(use_padded_im_info=cfg.padBatch['use_padded_im_info'])
+    samples = []
+    for im in ims:
+        sample = {'image': im.copy(), 'h': im.shape[0], 'w': im.shape[1]}
+        samples.append(permute(resizeImage(normalizeImage(sample))))
+    stride = cfg.padBatch['pad_to_stride']
+    max_shape = np.array([s['image'].shape for s in samples]).max(axis=0)
+    max_shape[1] = int(np.ceil(max_shape[1] / stride) * stride)
+    max_shape[2] = int(np.ceil(max_shape[2] / stride) * stride)
+    return np.concatenate([np.expand_dims(padBatch(max_shape, s)['image'], 0) for s in samples], 0)
+
+
+def new_collate(ims, resizeImage, fused):
+    samples = [resizeImage({'image': im.copy(), 'h': im.shape[0], 'w': im.shape[1]}) for im in ims]
+    return fused(samples)
+
+
+if __name__ == '__main__':
+    cv2.setNumThreads(1)   # 和读数据的进程里一样，单线程
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path_dir = os.path.join(root, 'images/test')
+    names = sorted(os.listdir(path_dir))
+    ims = [cv2.cvtColor(cv2.imread(os.path.join(path_dir, name)), cv2.COLOR_BGR2RGB) for name in names]
+    batch_size = 4
+    batches = [ims[i:i + batch_size] for i in range(0, len(ims), batch_size)]
+    print('%-36s %12s %12s %10s %14s' % ('config', 'old ms', 'fused ms', 'speedup', 'mean abs diff'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        resizeImage = ResizeImage(target_size=cfg.eval_cfg['target_size'], max_size=cfg.eval_cfg['max_size'],
+                                  interp=cfg.resizeImage['interp'], use_cv2=cfg.resizeImage['use_cv2'])
+        fused = NormalizePermutePadBatch(to_bgr=cfg.permute['to_bgr'],
+                                         pad_to_stride=cfg.padBatch['pad_to_stride'],
+                                         use_padded_im_info=cfg.padBatch['use_padded_im_info'],
+                                         num_buffers=1, **cfg.normalizeImage)
+        cost_old, cost_new, diffs = 0.0, 0.0, []
+        for batch in batches:
+            start = time.time()
+            out_old = old_collate(batch, cfg, resizeImage)
+            cost_old += time.time() - start
+            start = time.time()
+            out_new = new_collate(batch, resizeImage, fused)
+            cost_new += time.time() - start
+            # 双三次插值在uint8上会截断到[0, 255]，float32上不截断，所以物体边缘有少量差别
+            diffs.append(np.abs(out_old - out_new).mean())
+        print('%-36s %12.2f %12.2f %9.1fx %14.5f' % (cfg.__class__.__name__, cost_old / len(batches) * 1000,
+                                                     cost_new / len(batches) * 1000, cost_old / cost_new, np.mean(diffs)))
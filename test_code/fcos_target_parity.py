@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : FCOSTargetAssigner（model/fcos_target.py，一批一起在torch里算）和Gt2FCOSTargetSingle（逐张图片用NumPy算）的对比。
+#                 随机的、填充过的gt（和训练时一样先经过ScaleGtBboxSingle），包括没有gt的图片。labels比较所有格子；reg_target、centerness只在正样本格子上比较，
+#                 损失只用到这些（负样本格子上两者的值本来就不同：NumPy版对应第0个gt，没有gt时对应虚构的gt）。
+#                 用法：python test_code/fcos_target_parity.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import copy
+import time
+import numpy as np
+import torch
+
+from config import *
+from model.fcos_target import FCOSTargetAssigner
+from tools.transform import Gt2FCOSTargetSingle, ScaleGtBboxSingle
+
+
+def random_batch(batch_size, h, w, max_gts, rng):
+    '''
+    gt是原图中的坐标，im_info里的缩放因子随机，和训练时一样由ScaleGtBboxSingle缩放后再填充。
+    :return: NumPy版用的samples，以及torch版用的填充后的gt_bbox [N, G, 4]、gt_class [N, G]、gt_num [N, ]
+    '''
+    scale_gt_bbox = ScaleGtBboxSingle()
+    samples = []
+    gt_nums = rng.randint(0, max_gts + 1, size=(batch_size, ))
+    gt_nums[0] = 0   # 每批至少有一张没有gt的图片
+    for num_gts in gt_nums:
+        scale = rng.uniform(0.5, 1.5)
+        orig_h, orig_w = h / scale, w / scale
+        x1 = rng.uniform(0, orig_w - 16, size=(num_gts, 1))
+        y1 = rng.uniform(0, orig_h - 16, size=(num_gts, 1))
+        bw = rng.uniform(8, orig_w / 2, size=(num_gts, 1))
+        bh = rng.uniform(8, orig_h / 2, size=(num_gts, 1))
+        sample = {}
+        sample['image'] = np.zeros((3, h, w), dtype=np.float32)
+        sample['im_info'] = np.array([h, w, scale], dtype=np.float32)
+        sample['gt_bbox'] = np.concatenate([x1, y1, np.minimum(x1 + bw, orig_w - 1), np.minimum(y1 + bh, orig_h - 1)], 1).astype(np.float32).reshape((num_gts, 4))
+        sample['gt_class'] = rng.randint(0, 80, size=(num_gts, 1)).astype(np.int32)
+        sample['gt_score'] = np.ones((num_gts, 1), dtype=np.float32)
+        samples.append(sample)
+    num_pad = max(int(gt_nums.max()), 1)
+    gt_bbox = np.zeros((batch_size, num_pad, 4), dtype=np.float32)
+    gt_class = np.zeros((batch_size, num_pad), dtype=np.int32)
+    for i, sample in enumerate(samples):
+        gt_bbox[i, :gt_nums[i]] = scale_gt_bbox(copy.deepcopy(sample))['gt_bbox']
+        gt_class[i, :gt_nums[i]] = sample['gt_class'][:, 0]
+    return samples, torch.from_numpy(gt_bbox), torch.from_numpy(gt_class), torch.from_numpy(gt_nums)
+
+
+def compare(samples, gt_nums, tag_labels, tag_bboxes, tag_center):
+    '''
+    :return: labels不同的格子数，正样本格子上reg_target、centerness的最大差别，没有gt的图片里NumPy版centerness不为0的格子数
+    '''
+    label_mismatch = 0
+    reg_diff = 0.0
+    ctn_diff = 0.0
+    no_gt_masked = 0
+    for lvl in range(len(tag_labels)):
+        labels = np.stack([s['labels%d' % lvl] for s in samples])
+        reg_target = np.stack([s['reg_target%d' % lvl] for s in samples])
+        centerness = np.stack([s['centerness%d' % lvl] for s in samples])
+        label_mismatch += int((labels != tag_labels[lvl].numpy()).sum())
+        pos = labels[..., 0] > 0
+        if pos.any():
+            reg_diff = max(reg_diff, float(np.abs(reg_target[pos] - tag_bboxes[lvl].numpy()[pos]).max()))
+            ctn_diff = max(ctn_diff, float(np.abs(centerness[pos] - tag_center[lvl].numpy()[pos]).max()))
+        for i, num_gts in enumerate(gt_nums):
+            if num_gts == 0:
+                no_gt_masked += int((centerness[i] != 0).sum())
+    return label_mismatch, reg_diff, ctn_diff, no_gt_masked
+
+
+if __name__ == '__main__':
+    np.seterr(divide='ignore', invalid='ignore')   # 负样本格子的centerness是0/0，和训练时一样忽略
+    torch.set_num_threads(1)
+    rng = np.random.RandomState(0)
+    batch_size = 4
+    print('%-36s %12s %6s %10s %10s %10s %12s %10s %10s' % ('config', 'input', 'gts', 'label diff', 'reg diff', 'ctn diff',
+                                                           'no-gt masked', 'numpy ms', 'torch ms'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_R50_FPN_4x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        op = Gt2FCOSTargetSingle(**cfg.gt2FCOSTarget)
+        assigner = FCOSTargetAssigner(**cfg.gt2FCOSTarget)
+        for (h, w) in [(512, 736), (800, 1344)]:
+            for max_gts in [1, 20, 100]:
+                samples, gt_bbox, gt_class, gt_num = random_batch(batch_size, h, w, max_gts, rng)
+                start = time.time()
+                outs = [op(copy.deepcopy(sample)) for sample in samples]
+                cost = time.time() - start
+                start = time.time()
+                tag_labels, tag_bboxes, tag_center = assigner(gt_bbox, gt_class, gt_num, h, w)
+                cost_t = time.time() - start
+                label_mismatch, reg_diff, ctn_diff, no_gt_masked = compare(outs, gt_num.numpy(), tag_labels, tag_bboxes, tag_center)
+                print('%-36s %12s %6d %10d %10.2e %10.2e %12d %10.2f %10.2f' % (cfg.__class__.__name__, '%dx%dx%d' % (batch_size, h, w),
+                                                                               max_gts, label_mismatch, reg_diff, ctn_diff,
+                                                                               no_gt_masked, cost * 1000, cost_t * 1000))
@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : FCOS.fuse_for_inference()合并bn、AffineChannel前后，模型输出的差别和CPU上的推理耗时。
+#                 bn的统计量、仿射参数随机初始化，合并才不是恒等变换。用法：python test_code/fuse_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import copy
+import time
+import torch
+
+from config import *
+from model.fcos import *
+from model.custom_layers import AffineChannel
+
+
+def build(cfg):
+    Backbone = select_backbone(cfg.backbone_type)
+    Fpn = select_fpn(cfg.fpn_type)
+    Head = select_head(cfg.head_type)
+    fcos = FCOS(Backbone(**cfg.backbone), Fpn(**cfg.fpn), Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head))
+    for m in fcos.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            torch.nn.init.uniform_(m.weight, 0.5, 1.5)
+            torch.nn.init.uniform_(m.bias, -0.5, 0.5)
+        elif isinstance(m, AffineChannel):
+            torch.nn.init.uniform_(m.weight, 0.5, 1.5)
+            torch.nn.init.uniform_(m.bias, -0.5, 0.5)
+    return fcos.eval()
+
+
+def raw_outputs(fcos, x):
+    body_feats, _ = fcos.neck(fcos.backbone(x))
+    cls_logits, bboxes_reg, centerness = fcos.head._get_output(body_feats, is_training=False)
+    return cls_logits + bboxes_reg + centerness
+
+
+def latency(fcos, x, im_info, runs):
+    fcos(x, im_info)   # 预热
+    start = time.time()
+    for _ in range(runs):
+        fcos(x, im_info)
+    return (time.time() - start) / runs
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    runs = 5
+    x = torch.randn(1, 3, 512, 672)
+    im_info = torch.Tensor([[512, 672, 1.0]])
+    print('%-36s %14s %12s %12s %10s' % ('config', 'max abs diff', 'orig ms', 'fused ms', 'speedup'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_R50_FPN_4x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        fcos = build(cfg)
+        fused = copy.deepcopy(fcos).fuse_for_inference()
+        with torch.no_grad():
+            outs = raw_outputs(fcos, x)
+            outs_fused = raw_outputs(fused, x)
+            diff = max((a - b).abs().max().item() for a, b in zip(outs, outs_fused))
+            cost = latency(fcos, x, im_info, runs)
+            cost_fused = latency(fused, x, im_info, runs)
+        print('%-36s %14.6f %12.2f %12.2f %9.2fx' % (cfg.__class__.__name__, diff, cost * 1000, cost_fused * 1000, cost / cost_fused))
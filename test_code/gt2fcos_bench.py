@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : Gt2FCOSTargetSingle的速度、内存对比。旧版用np.tile造出[所有格子数, gt数, 4]的数组，
+#                 新版广播+gt分块。检查两者输出的labels、reg_target、centerness逐位相同。
+#                 用法：python test_code/gt2fcos_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import copy
+import time
+import tracemalloc
+import numpy as np
+
+from tools.transform import Gt2FCOSTargetSingle
+
+
+class Gt2FCOSTargetSingleTile(Gt2FCOSTargetSingle):
+    """
+    旧版实现，原样保留作对比。
+    """
+
+    def _check_inside_boxes_limited(self, gt_bbox, xs, ys,
+                                    num_points_each_level):
+        """
+        check if points is within the clipped boxes
+        :param gt_bbox: bounding boxes
+        :param xs: horizontal coordinate of points
+        :param ys: vertical coordinate of points
+        :return: the mask of points is within gt_box or not
+        """
+        bboxes = np.reshape(   # [gt数, 4] -> [1, gt数, 4]
+            gt_bbox, [1, gt_bbox.shape[0], gt_bbox.shape[1]])
+        bboxes = np.tile(bboxes, reps=[xs.shape[0], 1, 1])   # [所有格子数, gt数, 4]   gt坐标
+        ct_x = (bboxes[:, :, 0] + bboxes[:, :, 2]) / 2       # [所有格子数, gt数]      gt中心点x
+        ct_y = (bboxes[:, :, 1] + bboxes[:, :, 3]) / 2       # [所有格子数, gt数]      gt中心点y
+        beg = 0   # 开始=0
+        clipped_box = bboxes.copy()   # [所有格子数, gt数, 4]   gt坐标，限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+        for lvl, stride in enumerate(self.downsample_ratios):   # 遍历每个感受野，从 stride=8的感受野 到 stride=128的感受野
+            end = beg + num_points_each_level[lvl]   # 结束=开始+这个感受野的格子数
+            stride_exp = self.center_sampling_radius * stride   # stride_exp = 1.5 * 这个感受野的stride(的格子边长)
+            clipped_box[beg:end, :, 0] = np.maximum(
+                bboxes[beg:end, :, 0], ct_x[beg:end, :] - stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+            clipped_box[beg:end, :, 1] = np.maximum(
+                bboxes[beg:end, :, 1], ct_y[beg:end, :] - stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+            clipped_box[beg:end, :, 2] = np.minimum(
+                bboxes[beg:end, :, 2], ct_x[beg:end, :] + stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+            clipped_box[beg:end, :, 3] = np.minimum(
+                bboxes[beg:end, :, 3], ct_y[beg:end, :] + stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+            beg = end
+        # xs  [所有格子数, gt数]， 所有格子中心点的横坐标重复 gt数 次
+        l_res = xs - clipped_box[:, :, 0]   # [所有格子数, gt数]  所有格子需要学习 gt数 个l
+        r_res = clipped_box[:, :, 2] - xs   # [所有格子数, gt数]  所有格子需要学习 gt数 个r
+        t_res = ys - clipped_box[:, :, 1]   # [所有格子数, gt数]  所有格子需要学习 gt数 个t
+        b_res = clipped_box[:, :, 3] - ys   # [所有格子数, gt数]  所有格子需要学习 gt数 个b
+        clipped_box_reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)   # [所有格子数, gt数, 4]  所有格子需要学习 gt数 个lrtb
+        inside_gt_box = np.min(clipped_box_reg_targets, axis=2) > 0   # [所有格子数, gt数]  需要学习的lrtb如果都>0，表示格子被选中。即只选取中心点落在gt内的格子。
+        return inside_gt_box
+
+    def __call__(self, sample, context=None):
+        assert len(self.object_sizes_of_interest) == len(self.downsample_ratios), \
+            "object_sizes_of_interest', and 'downsample_ratios' should have same length."
+
+        # im, gt_bbox, gt_class, gt_score = sample
+        im = sample['image']
+        im_info = sample['im_info']
+        bboxes = sample['gt_bbox']
+        gt_class = sample['gt_class']
+        gt_score = sample['gt_score']
+        no_gt = False
+        if len(bboxes) == 0:   # 如果没有gt，虚构一个gt为了后面不报错。
+            no_gt = True
+            bboxes = np.array([[0, 0, 100, 100]]).astype(np.float32)
+            gt_class = np.array([[0]]).astype(np.int32)
+            gt_score = np.array([[1]]).astype(np.float32)
+        # bboxes的横坐标变成缩放后图片中对应物体的横坐标
+        bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * np.floor(im_info[1]) / \
+            np.floor(im_info[1] / im_info[2])
+        # bboxes的纵坐标变成缩放后图片中对应物体的纵坐标
+        bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * np.floor(im_info[0]) / \
+            np.floor(im_info[0] / im_info[2])
+        # calculate the locations
+        h, w = sample['image'].shape[1:3]   # h w是这一批所有图片对齐后的高宽。
+        points, num_points_each_level, _, object_scale_exp = self._compute_points(w, h)   # points是所有格子中心点的坐标，num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
+
+        gt_area = (bboxes[:, 2] - bboxes[:, 0]) * (      # [gt数, ]   所有gt的面积
+            bboxes[:, 3] - bboxes[:, 1])
+        xs, ys = points[:, 0], points[:, 1]   # 所有格子中心点的横坐标、纵坐标
+        xs = np.reshape(xs, [xs.shape[0], 1])   # [所有格子数, 1]
+        xs = np.tile(xs, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的横坐标重复 gt数 次
+        ys = np.reshape(ys, [ys.shape[0], 1])   # [所有格子数, 1]
+        ys = np.tile(ys, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的纵坐标重复 gt数 次
+
+        l_res = xs - bboxes[:, 0]   # [所有格子数, gt数] - [gt数, ] = [所有格子数, gt数]     结果是所有格子中心点的横坐标 分别减去 所有gt左上角的横坐标，即所有格子需要学习 gt数 个l
+        r_res = bboxes[:, 2] - xs   # 所有格子需要学习 gt数 个r
+        t_res = ys - bboxes[:, 1]   # 所有格子需要学习 gt数 个t
+        b_res = bboxes[:, 3] - ys   # 所有格子需要学习 gt数 个b
+        reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)   # [所有格子数, gt数, 4]   所有格子需要学习 gt数 个lrtb
+        if self.center_sampling_radius > 0:
+            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内（gt是被限制边长后的gt）。
+            # FCOS首先将gt框内的锚点（格子中心点）视为候选正样本，然后根据为每个金字塔等级定义的比例范围从候选中选择最终的正样本（而且是负责预测gt里面积最小的），最后那些未选择的锚点为负样本。
+            # (1)第1个正负样本判断依据
+            is_inside_box = self._check_inside_boxes_limited(
+                bboxes, xs, ys, num_points_each_level)
+        else:
+            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内。
+            # FCOS首先将gt框内的锚点（格子中心点）视为候选正样本，然后根据为每个金字塔等级定义的比例范围从候选中选择最终的正样本（而且是负责预测gt里面积最小的），最后那些未选择的锚点为负样本。
+            # (1)第1个正负样本判断依据
+            is_inside_box = np.min(reg_targets, axis=2) > 0
+        # check if the targets is inside the corresponding level
+        max_reg_targets = np.max(reg_targets, axis=2)    # [所有格子数, gt数]   所有格子需要学习 gt数 个lrtb   中的最大值
+        lower_bound = np.tile(    # [所有格子数, gt数]   下限重复 gt数 次
+            np.expand_dims(
+                object_scale_exp[:, 0], axis=1),
+            reps=[1, max_reg_targets.shape[1]])
+        high_bound = np.tile(     # [所有格子数, gt数]   上限重复 gt数 次
+            np.expand_dims(
+                object_scale_exp[:, 1], axis=1),
+            reps=[1, max_reg_targets.shape[1]])
+
+        # [所有格子数, gt数]   最大回归值如果位于区间内，就为True
+        # (2)第2个正负样本判断依据
+        is_match_current_level = \
+            (max_reg_targets > lower_bound) & \
+            (max_reg_targets < high_bound)
+        # [所有格子数, gt数]   所有gt的面积
+        points2gtarea = np.tile(
+            np.expand_dims(
+                gt_area, axis=0), reps=[xs.shape[0], 1])
+        points2gtarea[is_inside_box == 0] = self.INF            # 格子中心点落在gt外的（即负样本），需要学习的面积置为无穷。     这是为了points2gtarea.min(axis=1)时，若某格子有最终正样本，那么就应该不让负样本的面积影响到判断。
+        points2gtarea[is_match_current_level == 0] = self.INF   # 最大回归值如果位于区间外（即负样本），需要学习的面积置为无穷。 这是为了points2gtarea.min(axis=1)时，若某格子有最终正样本，那么就应该不让负样本的面积影响到判断。
+        points2min_area = points2gtarea.min(axis=1)          # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值
+        points2min_area_ind = points2gtarea.argmin(axis=1)   # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值的下标
+        labels = gt_class[points2min_area_ind] + 1     # [所有格子数, 1]   所有格子需要学习 的类别id，学习的是gt中面积最小值的的类别id
+        labels[points2min_area == self.INF] = 0        # [所有格子数, 1]   负样本的points2min_area肯定是self.INF，这里将负样本需要学习 的类别id 置为0
+        reg_targets = reg_targets[range(xs.shape[0]), points2min_area_ind]   # [所有格子数, 4]   所有格子需要学习 的 lrtb（负责预测gt里面积最小的）
+        ctn_targets = np.sqrt((reg_targets[:, [0, 2]].min(axis=1) / \
+                              reg_targets[:, [0, 2]].max(axis=1)) * \
+                              (reg_targets[:, [1, 3]].min(axis=1) / \
+                               reg_targets[:, [1, 3]].max(axis=1))).astype(np.float32)   # [所有格子数, ]  所有格子需要学习的centerness
+        ctn_targets = np.reshape(
+            ctn_targets, [ctn_targets.shape[0], 1])   # [所有格子数, 1]  所有格子需要学习的centerness
+        ctn_targets[labels <= 0] = 0   # 负样本需要学习的centerness置为0
+        pos_ind = np.nonzero(labels != 0)   # tuple=( ndarray(shape=[正样本数, ]), ndarray(shape=[正样本数, ]) )   即正样本在labels中的下标，因为labels是2维的，所以一个正样本有2个下标。
+        reg_targets_pos = reg_targets[pos_ind[0], :]    # [正样本数, 4]   正样本格子需要学习 的 lrtb
+        split_sections = []   # 每一个感受野 最后一个格子 在reg_targets中的位置（第一维的位置）
+        beg = 0
+        for lvl in range(len(num_points_each_level)):
+            end = beg + num_points_each_level[lvl]
+            split_sections.append(end)
+            beg = end
+        if no_gt:   # 如果没有gt，labels里全部置为0（背景的类别id是0）即表示所有格子都是负样本
+            labels[:, :] = 0
+        labels_by_level = np.split(labels, split_sections, axis=0)             # 一个list，根据split_sections切分，各个感受野的target切分开来。
+        reg_targets_by_level = np.split(reg_targets, split_sections, axis=0)   # 一个list，根据split_sections切分，各个感受野的target切分开来。
+        ctn_targets_by_level = np.split(ctn_targets, split_sections, axis=0)   # 一个list，根据split_sections切分，各个感受野的target切分开来。
+
+        # 最后一步是reshape，和格子的位置对应上。
+        for lvl in range(len(self.downsample_ratios)):
+            grid_w = int(np.ceil(w / self.downsample_ratios[lvl]))   # 格子列数
+            grid_h = int(np.ceil(h / self.downsample_ratios[lvl]))   # 格子行数
+            if self.norm_reg_targets:   # 是否将reg目标归一化，配置里是True
+                sample['reg_target{}'.format(lvl)] = \
+                    np.reshape(
+                        reg_targets_by_level[lvl] / \
+                        self.downsample_ratios[lvl],      # 归一化方式是除以格子边长（即下采样倍率）
+                        [grid_h, grid_w, 4])     # reshape成[grid_h, grid_w, 4]
+            else:
+                sample['reg_target{}'.format(lvl)] = np.reshape(
+                    reg_targets_by_level[lvl],
+                    [grid_h, grid_w, 4])
+            sample['labels{}'.format(lvl)] = np.reshape(
+                labels_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+            sample['centerness{}'.format(lvl)] = np.reshape(
+                ctn_targets_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+        return sample
+
+
+def random_sample(h, w, num_gts, rng):
+    x1 = rng.uniform(0, w - 16, size=(num_gts, 1))
+    y1 = rng.uniform(0, h - 16, size=(num_gts, 1))
+    bw = rng.uniform(8, w / 2, size=(num_gts, 1))
+    bh = rng.uniform(8, h / 2, size=(num_gts, 1))
+    gt_bbox = np.concatenate([x1, y1, np.minimum(x1 + bw, w - 1), np.minimum(y1 + bh, h - 1)], 1).astype(np.float32)
+    sample = {}
+    sample['image'] = np.zeros((3, h, w), dtype=np.float32)
+    sample['im_info'] = np.array([h, w, 1.], dtype=np.float32)
+    sample['gt_bbox'] = gt_bbox
+    sample['gt_class'] = rng.randint(0, 80, size=(num_gts, 1)).astype(np.int32)
+    sample['gt_score'] = np.ones((num_gts, 1), dtype=np.float32)
+    return sample
+
+
+def run(op, sample, repeat):
+    # 先量峰值内存，再量时间（tracemalloc会拖慢速度）
+    tracemalloc.start()
+    out = op(copy.deepcopy(sample))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.time()
+    for _ in range(repeat):
+        op(copy.deepcopy(sample))
+    cost = (time.time() - start) / repeat
+    return out, cost, peak
+
+
+def same(out1, out2, n_features):
+    for lvl in range(n_features):
+        for key in ['labels%d' % lvl, 'reg_target%d' % lvl, 'centerness%d' % lvl]:
+            a, b = out1[key], out2[key]
+            if a.dtype != b.dtype or a.shape != b.shape:
+                return False
+            if not np.array_equal(a, b, equal_nan=True):
+                return False
+    return True
+
+
+if __name__ == '__main__':
+    # 和config里的Gt2FCOSTargetSingle一致
+    kwargs = dict(object_sizes_boundary=[64, 128, 256, 512],
+                  center_sampling_radius=1.5,
+                  downsample_ratios=[8, 16, 32, 64, 128],
+                  norm_reg_targets=True)
+    np.seterr(divide='ignore', invalid='ignore')   # 负样本格子的centerness是0/0，和训练时一样忽略
+    op_old = Gt2FCOSTargetSingleTile(**kwargs)
+    op_new = Gt2FCOSTargetSingle(**kwargs)
+    n_features = len(kwargs['downsample_ratios'])
+    rng = np.random.RandomState(0)
+    repeat = 5
+    print('%-12s %6s %12s %12s %12s %12s %8s' % ('image', 'gts', 'old ms', 'new ms', 'old MB', 'new MB', 'same'))
+    for (h, w) in [(512, 512), (768, 1024), (896, 1408)]:
+        for num_gts in [1, 10, 60, 200]:
+            sample = random_sample(h, w, num_gts, rng)
+            out_old, cost_old, peak_old = run(op_old, sample, repeat)
+            out_new, cost_new, peak_new = run(op_new, sample, repeat)
+            print('%-12s %6d %12.2f %12.2f %12.1f %12.1f %8s' % ('%dx%d' % (h, w), num_gts,
+                                                           cost_old * 1000, cost_new * 1000,
+                                                           peak_old / 1024 / 1024, peak_new / 1024 / 1024,
+                                                           same(out_old, out_new, n_features)))
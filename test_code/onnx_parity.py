@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 导出的ONNX模型（model/onnx_backend.py，onnxruntime + NumPy的matrix_nms）和原来的模型，
+#                 在导出用的尺寸以外的输入尺寸、批大小上的输出对比，以及CPU上的推理耗时。用法：python test_code/onnx_parity.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tempfile
+import time
+import numpy as np
+import torch
+
+from config import *
+from model.fcos import *
+from model.onnx_backend import export_onnx, OnnxFCOS
+
+
+def build(cfg):
+    # 分数阈值置0，随机权重的模型也有足够多的预测框参与nms
+    cfg.nms_cfg['score_threshold'] = 0.0
+    cfg.nms_cfg['post_threshold'] = 0.0
+    Backbone = select_backbone(cfg.backbone_type)
+    Fpn = select_fpn(cfg.fpn_type)
+    Head = select_head(cfg.head_type)
+    fcos = FCOS(Backbone(**cfg.backbone), Fpn(**cfg.fpn), Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head))
+    for m in fcos.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+    torch.nn.init.constant_(fcos.head.reg_convs[-1].conv.bias, 3.0)   # 预测框不至于都缩成一个点
+    return fcos.eval()
+
+
+def compare(pred, pred_onnx):
+    # 两边的结果都是先比类别、分数，再比坐标。分数很接近的框可能排序不同，所以按(类别, 分数)排序后再比较
+    diffs = []
+    for p, q in zip(pred, pred_onnx):
+        p = p[p[:, 0] >= 0]
+        q = q[q[:, 0] >= 0]
+        if len(p) != len(q):
+            return float('inf')
+        p = p[np.lexsort((p[:, 1], p[:, 0]))]
+        q = q[np.lexsort((q[:, 1], q[:, 0]))]
+        diffs.append(np.abs(p - q).max() if len(p) > 0 else 0.0)
+    return max(diffs)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    save_path = os.path.join(tempfile.gettempdir(), 'fcos_onnx_parity.onnx')
+    inputs = [(1, 512, 736), (1, 384, 512), (2, 448, 608)]   # 导出用的是(1, 512, 736)
+    print('%-36s %16s %14s %12s %12s' % ('config', 'input', 'max abs diff', 'eager ms', 'onnx ms'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_R50_FPN_4x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        fcos = build(cfg).fuse_for_inference()
+        export_onnx(fcos, save_path, 512, 736)
+        fcos_onnx = OnnxFCOS(save_path, cfg.nms_cfg, num_threads=1)
+        for n, h, w in inputs:
+            x = torch.randn(n, 3, h, w)
+            im_info = torch.Tensor([[h, w, 1.0]] * n)
+            x_np, im_info_np = x.numpy(), im_info.numpy()
+            with torch.no_grad():
+                fcos_onnx(x_np, im_info_np)   # 预热
+                start = time.time()
+                pred = fcos(x, im_info).numpy()
+                cost = time.time() - start
+            start = time.time()
+            pred_onnx = fcos_onnx(x_np, im_info_np)
+            cost_onnx = time.time() - start
+            print('%-36s %16s %14.6f %12.2f %12.2f' % (cfg.__class__.__name__, '%dx%dx%d' % (n, h, w),
+                                                       compare(pred, pred_onnx), cost * 1000, cost_onnx * 1000))
+    os.remove(save_path)
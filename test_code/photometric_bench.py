@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : PhotometricDistort（float32）和PhotometricDistortLUT（uint8查找表）的速度对比，
+#                 以及同一个随机种子下两者输出的差别。用法：python test_code/photometric_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import cv2
+import numpy as np
+
+from tools.transform import PhotometricDistort, PhotometricDistortLUT
+
+
+def run(op, im, seeds):
+    outs = []
+    start = time.time()
+    for seed in seeds:
+        np.random.seed(seed)
+        outs.append(op({'image': im})['image'])
+    cost = (time.time() - start) / len(seeds)
+    return outs, cost
+
+
+if __name__ == '__main__':
+    cv2.setNumThreads(1)   # 和读数据的进程里一样，单线程
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path_dir = os.path.join(root, 'images/test')
+    seeds = list(range(50))
+    op_float = PhotometricDistort()
+    op_lut = PhotometricDistortLUT()
+    print('%-24s %12s %12s %10s %14s' % ('image', 'float ms', 'lut ms', 'speedup', 'mean abs diff'))
+    for name in sorted(os.listdir(path_dir)):
+        im = cv2.imread(os.path.join(path_dir, name))
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        outs_float, cost_float = run(op_float, im, seeds)
+        outs_lut, cost_lut = run(op_lut, im, seeds)
+        # float版没有截断，比较时先截断到[0, 255]
+        diff = np.mean([np.abs(np.clip(a, 0, 255) - b.astype(np.float32)).mean() for a, b in zip(outs_float, outs_lut)])
+        print('%-24s %12.2f %12.2f %9.1fx %14.3f' % (name, cost_float * 1000, cost_lut * 1000, cost_float / cost_lut, diff))
+
+    # 统计上的一致性：所有输出的逐通道均值、标准差
+    stats_float = np.array([[np.clip(a, 0, 255)[:, :, c].mean() for c in range(3)] for a in outs_float])
+    stats_lut = np.array([[b[:, :, c].mean() for c in range(3)] for b in outs_lut])
+    print('per-channel mean over seeds, float: %s, lut: %s' % (np.round(stats_float.mean(0), 2), np.round(stats_lut.mean(0), 2)))
+    print('per-channel std over seeds,  float: %s, lut: %s' % (np.round(stats_float.std(0), 2), np.round(stats_lut.std(0), 2)))
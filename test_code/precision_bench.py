@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 推理精度（model/precision.py，fp32 / bf16 / fp16）对比：验证集上的mAP（tools/cocotools.py的eval()）、
+#                 每秒处理的图片数、权重占的内存、一次前向所有层输出（激活）的总大小。模型都是fuse_for_inference()之后的。
+#                 用法：python test_code/precision_bench.py --config 0 --num_eval 500 [--use_gpu True]
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import copy
+import time
+import cv2
+import torch
+
+from config import *
+from model.fcos import *
+from model.decode_np import Decode
+from model.precision import PRECISIONS, autocast
+from tools.cocotools import eval, get_classes, clsid2catid
+
+parser = argparse.ArgumentParser(description='Precision Benchmark')
+parser.add_argument('--use_gpu', type=bool, default=False)
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--num_eval', type=int, default=500, help='评估用的验证集图片数（有gt的前num_eval张）')
+parser.add_argument('--val_path', type=str, default=None, help='不是None时代替配置文件里的val_path')
+parser.add_argument('--val_pre_path', type=str, default=None, help='不是None时代替配置文件里的val_pre_path')
+args = parser.parse_args()
+
+
+def weight_mb(fcos):
+    tensors = list(fcos.parameters()) + list(fcos.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 1024 ** 2
+
+
+def activation_mb(_decode, im_path):
+    '''
+    一张验证集图片前向一次，所有叶子模块输出的总大小。
+    '''
+    total = [0]
+
+    def hook(module, inputs, output):
+        outs = output if isinstance(output, (list, tuple)) else [output]
+        total[0] += sum(t.numel() * t.element_size() for t in outs if isinstance(t, torch.Tensor))
+
+    fcos = _decode._model
+    handles = [m.register_forward_hook(hook) for m in fcos.modules() if len(list(m.children())) == 0]
+    pimage, im_info = _decode.process_batch([_decode.process_image(cv2.imread(im_path))])
+    pimage, im_info = torch.from_numpy(pimage), torch.from_numpy(im_info)
+    if _decode.use_gpu:
+        pimage, im_info = pimage.cuda(), im_info.cuda()
+    with torch.no_grad(), autocast(_decode.precision, _decode.device_type):
+        fcos(pimage, im_info)
+    for h in handles:
+        h.remove()
+    return total[0] / 1024 ** 2
+
+
+if __name__ == '__main__':
+    cfg = [FCOS_R50_FPN_Multiscale_2x_Config, FCOS_RT_R50_FPN_4x_Config, FCOS_RT_DLA34_FPN_4x_Config][args.config]()
+    if args.val_path is not None:
+        cfg.val_path = args.val_path
+    if args.val_pre_path is not None:
+        cfg.val_pre_path = args.val_pre_path
+    all_classes = get_classes(cfg.classes_path)
+    _clsid2catid = copy.deepcopy(clsid2catid)
+    if len(all_classes) != 80:
+        _clsid2catid = {k: k for k in range(len(all_classes))}
+
+    from pycocotools.coco import COCO
+    val_dataset = COCO(cfg.val_path)
+    images = val_dataset.loadImgs(val_dataset.getImgIds())
+    eval_images = [im for im in images if len(val_dataset.getAnnIds(imgIds=im['id'], iscrowd=False)) > 0][:args.num_eval]
+
+    Backbone = select_backbone(cfg.backbone_type)
+    Fpn = select_fpn(cfg.fpn_type)
+    Head = select_head(cfg.head_type)
+    fcos = FCOS(Backbone(**cfg.backbone), Fpn(**cfg.fpn), Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head))
+    fcos.load_state_dict(torch.load(cfg.eval_cfg['model_path'], map_location='cpu'))
+    if args.use_gpu:
+        fcos = fcos.cuda()
+    fcos.eval().fuse_for_inference()
+
+    results = []
+    for precision in PRECISIONS:
+        cfg.eval_cfg['precision'] = precision
+        _decode = Decode(copy.deepcopy(fcos), all_classes, args.use_gpu, cfg, for_test=False)
+        act = activation_mb(_decode, cfg.val_pre_path + eval_images[0]['file_name'])
+        start = time.time()
+        with torch.no_grad():
+            box_ap = eval(_decode, eval_images, cfg.val_pre_path, cfg.val_path, cfg.eval_cfg['eval_batch_size'], _clsid2catid,
+                          False, 0.0, cfg.eval_cfg['prefetch_depth'])
+        speed = len(eval_images) / (time.time() - start)
+        results.append((_decode.precision, box_ap[0], speed, weight_mb(_decode._model), act))
+
+    ap0, speed0, weight0, act0 = results[0][1:]
+    print('%-6s %10s %10s %12s %10s %12s %12s' % ('prec', 'mAP', 'delta', 'images/sec', 'speedup', 'weights MB', 'activ. MB'))
+    for precision, ap, speed, weight, act in results:
+        print('%-6s %10.4f %+10.4f %12.2f %9.2fx %12.1f %12.1f' % (precision, ap, ap - ap0, speed, speed / speed0, weight, act))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : FCOSHead后处理（解码+matrix_nms）每层预选pre_nms_top_n个候选与不预选（对所有格子算sigmoid()、解码）的对比：
+#                 结果的最大差别、CPU上的耗时。head的输出随机生成，尺寸是各配置验证时的尺寸。
+#                 用法：python test_code/preselect_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import torch
+
+from config import *
+from model.fcos import *
+
+
+def fake_head_outputs(head, batch_size, h, w, logit_shift):
+    cls_logits, bboxes_reg, centerness = [], [], []
+    for fpn_stride in head.fpn_stride:
+        fh, fw = (h + fpn_stride - 1) // fpn_stride, (w + fpn_stride - 1) // fpn_stride
+        cls_logits.append(torch.randn(batch_size, head.num_classes, fh, fw) * 1.5 + logit_shift)
+        bboxes_reg.append(torch.rand(batch_size, 4, fh, fw) * fpn_stride * 4)
+        centerness.append(torch.randn(batch_size, 1, fh, fw))
+    return cls_logits, bboxes_reg, centerness
+
+
+def post_processing(head, features, outputs, im_info, pre_nms_top_n):
+    head.nms_cfg['pre_nms_top_n'] = pre_nms_top_n
+    locations = head._compute_locations(features)
+    return head._post_processing(locations, *outputs, im_info)
+
+
+def compare(preds, preds_p):
+    # 只对留下来的候选算sigmoid()，和对整个张量算时可能差最后一位（CPU上向量化的部分和尾部的舍入不同）
+    if preds.shape != preds_p.shape:
+        return float('inf')
+    return (preds - preds_p).abs().max().item()
+
+
+def timeit(fn, runs):
+    fn()   # 预热
+    start = time.time()
+    for _ in range(runs):
+        out = fn()
+    return out, (time.time() - start) / runs
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    runs = 3
+    print('%-36s %14s %6s %8s %14s %12s %12s %9s' % ('config', 'input', 'shift', 'top_n', 'max abs diff', 'dense ms', 'preselect ms', 'speedup'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_R50_FPN_4x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        Head = select_head(cfg.head_type)
+        head = Head(fcos_loss=None, nms_cfg=dict(cfg.nms_cfg), **cfg.head).eval()
+        pre_nms_top_n = cfg.nms_cfg['pre_nms_top_n']
+        h = (cfg.eval_cfg['target_size'] + 31) // 32 * 32
+        w = (cfg.eval_cfg['max_size'] + 31) // 32 * 32
+        # logit_shift=-6时约18%的logit超过score_threshold对应的阈值；-9时约0.1%，和训练好的模型更接近
+        for batch_size, logit_shift in [(1, -6.0), (1, -9.0), (4, -6.0), (4, -9.0)]:
+            outputs = fake_head_outputs(head, batch_size, h, w, logit_shift)
+            im_info = torch.Tensor([[h, w, 1.0]] * batch_size)
+            with torch.no_grad():
+                for top_n in [pre_nms_top_n, cfg.nms_cfg['nms_top_k'] // 2]:   # 后者比nms_top_k小，结果会有差别
+                    preds, cost = timeit(lambda: post_processing(head, outputs[0], outputs, im_info, 0), runs)
+                    preds_p, cost_p = timeit(lambda: post_processing(head, outputs[0], outputs, im_info, top_n), runs)
+                    print('%-36s %14s %6.1f %8d %14.1e %12.2f %12.2f %8.2fx' % (cfg.__class__.__name__, '%dx%dx%d' % (batch_size, h, w), logit_shift,
+                                                                             top_n, compare(preds, preds_p), cost * 1000, cost_p * 1000, cost / cost_p))
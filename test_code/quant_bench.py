@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 骨干网络int8量化（model/quantization.py）前后，验证集上的mAP（tools/cocotools.py的eval()，即cocoapi_eval）
+#                 和CPU上每秒处理的图片数。float模型是fuse_for_inference()之后的。
+#                 用法：python test_code/quant_bench.py --config 2 --num_calib 100 --num_eval 500
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import copy
+import random
+import time
+import torch
+
+from config import *
+from model.fcos import *
+from model.decode_np import Decode
+from model.quantization import quantize_fcos
+from tools.cocotools import eval, get_classes, clsid2catid
+
+parser = argparse.ArgumentParser(description='Quantization Benchmark')
+parser.add_argument('--config', type=int, default=2,
+                    choices=[0, 1, 2],
+                    help='0 -- fcos_r50_fpn_multiscale_2x.py;  1 -- fcos_rt_r50_fpn_4x.py;  2 -- fcos_rt_dla34_fpn_4x.py.')
+parser.add_argument('--num_calib', type=int, default=100, help='校准用的验证集图片数')
+parser.add_argument('--num_eval', type=int, default=500, help='评估用的验证集图片数（有gt的前num_eval张）')
+parser.add_argument('--val_path', type=str, default=None, help='不是None时代替配置文件里的val_path')
+parser.add_argument('--val_pre_path', type=str, default=None, help='不是None时代替配置文件里的val_pre_path')
+args = parser.parse_args()
+
+
+def run_eval(fcos, cfg, images, all_classes, _clsid2catid):
+    _decode = Decode(fcos, all_classes, False, cfg, for_test=False)
+    start = time.time()
+    with torch.no_grad():
+        box_ap = eval(_decode, images, cfg.val_pre_path, cfg.val_path, cfg.eval_cfg['eval_batch_size'], _clsid2catid,
+                      False, 0.0, cfg.eval_cfg['prefetch_depth'])
+    return box_ap[0], len(images) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    cfg = [FCOS_R50_FPN_Multiscale_2x_Config, FCOS_RT_R50_FPN_4x_Config, FCOS_RT_DLA34_FPN_4x_Config][args.config]()
+    if args.val_path is not None:
+        cfg.val_path = args.val_path
+    if args.val_pre_path is not None:
+        cfg.val_pre_path = args.val_pre_path
+    all_classes = get_classes(cfg.classes_path)
+    _clsid2catid = copy.deepcopy(clsid2catid)
+    if len(all_classes) != 80:
+        _clsid2catid = {k: k for k in range(len(all_classes))}
+
+    from pycocotools.coco import COCO
+    val_dataset = COCO(cfg.val_path)
+    images = val_dataset.loadImgs(val_dataset.getImgIds())
+    calib_images = list(images)
+    random.Random(0).shuffle(calib_images)
+    calib_paths = [cfg.val_pre_path + im['file_name'] for im in calib_images[:args.num_calib]]
+    eval_images = [im for im in images if len(val_dataset.getAnnIds(imgIds=im['id'], iscrowd=False)) > 0][:args.num_eval]
+
+    Backbone = select_backbone(cfg.backbone_type)
+    Fpn = select_fpn(cfg.fpn_type)
+    Head = select_head(cfg.head_type)
+    fcos = FCOS(Backbone(**cfg.backbone), Fpn(**cfg.fpn), Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head))
+    fcos.load_state_dict(torch.load(cfg.eval_cfg['model_path'], map_location='cpu'))
+    fcos.eval()
+
+    fcos_int8 = quantize_fcos(copy.deepcopy(fcos), Decode(None, all_classes, False, cfg, for_test=False), calib_paths,
+                              cfg.eval_cfg['eval_batch_size'])
+    ap, speed = run_eval(fcos.fuse_for_inference(), cfg, eval_images, all_classes, _clsid2catid)
+    ap_int8, speed_int8 = run_eval(fcos_int8, cfg, eval_images, all_classes, _clsid2catid)
+    print('%-8s %10s %12s' % ('model', 'mAP', 'images/sec'))
+    print('%-8s %10.4f %12.2f' % ('float', ap, speed))
+    print('%-8s %10.4f %12.2f' % ('int8', ap_int8, speed_int8))
+    print('mAP delta: %+.4f, speedup: %.2fx' % (ap_int8 - ap, speed_int8 / speed))
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : DecodeImage全分辨率解码和缩小解码（reduced_decode=True）的速度对比。
+#                 两种做法ResizeImage之后的图片尺寸、缩放到网络输入上的gt坐标应该基本一致。
+#                 用法：python test_code/reduced_decode_bench.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import cv2
+import numpy as np
+
+from tools.transform import DecodeImage, ResizeImage, ScaleGtBboxSingle
+
+
+def run(decodeImage, resizeImage, data, h, w, gt_bbox, target_size):
+    sample = {'image': data, 'h': h, 'w': w, 'gt_bbox': gt_bbox, 'target_size': target_size}
+    start = time.time()
+    sample = decodeImage(sample)
+    cost = time.time() - start
+    decoded_shape = sample['image'].shape
+    sample = resizeImage(sample)
+    sample = ScaleGtBboxSingle()(sample)
+    return sample, decoded_shape, cost
+
+
+if __name__ == '__main__':
+    cv2.setNumThreads(1)   # 和读数据的进程里一样，单线程
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path_dir = os.path.join(root, 'images/test')
+    max_size = 900
+    resizeImage = ResizeImage(target_size=[256, 608], max_size=max_size, interp=2)
+    decode_full = DecodeImage(to_rgb=False)
+    decode_reduced = DecodeImage(to_rgb=False, reduced_decode=True, target_size=[256, 608], max_size=max_size)
+    print('%-24s %6s %14s %14s %10s %10s %10s %12s' % ('image', 'scale', 'full shape', 'reduced shape', 'full ms',
+                                                       'reduced ms', 'speedup', 'max gt diff'))
+    for name in sorted(os.listdir(path_dir))[:5]:
+        im = cv2.imread(os.path.join(path_dir, name))
+        # COCO的图片大多是640左右，再放大2、4倍编码成jpg，模拟高分辨率的数据集
+        for enlarge in [1, 2, 4]:
+            big = cv2.resize(im, None, fx=enlarge, fy=enlarge, interpolation=cv2.INTER_LINEAR)
+            data = cv2.imencode('.jpg', big)[1].tobytes()
+            h, w = big.shape[:2]
+            gt_bbox = np.array([[0.1 * w, 0.2 * h, 0.6 * w, 0.9 * h]], dtype=np.float32)
+            for target_size in [256, 608]:
+                s_full, shape_full, cost_full = run(decode_full, resizeImage, data, h, w, gt_bbox, target_size)
+                s_reduced, shape_reduced, cost_reduced = run(decode_reduced, resizeImage, data, h, w, gt_bbox, target_size)
+                # jpg缩小解码的尺寸是向上取整的，缩放后的尺寸最多差1个像素
+                size_diff = np.abs(np.array(s_full['image'].shape[:2]) - np.array(s_reduced['image'].shape[:2])).max()
+                assert size_diff <= 1
+                gt_diff = np.abs(s_full['gt_bbox'] - s_reduced['gt_bbox']).max()
+                print('%-24s %6d %14s %14s %10.2f %10.2f %9.1fx %12.3f' % (
+                    '%s x%d' % (name, enlarge), target_size, '%dx%d' % shape_full[:2], '%dx%d' % shape_reduced[:2],
+                    cost_full * 1000, cost_reduced * 1000, cost_full / cost_reduced, gt_diff))
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 导出的TorchScript模型（model/export.py）和原来的模型，在trace用的尺寸以外的输入尺寸、批大小上的输出对比，
+#                 以及CPU上的推理耗时。用法：python test_code/torchscript_parity.py
+#
+# ================================================================
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tempfile
+import time
+import torch
+
+from config import *
+from model.fcos import *
+from model.export import export_torchscript, load_torchscript
+
+
+def build(cfg):
+    # 分数阈值置0，随机权重的模型也有足够多的预测框参与nms
+    cfg.nms_cfg['score_threshold'] = 0.0
+    cfg.nms_cfg['post_threshold'] = 0.0
+    Backbone = select_backbone(cfg.backbone_type)
+    Fpn = select_fpn(cfg.fpn_type)
+    Head = select_head(cfg.head_type)
+    fcos = FCOS(Backbone(**cfg.backbone), Fpn(**cfg.fpn), Head(fcos_loss=None, nms_cfg=cfg.nms_cfg, **cfg.head))
+    for m in fcos.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+    torch.nn.init.constant_(fcos.head.reg_convs[-1].conv.bias, 3.0)   # 预测框不至于都缩成一个点
+    return fcos.eval()
+
+
+def compare(pred, pred_ts):
+    # 原来的模型批大小为1时不填充，只比较前面的，TorchScript模型后面填充的应该都是-1
+    k = pred.shape[1]
+    diff = (pred - pred_ts[:, :k]).abs().max().item()
+    if pred_ts.shape[1] > k:
+        diff = max(diff, (pred_ts[:, k:] + 1.0).abs().max().item())
+    return diff
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    save_path = os.path.join(tempfile.gettempdir(), 'fcos_torchscript_parity.pt')
+    inputs = [(1, 512, 736), (1, 384, 512), (2, 448, 608)]   # trace用的是(1, 512, 736)
+    print('%-36s %16s %14s %12s %12s' % ('config', 'input', 'max abs diff', 'eager ms', 'script ms'))
+    for cfg in [FCOS_R50_FPN_Multiscale_2x_Config(), FCOS_RT_R50_FPN_4x_Config(), FCOS_RT_DLA34_FPN_4x_Config()]:
+        fcos = build(cfg).fuse_for_inference()
+        export_torchscript(fcos, save_path, 512, 736)
+        fcos_ts = load_torchscript(save_path)
+        for n, h, w in inputs:
+            x = torch.randn(n, 3, h, w)
+            im_info = torch.Tensor([[h, w, 1.0]] * n)
+            with torch.no_grad():
+                fcos_ts(x, im_info)   # 预热，TorchScript前几次调用会做图优化
+                start = time.time()
+                pred = fcos(x, im_info)
+                cost = time.time() - start
+                start = time.time()
+                pred_ts = fcos_ts(x, im_info)
+                cost_ts = time.time() - start
+            print('%-36s %16s %14.6f %12.2f %12.2f' % (cfg.__class__.__name__, '%dx%dx%d' % (n, h, w),
+                                                       compare(pred, pred_ts), cost * 1000, cost_ts * 1000))
+    os.remove(save_path)
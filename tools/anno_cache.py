@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 训练集注解的缓存。data_clean()的结果存成扁平的numpy数组（npz，格式见tools/record_store.py），
+#                 下次启动时直接读，不用pycocotools解析完整的注解json、也不用逐张图片调用loadImgs/getAnnIds/loadAnns。
+#
+# ================================================================
+import os
+import json
+import hashlib
+import numpy as np
+
+from tools.data_process import data_clean
+from tools.record_store import RecordStore, records_to_arrays
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def anno_cache_key(anno_path, image_dir, catid2clsid):
+    '''
+    缓存的键。注解文件的绝对路径、大小、修改时间、开头和结尾各1MB内容的哈希，加上类别映射和图片目录。任何一个变了都重新生成缓存。
+    '''
+    st = os.stat(anno_path)
+    content = hashlib.sha1()
+    with open(anno_path, 'rb') as f:
+        content.update(f.read(1024 * 1024))
+        if st.st_size > 1024 * 1024:
+            f.seek(max(st.st_size - 1024 * 1024, 1024 * 1024))
+            content.update(f.read())
+    key = {
+        'anno_path': os.path.abspath(anno_path),
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'content': content.hexdigest(),
+        'image_dir': image_dir,
+        'catid2clsid': sorted([[int(k), int(v)] for k, v in catid2clsid.items()]),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_train_records(anno_path, image_dir, catid2clsid, cache_dir=None):
+    '''
+    读训练集注解。cache_dir不是None时先找缓存，没有或者过期就用pycocotools读、data_clean()清洗，再写缓存。
+    :return: RecordStore
+    '''
+    cache_path = None
+    if cache_dir is not None:
+        key = anno_cache_key(anno_path, image_dir, catid2clsid)
+        name = os.path.splitext(os.path.basename(anno_path))[0]
+        cache_path = os.path.join(cache_dir, '%s.%s.npz' % (name, key[:16]))
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                arrays = {k: data[k] for k in data.files}
+            records = RecordStore(arrays, anno_path=anno_path)
+            logger.info('{} samples in train set, loaded from {}.'.format(len(records), cache_path))
+            return records
+
+    from pycocotools.coco import COCO
+    train_dataset = COCO(anno_path)
+    train_img_ids = train_dataset.getImgIds()
+    records = data_clean(train_dataset, train_img_ids, catid2clsid, image_dir)
+    arrays = records_to_arrays(records)
+    records = RecordStore(arrays, anno_path=anno_path)
+
+    if cache_path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)   # 写完再改名，中途退出不会留下半个缓存
+        logger.info('Save annotation cache to {}'.format(cache_path))
+    return records
@@ -15,6 +15,8 @@ import time
 import threading
 import numpy as np
 import shutil
+from tools.prefetch import PrefetchQueue
+from tools import op_stats
 import logging
 logger = logging.getLogger(__name__)
 
@@ -109,27 +111,13 @@ def multi_thread_read(j, images, _decode, offset, eval_pre_path, batch_im_id, ba
     sample = _decode.process_image(np.copy(image))
     samples[j] = sample
 
-def multi_thread_read_batch_transforms(j, samples, max_shape, _decode, batch_pimage, batch_im_info):
-    pimage, im_info = _decode.process_image_batch_transforms(samples[j], max_shape)
-    batch_pimage[j] = pimage
-    batch_im_info[j] = im_info
-
 def read_eval_data(images,
                    _decode,
                    eval_pre_path,
                    eval_batch_size,
-                   num_steps,
-                   eval_dic):
+                   num_steps):
     n = len(images)
     for i in range(num_steps):
-        key_list = list(eval_dic.keys())
-        key_len = len(key_list)
-        while key_len >= 3:
-            time.sleep(0.01)
-            key_list = list(eval_dic.keys())
-            key_len = len(key_list)
-
-
         batch_size = eval_batch_size
         if i == num_steps - 1:
             batch_size = n - (num_steps - 1) * eval_batch_size
@@ -137,8 +125,6 @@ def read_eval_data(images,
         batch_im_id = [None] * batch_size
         batch_im_name = [None] * batch_size
         batch_img = [None] * batch_size
-        batch_pimage = [None] * batch_size
-        batch_im_info = [None] * batch_size
         samples = [None] * batch_size
         threads = []
         offset = i * eval_batch_size
@@ -153,33 +139,16 @@ def read_eval_data(images,
         for t in threads:
             t.join()
 
-        # batch_transforms。需要先同步PadBatch
-        coarsest_stride = _decode.pad_to_stride
-        max_shape = np.array([data['image'].shape for data in samples]).max(
-            axis=0)    # max_shape=[3, max_h, max_w]
-        max_shape[1] = int(   # max_h增加到最小的能被coarsest_stride=128整除的数
-            np.ceil(max_shape[1] / coarsest_stride) * coarsest_stride)
-        max_shape[2] = int(   # max_w增加到最小的能被coarsest_stride=128整除的数
-            np.ceil(max_shape[2] / coarsest_stride) * coarsest_stride)
-
-        for j in range(batch_size):
-            t = threading.Thread(target=multi_thread_read_batch_transforms,
-                                 args=(j, samples, max_shape, _decode, batch_pimage, batch_im_info))
-            threads.append(t)
-            t.start()
-        # 等待所有线程任务结束。
-        for t in threads:
-            t.join()
-
-        batch_pimage = np.concatenate(batch_pimage, axis=0)
-        batch_im_info = np.concatenate(batch_im_info, axis=0)
+        # batch_transforms。整批图片一次写进批数组
+        batch_pimage, batch_im_info = _decode.process_batch(samples)
         dic = {}
         dic['batch_im_id'] = batch_im_id
         dic['batch_im_name'] = batch_im_name
         dic['batch_img'] = batch_img
         dic['batch_pimage'] = batch_pimage
         dic['batch_im_info'] = batch_im_info
-        eval_dic['%.8d' % i] = dic
+        op_stats.report(i + 1, 'eval')
+        yield dic
 
 def multi_thread_write_json(j, result_image, result_boxes, result_scores, result_classes, batch_im_id, batch_im_name, _clsid2catid, draw_image):
     image = result_image[j]
@@ -217,7 +186,7 @@ def multi_thread_write_json(j, result_image, result_boxes, result_scores, result
 
 
 
-def eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image, draw_thresh):
+def eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2catid, draw_image, draw_thresh, prefetch_depth=3):
     # 8G内存的电脑并不能装下所有结果，所以把结果写进文件里。
     if os.path.exists('eval_results/bbox/'): shutil.rmtree('eval_results/bbox/')
     if draw_image:
@@ -236,24 +205,16 @@ def eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2cati
     logger.info('Total iter: {}'.format(num_steps))
     start = time.time()
 
-    # 读数据的线程
-    eval_dic = {}
-    thr = threading.Thread(target=read_eval_data,
-                           args=(images,
-                                 _decode,
-                                 eval_pre_path,
-                                 eval_batch_size,
-                                 num_steps,
-                                 eval_dic))
-    thr.start()
-    for i in range(num_steps):
-        key_list = list(eval_dic.keys())
-        key_len = len(key_list)
-        while key_len == 0:
-            time.sleep(0.01)
-            key_list = list(eval_dic.keys())
-            key_len = len(key_list)
-        dic = eval_dic.pop('%.8d' % i)
+    # 读数据的线程。读好的批放进有界阻塞队列。
+    eval_queue = PrefetchQueue(read_eval_data,
+                               args=(images,
+                                     _decode,
+                                     eval_pre_path,
+                                     eval_batch_size,
+                                     num_steps),
+                               depth=prefetch_depth)
+    write_threads = []
+    for i, dic in enumerate(eval_queue):
         batch_im_id = dic['batch_im_id']
         batch_im_name = dic['batch_im_name']
         batch_img = dic['batch_img']
@@ -268,13 +229,21 @@ def eval(_decode, images, eval_pre_path, anno_file, eval_batch_size, _clsid2cati
         for j in range(batch_size):
             t = threading.Thread(target=multi_thread_write_json,
                                  args=(j, result_image, result_boxes, result_scores, result_classes, batch_im_id, batch_im_name, _clsid2catid, draw_image))
+            write_threads.append(t)
             t.start()
         if i % 100 == 0:
             logger.info('Test iter {}'.format(i))
+    # 等所有结果都写进文件之后再评测
+    for t in write_threads:
+        t.join()
     logger.info('Test Done.')
     cost = time.time() - start
     logger.info('total time: {0:.6f}s'.format(cost))
     logger.info('Speed: %.6fs per image,  %.1f FPS.'%((cost / n), (n / cost)))
+    queue_stats = eval_queue.stats()
+    logger.info('Prefetch queue: mean occupancy {:.2f}/{}, consumer waits: {}, producer waits: {}'.format(
+        queue_stats['mean_occupancy'], queue_stats['depth'], queue_stats['empty_waits'], queue_stats['full_waits']))
+    op_stats.report(num_steps, 'eval', force=True)   # 预测都做完之后再汇总一次，包括模型里缓存的命中率
     # 开始评测
     box_ap_stats = bbox_eval(anno_file)
     return box_ap_stats
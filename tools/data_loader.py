@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 多进程读训练数据。sample_transforms、batch_transforms在常驻的工作进程里执行，
+#                 绕开GIL，读数据的速度随CPU核数增长。
+#
+# ================================================================
+import collections
+import multiprocessing
+import random
+import cv2
+import numpy as np
+
+from tools.data_process import get_batch_indexes, get_grouped_batches, get_mix_indexes, load_samples
+from tools import op_stats
+from tools.transform import MixupImage, NormalizePermutePadBatch, Gt2FCOSTargetSingle
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def make_batch(samples, context, with_mixup, sample_transforms, batch_transforms, n_features):
+    '''
+    对一批样本依次做sample_transforms、batch_transforms，再整理成ndarray。
+    batch_transforms里要有NormalizePermutePadBatch，它给出batch_images。
+    :return: dict。batch_images [N, 3, max_h, max_w]；pad_ratio是batch_images里填充的像素的比例；batch_labels{i}、batch_reg_target{i}、batch_centerness{i}是第i个感受野的target。
+             batch_transforms里没有Gt2FCOSTargetSingle时不算target，给出batch_gt_bbox [N, G, 4]、batch_gt_class [N, G]、batch_gt_num [N, ]。
+             稀疏的target时给出batch_labels{i}和batch_pos_ind、batch_pos_reg、batch_pos_ctn。
+    '''
+    batch_size = len(samples)
+    for k in range(batch_size):
+        for sample_transform in sample_transforms:
+            if isinstance(sample_transform, MixupImage) and not with_mixup:
+                continue
+            samples[k] = sample_transform(samples[k], context)
+
+    # batch_transforms。NormalizePermutePadBatch把整批图片写进一个批数组，需要先同步各图片的形状
+    batch = {}
+    for batch_transform in batch_transforms:
+        if isinstance(batch_transform, NormalizePermutePadBatch):
+            # 填充的像素的比例。此时图片还是HWC格式
+            valid_pixels = sum([s['image'].shape[0] * s['image'].shape[1] for s in samples])
+            batch['batch_images'] = batch_transform(samples, context)
+            pad_ratio = 1.0 - float(valid_pixels) / float(batch['batch_images'][:, 0].size)
+        else:
+            for k in range(batch_size):
+                samples[k] = batch_transform(samples[k], context)
+
+    # 整理成ndarray
+    batch['pad_ratio'] = pad_ratio
+    if not any(isinstance(t, Gt2FCOSTargetSingle) for t in batch_transforms):
+        # target在模型所在的设备上计算，只传gt。gt数填充到这一批的最大gt数。
+        max_num_gts = max(max([len(s['gt_bbox']) for s in samples]), 1)
+        batch_gt_bbox = np.zeros((batch_size, max_num_gts, 4), dtype=np.float32)
+        batch_gt_class = np.zeros((batch_size, max_num_gts), dtype=np.int32)
+        batch_gt_num = np.zeros((batch_size, ), dtype=np.int32)
+        for k, s in enumerate(samples):
+            num_gts = len(s['gt_bbox'])
+            batch_gt_bbox[k, :num_gts] = s['gt_bbox']
+            batch_gt_class[k, :num_gts] = s['gt_class'].reshape((-1, ))
+            batch_gt_num[k] = num_gts
+        batch['batch_gt_bbox'] = batch_gt_bbox
+        batch['batch_gt_class'] = batch_gt_class
+        batch['batch_gt_num'] = batch_gt_num
+        return batch
+    if 'pos_ind' in samples[0]:
+        # 稀疏的target（Gt2FCOSTargetSingle(sparse=True)）。batch_labels{i}是int16的稠密数组，
+        # 正样本只给出batch_pos_ind（在损失里 批大小*所有格子数 的下标）和它们的batch_pos_reg [P, 4]、batch_pos_ctn [P, 1]。
+        level_sizes = np.array([samples[0]['labels%d' % lvl].size for lvl in range(n_features)])
+        level_starts = np.concatenate([[0], np.cumsum(level_sizes)])   # 一张图片里每个感受野第一个格子的下标
+        batch_pos_ind = []
+        for k, s in enumerate(samples):
+            ind = s['pos_ind']
+            lvl = np.searchsorted(level_starts, ind, side='right') - 1
+            # 损失里的顺序：先按感受野，再按图片，最后是图片里的格子
+            batch_pos_ind.append(level_starts[lvl] * batch_size + k * level_sizes[lvl] + (ind - level_starts[lvl]))
+        batch['batch_pos_ind'] = np.concatenate(batch_pos_ind).astype(np.int64)
+        batch['batch_pos_reg'] = np.concatenate([s['pos_reg'] for s in samples], 0)
+        batch['batch_pos_ctn'] = np.concatenate([s['pos_ctn'] for s in samples], 0)
+        for lvl in range(n_features):
+            batch['batch_labels%d' % lvl] = np.stack([s['labels%d' % lvl] for s in samples], 0)
+        return batch
+    for lvl in range(n_features):
+        batch['batch_labels%d' % lvl] = np.stack([s['labels%d' % lvl].astype(np.int32) for s in samples], 0)
+        batch['batch_reg_target%d' % lvl] = np.stack([s['reg_target%d' % lvl].astype(np.float32) for s in samples], 0)
+        batch['batch_centerness%d' % lvl] = np.stack([s['centerness%d' % lvl].astype(np.float32) for s in samples], 0)
+    return batch
+
+
+# 工作进程里的全局变量，由_init_worker()填写。
+_worker_args = None
+
+
+def _init_worker(records, packed_dataset, loader_args, stats_cfg):
+    global _worker_args
+    _worker_args = (records, packed_dataset) + loader_args
+    # 用spawn启动的进程不继承主进程的模块状态，耗时统计的开关显式传过来
+    op_stats.configure(**stats_cfg)
+    # 已经是多进程并行，关掉opencv自己的线程池以免抢核。
+    cv2.setNumThreads(1)
+
+
+def _seed_batch(batch_seed):
+    # 数据增强用的是全局的np.random、random。每一批处理之前按这一批的种子重置，
+    # 数据增强只由这一批决定，和哪个工作进程处理、之前处理过哪些批都无关。
+    np.random.seed(batch_seed)
+    random.seed(batch_seed)
+
+
+def _read_packed_images(samples, indexes, mix_indexes, packed_dataset):
+    # 从打包的数据集的分片里读图片文件的字节，DecodeImage直接解码sample['image']
+    if packed_dataset is not None:
+        for k, sample in enumerate(samples):
+            sample['image'] = packed_dataset.read_image(indexes[k])
+            if 'mixup' in sample:
+                sample['mixup']['image'] = packed_dataset.read_image(mix_indexes[k])
+    return samples
+
+
+def _set_target_size(samples, target_size):
+    # 这一批的所有图片用同一个尺度，ResizeImage读sample['target_size']
+    if target_size is not None:
+        for sample in samples:
+            sample['target_size'] = target_size
+    return samples
+
+
+def _worker_make_batch(indexes, mix_indexes, target_size, batch_seed):
+    records, packed_dataset, context, with_mixup, sample_transforms, batch_transforms, n_features = _worker_args
+    _seed_batch(batch_seed)
+    samples = load_samples(records, indexes, mix_indexes)
+    samples = _read_packed_images(samples, indexes, mix_indexes, packed_dataset)
+    samples = _set_target_size(samples, target_size)
+    batch = make_batch(samples, context, with_mixup, sample_transforms, batch_transforms, n_features)
+    if op_stats.is_enabled():
+        # 这一批的算子耗时增量随批传回，主进程累加
+        batch['op_stats'] = op_stats.pop_stats()
+    return batch
+
+
+class TrainLoader(object):
+    """
+    常驻工作进程池。每个工作进程负责完整的一批，主进程只负责分发下标、按顺序收集结果。
+    第epoch个epoch的洗乱只由(seed, epoch)决定，这个epoch第step批的mixup图片、尺度、数据增强只由(seed, epoch, step)决定。
+    所以读数据的状态就是seed和已经训练的步数（state_dict()），从检查点恢复后产生的批和不中断时完全一样。
+    Args:
+        num_workers (int): 工作进程数。0表示在调用者的线程里直接处理。
+        seed (int): 随机种子。None表示随机选一个。
+        group_ids (ndarray): 每张图片的宽高比组号。不是None时同一组的图片凑成一批，减少PadBatch填充的像素。
+        batch_target_sizes (list): 不是None时每一批随机选一个尺度，这一批的所有图片都缩放到这个尺度。
+        packed_dataset (PackedDataset): 打包的数据集，records是它的records()。不是None时从分片里读图片，
+            每个epoch先洗乱分片、再在容量为shuffle_buffer的缓冲区里洗乱。和group_ids一起用时批的顺序不再洗乱，
+            按每批最后一张图片在这个顺序里的位置排，见get_grouped_batches()。
+    """
+
+    def __init__(self,
+                 records,
+                 batch_size,
+                 context,
+                 with_mixup,
+                 sample_transforms,
+                 batch_transforms,
+                 n_features,
+                 num_workers=0,
+                 seed=None,
+                 group_ids=None,
+                 batch_target_sizes=None,
+                 packed_dataset=None,
+                 shuffle_buffer=1000):
+        self.records = records
+        self.batch_size = batch_size
+        self.with_mixup = with_mixup
+        self.num_workers = num_workers
+        self.group_ids = group_ids
+        self.batch_target_sizes = batch_target_sizes
+        self.packed_dataset = packed_dataset
+        self.shuffle_buffer = shuffle_buffer
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31)
+        self.seed = seed
+        self.loader_args = (context, with_mixup, sample_transforms, batch_transforms, n_features)
+        self.pool = None
+        if num_workers > 0:
+            self.pool = multiprocessing.Pool(num_workers,
+                                             initializer=_init_worker,
+                                             initargs=(records, packed_dataset, self.loader_args,
+                                                       {'enable': op_stats.is_enabled()}))
+
+    def state_dict(self, iter_id, train_steps):
+        '''
+        读数据的状态，存进检查点。iter_id是已经训练的步数。
+        '''
+        return {
+            'seed': self.seed,
+            'iter_id': iter_id,
+            'epoch': iter_id // train_steps,
+            'step': iter_id % train_steps,
+        }
+
+    def load_state_dict(self, state):
+        '''
+        从检查点恢复。之后batches()从state['iter_id']的下一步开始产生。
+        '''
+        self.seed = state['seed']
+
+    def _make_batch_local(self, indexes, mix_indexes, target_size, batch_seed):
+        _seed_batch(batch_seed)
+        samples = load_samples(self.records, indexes, mix_indexes)
+        samples = _read_packed_images(samples, indexes, mix_indexes, self.packed_dataset)
+        samples = _set_target_size(samples, target_size)
+        return make_batch(samples, *self.loader_args)
+
+    def batches(self, train_indexes, train_steps, iter_id, max_iters):
+        '''
+        无限个epoch地产生批，直到第max_iters步。
+        :param iter_id: 已经训练的步数。产生的第一批是第iter_id+1步的。
+        :return: 生成器，每次给出 (iter_id, batch)
+        '''
+        # 在途的批数。工作进程都忙着，并且每个进程手上再排一批。
+        max_pending = 2 * self.num_workers
+        pending = collections.deque()
+        epoch = iter_id // train_steps
+        start_step = iter_id % train_steps   # 从检查点恢复时，从这个epoch的中间开始
+        while True:   # 无限个epoch
+            # 每个epoch之前洗乱。每个epoch都从train_indexes原来的顺序洗乱，不依赖之前的epoch。
+            rng = np.random.RandomState([self.seed, epoch])
+            if self.packed_dataset is not None:
+                epoch_indexes = self.packed_dataset.shuffled_indexes(self.shuffle_buffer, rng)
+            else:
+                epoch_indexes = list(train_indexes)
+                rng.shuffle(epoch_indexes)
+            if self.group_ids is not None:
+                # 打包的数据集不洗乱批的顺序，保持按分片顺序读
+                grouped_batches = get_grouped_batches(epoch_indexes, self.group_ids, self.batch_size, rng,
+                                                      keep_order=self.packed_dataset is not None)
+            for step in range(start_step, train_steps):
+                iter_id += 1
+                batch_rng = np.random.RandomState([self.seed, epoch, step])
+                if self.group_ids is not None:
+                    indexes = grouped_batches[step]
+                    mix_indexes = get_mix_indexes(epoch_indexes, indexes, batch_rng) if self.with_mixup else None
+                else:
+                    indexes, mix_indexes = get_batch_indexes(epoch_indexes, step, self.batch_size, self.with_mixup, batch_rng)
+                target_size = None
+                if self.batch_target_sizes is not None:
+                    target_size = self.batch_target_sizes[batch_rng.randint(0, len(self.batch_target_sizes))]
+                batch_seed = batch_rng.randint(0, 2 ** 31)   # 这一批数据增强的种子
+                if self.pool is None:
+                    yield iter_id, self._make_batch_local(indexes, mix_indexes, target_size, batch_seed)
+                else:
+                    pending.append((iter_id, self.pool.apply_async(_worker_make_batch, (indexes, mix_indexes, target_size, batch_seed))))
+                    if len(pending) >= max_pending:
+                        _iter_id, result = pending.popleft()
+                        yield _iter_id, result.get()
+                if iter_id == max_iters:
+                    while len(pending) > 0:
+                        _iter_id, result = pending.popleft()
+                        yield _iter_id, result.get()
+                    return
+            epoch += 1
+            start_step = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
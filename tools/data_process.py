@@ -11,6 +11,8 @@ import os
 import copy
 import numpy as np
 
+from tools.record_store import RecordStore
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -85,21 +87,90 @@ def data_clean(coco, img_ids, catid2clsid, image_dir):
     logger.info('{} samples in train set.'.format(ct))
     return records
 
-def get_samples(train_records, train_indexes, step, batch_size, with_mixup):
-    indexes = train_indexes[step * batch_size:(step + 1) * batch_size]
-    samples = []
-    for i in range(batch_size):
-        pos = indexes[i]
-        sample = copy.deepcopy(train_records[pos])
-
-        # 为mixup数据增强做准备
-        if with_mixup:
-            num = len(train_indexes)
-            mix_idx = np.random.randint(1, num)
+def get_batch_indexes(train_indexes, step, batch_size, with_mixup, rng=np.random):
+    indexes = list(train_indexes[step * batch_size:(step + 1) * batch_size])
+    mix_indexes = None
+    # 为mixup数据增强做准备
+    if with_mixup:
+        num = len(train_indexes)
+        mix_indexes = []
+        for i in range(batch_size):
+            mix_idx = rng.randint(1, num)
             mix_idx = train_indexes[(mix_idx + step * batch_size + i) % num]   # 为了不选到自己
-            sample['mixup'] = copy.deepcopy(train_records[mix_idx])
+            mix_indexes.append(mix_idx)
+    return indexes, mix_indexes
+
+def get_aspect_ratio_groups(train_records, aspect_ratio_bins):
+    '''
+    按宽高比w/h给每张图片分组。aspect_ratio_bins是分组边界，比如[0.75, 1.0, 1.333]分成4组。
+    :return: [图片数, ]  每张图片的组号
+    '''
+    if isinstance(train_records, RecordStore):
+        aspect_ratios = (train_records.w / train_records.h).astype(np.float32)
+    else:
+        aspect_ratios = np.array([rec['w'] / rec['h'] for rec in train_records], dtype=np.float32)
+    group_ids = np.digitize(aspect_ratios, aspect_ratio_bins)
+    counts = np.bincount(group_ids, minlength=len(aspect_ratio_bins) + 1)
+    logger.info('Aspect ratio groups (bins {}): {}'.format(aspect_ratio_bins, counts.tolist()))
+    return group_ids
+
+def get_grouped_batches(train_indexes, group_ids, batch_size, rng=np.random, keep_order=False):
+    '''
+    一个epoch的所有批。train_indexes需要已经洗乱。
+    同一组（宽高比相近）的图片凑成一批，每组凑不满一批的剩余图片再混在一起凑批，最后丢弃凑不满一批的。
+    所以批数和不分组时一样，都是 图片数 // batch_size。批的顺序是洗乱的。
+    keep_order=True时批的顺序不洗乱，按每批最后一张图片在train_indexes里的位置排，即按顺序读train_indexes、某一组凑满一批就给出这一批。
+    打包的数据集用这个，train_indexes是shuffled_indexes()给出的基本按分片顺序的顺序，再洗乱批的顺序就成了随机读分片。
+    rng是随机数生成器（np.random.RandomState），默认用全局的。
+    '''
+    buckets = {}
+    for idx in train_indexes:
+        buckets.setdefault(group_ids[idx], []).append(idx)
+    batches = []
+    leftovers = []
+    for g in sorted(buckets.keys()):
+        bucket = buckets[g]
+        num_full = len(bucket) // batch_size * batch_size
+        for i in range(0, num_full, batch_size):
+            batches.append(bucket[i:i + batch_size])
+        leftovers += bucket[num_full:]
+    for i in range(0, len(leftovers) // batch_size * batch_size, batch_size):
+        batches.append(leftovers[i:i + batch_size])
+    if keep_order:
+        position = {idx: i for i, idx in enumerate(train_indexes)}
+        return sorted(batches, key=lambda batch: max(position[idx] for idx in batch))
+    order = rng.permutation(len(batches))
+    return [batches[i] for i in order]
 
+def get_mix_indexes(train_indexes, indexes, rng=np.random):
+    '''
+    为mixup数据增强随机选另一张图片，不选到自己。
+    '''
+    num = len(train_indexes)
+    mix_indexes = []
+    for idx in indexes:
+        mix_idx = train_indexes[rng.randint(0, num)]
+        while mix_idx == idx and num > 1:
+            mix_idx = train_indexes[rng.randint(0, num)]
+        mix_indexes.append(mix_idx)
+    return mix_indexes
+
+def load_samples(train_records, indexes, mix_indexes=None):
+    # RecordStore每次给出新的dict，数组是只读视图，不需要深复制。
+    if isinstance(train_records, RecordStore):
+        get_record = lambda pos: train_records[pos]
+    else:
+        get_record = lambda pos: copy.deepcopy(train_records[pos])
+    samples = []
+    for i, pos in enumerate(indexes):
+        sample = get_record(pos)
+        if mix_indexes is not None:
+            sample['mixup'] = get_record(mix_indexes[i])
         samples.append(sample)
     return samples
 
+def get_samples(train_records, train_indexes, step, batch_size, with_mixup):
+    indexes, mix_indexes = get_batch_indexes(train_indexes, step, batch_size, with_mixup)
+    return load_samples(train_records, indexes, mix_indexes)
+
 
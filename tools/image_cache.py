@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 解码后图片的缓存。所有图片解码一次，按顺序写进一个uint8文件，训练时用np.memmap只读打开，
+#                 DecodeImage直接拿到图片的视图，不用每个epoch都重新读文件、解码jpg。
+#                 文件只读，多个读数据的进程共用操作系统的页缓存。
+#
+# ================================================================
+import os
+import json
+import multiprocessing
+import cv2
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DATA_NAME = 'images.u8'
+INDEX_NAME = 'index.json'
+
+
+def shrink_size(h, w, target_size, max_size):
+    '''
+    和ResizeImage相同的规则算出最大的缩放尺寸。target_size是list时取最大的尺度。只缩小不放大。
+    :return: 缩小后的高、宽
+    '''
+    if isinstance(target_size, list):
+        target_size = max(target_size)
+    if target_size <= 0:
+        return h, w
+    im_size_min = min(h, w)
+    im_size_max = max(h, w)
+    im_scale = float(target_size) / float(im_size_min)
+    if max_size != 0 and np.round(im_scale * im_size_max) > max_size:
+        im_scale = float(max_size) / float(im_size_max)
+    if im_scale >= 1.0:
+        return h, w
+    return int(np.round(h * im_scale)), int(np.round(w * im_scale))
+
+
+def rescale_gt_bbox(gt_bbox, orig_h, orig_w, h, w):
+    '''
+    缓存里的图片被缩小过时，gt坐标也跟着缩放。返回新数组，不修改原来的gt_bbox。
+    '''
+    scale = np.array([w / orig_w, h / orig_h, w / orig_w, h / orig_h], dtype=np.float32)
+    return (gt_bbox * scale).astype(np.float32)
+
+
+def _decode_for_cache(args):
+    im_file, to_rgb, target_size, max_size = args
+    im = cv2.imread(im_file, 1)   # BGR
+    if im is None:
+        raise IOError('Can not read image: {}'.format(im_file))
+    if to_rgb:
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    orig_h, orig_w = im.shape[:2]
+    h, w = shrink_size(orig_h, orig_w, target_size, max_size)
+    if (h, w) != (orig_h, orig_w):
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_AREA)
+    return im_file, np.ascontiguousarray(im), orig_h, orig_w
+
+
+def build_image_cache(im_files, cache_dir, to_rgb=True, target_size=0, max_size=0, num_workers=4):
+    '''
+    解码所有图片，写进cache_dir下的images.u8，索引（偏移、形状、原始高宽）写进index.json。
+    :param im_files: 图片路径list，和data_clean()给出的im_file一致
+    :param to_rgb: 和DecodeImage的to_rgb一致
+    :param target_size max_size: ResizeImage的配置。target_size>0时预先缩小到训练时可能用到的最大尺寸。
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    data_path = os.path.join(cache_dir, DATA_NAME)
+    tasks = [(im_file, to_rgb, target_size, max_size) for im_file in im_files]
+    images = []
+    offset = 0
+    pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+    results = pool.imap(_decode_for_cache, tasks, chunksize=16) if pool is not None else map(_decode_for_cache, tasks)
+    with open(data_path, 'wb') as f:
+        for k, (im_file, im, orig_h, orig_w) in enumerate(results):
+            f.write(im.tobytes())
+            images.append({
+                'im_file': os.path.normpath(im_file),
+                'offset': offset,
+                'shape': list(im.shape),
+                'orig_shape': [orig_h, orig_w],
+            })
+            offset += im.nbytes
+            if (k + 1) % 1000 == 0:
+                logger.info('Cached {}/{} images, {:.1f} GB.'.format(k + 1, len(tasks), offset / 1024 ** 3))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    index = {
+        'to_rgb': to_rgb,
+        'target_size': target_size,
+        'max_size': max_size,
+        'images': images,
+    }
+    with open(os.path.join(cache_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    logger.info('Cached {} images into {}, {:.1f} GB.'.format(len(images), data_path, offset / 1024 ** 3))
+
+
+class ImageCache(object):
+    """
+    只读的解码后图片缓存。np.memmap在第一次get()时才打开，所以fork出来的每个读数据的进程各自映射同一个文件。
+    Args:
+        cache_dir (str): build_image_cache()生成的目录
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        self.to_rgb = index['to_rgb']
+        self.entries = {}
+        for entry in index['images']:
+            self.entries[entry['im_file']] = entry
+        self.data = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, im_file):
+        return os.path.normpath(im_file) in self.entries
+
+    def __getstate__(self):
+        # 传给别的进程时不带上映射，到了那边再打开
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def get(self, im_file):
+        '''
+        :return: (im, orig_h, orig_w)。im是只读的视图[h, w, 3]，不复制。缓存里没有这张图片时返回None。
+        '''
+        entry = self.entries.get(os.path.normpath(im_file))
+        if entry is None:
+            return None
+        if self.data is None:
+            self.data = np.asarray(np.memmap(os.path.join(self.cache_dir, DATA_NAME), dtype=np.uint8, mode='r'))
+        h, w, c = entry['shape']
+        offset = entry['offset']
+        im = self.data[offset:offset + h * w * c].reshape((h, w, c))
+        orig_h, orig_w = entry['orig_shape']
+        return im, orig_h, orig_w
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 只读文件头得到图片的高宽，不解码整张图片。JPEG读SOF段（并按EXIF的方向交换高宽，和cv2.imread一致），
+#                 PNG读IHDR块。其他格式或文件头解析失败时退回cv2.imread。
+#
+# ================================================================
+import struct
+import cv2
+
+
+# SOF0~SOF15，除去DHT(0xC4)、JPG(0xC8)、DAC(0xCC)
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# 没有长度字段的标记：TEM、RST0~RST7、SOI、EOI
+_JPEG_STANDALONE = {0x01} | set(range(0xD0, 0xDA))
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _exif_orientation(data):
+    '''
+    APP1段里EXIF的方向（0x0112），没有时返回1。
+    '''
+    if not data.startswith(b'Exif\x00\x00'):
+        return 1
+    tiff = data[6:]
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    num_entries = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    for k in range(num_entries):
+        entry = tiff[ifd + 2 + 12 * k:ifd + 14 + 12 * k]
+        if len(entry) < 12:
+            break
+        tag = struct.unpack(endian + 'H', entry[:2])[0]
+        if tag == 0x0112:
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return 1
+
+
+def _jpeg_size(f):
+    orientation = 1
+    while True:
+        b = f.read(1)
+        if len(b) == 0:
+            return None
+        if b != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':   # 填充字节
+            marker = f.read(1)
+        if len(marker) == 0:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_STANDALONE:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker in _JPEG_SOF:
+            _, h, w = struct.unpack('>BHH', f.read(5))
+            # 方向5~8是转置、旋转90度，cv2.imread按EXIF摆正后高宽交换
+            if orientation in (5, 6, 7, 8):
+                h, w = w, h
+            return h, w
+        if marker == 0xDA:   # SOS之后是压缩数据，没有找到SOF
+            return None
+        data = f.read(length - 2)
+        if marker == 0xE1 and orientation == 1:
+            orientation = _exif_orientation(data)
+
+
+def _png_size(f):
+    header = f.read(8)   # 块长度、块类型
+    if header[4:8] != b'IHDR':
+        return None
+    w, h = struct.unpack('>II', f.read(8))
+    return h, w
+
+
+def read_image_size(im_file):
+    '''
+    :return: (h, w)，和cv2.imread(im_file).shape[:2]相同。读不出来时返回None。
+    '''
+    size = None
+    try:
+        with open(im_file, 'rb') as f:
+            head = f.read(8)
+            if head[:2] == b'\xff\xd8':
+                f.seek(2)
+                size = _jpeg_size(f)
+            elif head == _PNG_SIGNATURE:
+                f.seek(8)
+                size = _png_size(f)
+    except (OSError, struct.error, IndexError):
+        size = None
+    if size is None:   # 其他格式、文件头损坏，解码整张图片
+        im = cv2.imread(im_file)
+        if im is None:
+            return None
+        size = im.shape[:2]
+    return size
+
+
+def read_image_sizes(im_files, pool=None, chunksize=64):
+    '''
+    一组图片的高宽，顺序和im_files一致。pool不是None时用进程池并行读。
+    '''
+    if pool is None:
+        return [read_image_size(im_file) for im_file in im_files]
+    return pool.map(read_image_size, im_files, chunksize=chunksize)
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 有界的LRU缓存。FCOS的格子中心点坐标等只和(对齐后的高宽, 下采样倍率, dtype, device)有关，
+#                 对齐后的尺寸种类不多，缓存起来各批复用。命中率记进op_stats。
+#
+# ================================================================
+import collections
+import threading
+
+from tools import op_stats
+
+
+class LRUCache(object):
+    """
+    get(key, build)命中时直接返回缓存的值，否则调用build()生成并放进缓存；超过capacity个时丢掉最久没用过的。
+    缓存的值会被很多批共用，调用者不能原地修改。
+    Args:
+        name (str): 统计命中率时的名字
+        capacity (int): 最多缓存几个
+    """
+
+    def __init__(self, name, capacity=64):
+        self.name = name
+        self.capacity = capacity
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+        hit = value is not None
+        if not hit:
+            value = build()
+            with self._lock:
+                self._data[key] = value
+                while len(self._data) > self.capacity:
+                    self._data.popitem(last=False)
+        op_stats.record_cache(self.name, hit)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 预处理算子的耗时统计。默认关闭，configure(enable=True)之后每个BaseOperator子类的__call__
+#                 都会累计 耗时、调用次数、输出数组的字节数。按算子的stats_scope（train/eval/test）分开统计。
+#                 另外统计各个LRUCache（tools/lru_cache.py）的命中次数、未命中次数。
+#                 多线程：统计表加锁。多进程：工作进程用pop_stats()取出增量随批传回，主进程merge()。
+#
+# ================================================================
+import json
+import threading
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_enabled = False
+_print_iter = 0
+_json_path = None
+_lock = threading.Lock()
+_stats = {}   # {scope: {算子名: [耗时(秒), 调用次数, 输出字节数]}}
+_cache_stats = {}   # {缓存名: [命中次数, 未命中次数]}
+
+
+def configure(enable=False, print_iter=100, json_path=None):
+    '''
+    :param enable: 是否统计
+    :param print_iter: report()每隔几步打印一次汇总。0表示不打印
+    :param json_path: report()打印时同时写到这个json文件。None表示不写
+    '''
+    global _enabled, _print_iter, _json_path
+    _enabled = enable
+    _print_iter = print_iter
+    _json_path = json_path
+
+
+def is_enabled():
+    return _enabled
+
+
+def output_nbytes(out):
+    '''
+    算子输出的数组的字节数。out是sample（dict，mixup的图片在sample['mixup']里）、samples或批数组。
+    '''
+    if isinstance(out, np.ndarray):
+        return out.nbytes
+    if isinstance(out, dict):
+        return sum(output_nbytes(v) for v in out.values())
+    if isinstance(out, (list, tuple)):
+        return sum(output_nbytes(v) for v in out)
+    return 0
+
+
+def record(scope, name, cost, nbytes):
+    with _lock:
+        ops = _stats.setdefault(scope, {})
+        s = ops.get(name)
+        if s is None:
+            ops[name] = [cost, 1, nbytes]
+        else:
+            s[0] += cost
+            s[1] += 1
+            s[2] += nbytes
+
+
+def record_cache(name, hit):
+    if not _enabled:
+        return
+    with _lock:
+        s = _cache_stats.get(name)
+        if s is None:
+            s = _cache_stats[name] = [0, 0]
+        s[0 if hit else 1] += 1
+
+
+def pop_stats():
+    '''
+    取出并清空统计表。工作进程每处理完一批调用一次，把增量随批传回主进程。
+    '''
+    global _stats, _cache_stats
+    with _lock:
+        stats = {'ops': _stats, 'caches': _cache_stats}
+        _stats, _cache_stats = {}, {}
+    return stats
+
+
+def merge(stats):
+    '''
+    累加pop_stats()取出的增量。
+    '''
+    with _lock:
+        for name, (hits, misses) in stats['caches'].items():
+            s = _cache_stats.get(name)
+            if s is None:
+                s = _cache_stats[name] = [0, 0]
+            s[0] += hits
+            s[1] += misses
+        for scope, ops in stats['ops'].items():
+            _ops = _stats.setdefault(scope, {})
+            for name, (cost, calls, nbytes) in ops.items():
+                s = _ops.get(name)
+                if s is None:
+                    _ops[name] = [cost, calls, nbytes]
+                else:
+                    s[0] += cost
+                    s[1] += calls
+                    s[2] += nbytes
+
+
+def get_stats():
+    '''
+    :return: {'ops': {scope: {算子名: {'time':, 'calls':, 'bytes':, 'ms_per_call':, 'kb_per_call':}}},
+              'caches': {缓存名: {'hits':, 'misses':, 'hit_rate':}}}，可以直接写json
+    '''
+    with _lock:
+        stats = {scope: {name: list(s) for name, s in ops.items()} for scope, ops in _stats.items()}
+        cache_stats = {name: list(s) for name, s in _cache_stats.items()}
+    out = {'ops': {}, 'caches': {}}
+    for scope, ops in stats.items():
+        out['ops'][scope] = {}
+        for name, (cost, calls, nbytes) in ops.items():
+            out['ops'][scope][name] = {
+                'time': cost,
+                'calls': calls,
+                'bytes': nbytes,
+                'ms_per_call': cost / calls * 1000,
+                'kb_per_call': nbytes / calls / 1024,
+            }
+    for name, (hits, misses) in cache_stats.items():
+        out['caches'][name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+        }
+    return out
+
+
+def summary(scope):
+    '''
+    scope里各算子的汇总表，按总耗时从大到小排。后面是所有缓存的命中率。
+    '''
+    stats = get_stats()
+    ops = stats['ops'].get(scope, {})
+    total = sum(s['time'] for s in ops.values())
+    lines = ['Op stats (%s):' % scope,
+             '%-28s %10s %8s %10s %8s %12s' % ('op', 'calls', 'time(s)', 'ms/call', 'ratio', 'KB/call')]
+    for name, s in sorted(ops.items(), key=lambda x: -x[1]['time']):
+        lines.append('%-28s %10d %8.2f %10.3f %7.1f%% %12.1f' % (name, s['calls'], s['time'], s['ms_per_call'],
+                                                                100.0 * s['time'] / max(total, 1e-9), s['kb_per_call']))
+    for name, s in sorted(stats['caches'].items()):
+        lines.append('cache %-22s hits %d, misses %d, hit rate %.1f%%' % (name, s['hits'], s['misses'], 100.0 * s['hit_rate']))
+    return '\n'.join(lines)
+
+
+def dump_json(path):
+    with open(path, 'w') as f:
+        json.dump(get_stats(), f, indent=2)
+
+
+def report(step, scope, force=False):
+    '''
+    读数据的循环每一步调用。每隔print_iter步（或force=True时）打印scope的汇总，并写json。
+    '''
+    if not _enabled:
+        return
+    if not force and (_print_iter <= 0 or step % _print_iter != 0):
+        return
+    logger.info(summary(scope))
+    if _json_path is not None:
+        dump_json(_json_path)
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 打包的数据集。图片文件原样（jpg字节）顺序写进少数几个大的分片文件，清洗过的注解和索引写进index.json。
+#                 训练时不用打开成千上万个小文件，也不用pycocotools解析完整的注解json。
+#
+# ================================================================
+import os
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+INDEX_NAME = 'index.json'
+
+
+def pack_dataset(records, pack_dir, shard_size=1024 ** 3):
+    '''
+    打包。records是data_clean()的结果，其中gt_class是COCO的category_id（data_clean时用恒等的catid2clsid）。
+    :param shard_size: 每个分片文件的大致字节数
+    '''
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    shards = []
+    images = []
+    f = None
+    offset = 0
+    for k, rec in enumerate(records):
+        if f is None or offset >= shard_size:
+            if f is not None:
+                f.close()
+            shards.append('shard-%05d.bin' % len(shards))
+            f = open(os.path.join(pack_dir, shards[-1]), 'wb')
+            offset = 0
+        with open(rec['im_file'], 'rb') as im_f:
+            data = im_f.read()
+        f.write(data)
+        images.append({
+            'im_file': rec['im_file'],
+            'im_id': int(rec['im_id'][0]),
+            'h': rec['h'],
+            'w': rec['w'],
+            'shard': len(shards) - 1,
+            'offset': offset,
+            'length': len(data),
+            'gt_bbox': rec['gt_bbox'].tolist(),
+            'category_id': rec['gt_class'][:, 0].tolist(),
+            'is_crowd': rec['is_crowd'][:, 0].tolist(),
+            'anno_id': rec['anno_id'],
+        })
+        offset += len(data)
+        if (k + 1) % 5000 == 0:
+            logger.info('Packed {}/{} images into {} shards.'.format(k + 1, len(records), len(shards)))
+    if f is not None:
+        f.close()
+    index = {
+        'shards': shards,
+        'images': images,
+    }
+    with open(os.path.join(pack_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    logger.info('Packed {} images into {} shards in {}.'.format(len(images), len(shards), pack_dir))
+
+
+class PackedDataset(object):
+    """
+    读取pack_dataset()打包的数据集。
+    - records()给出和data_clean()格式相同的注解，图片的字节由read_image()从分片里读。
+    - shuffled_indexes()先洗乱分片的顺序，再在缓冲区里洗乱，读分片基本是顺序读。
+    分片文件在第一次读的时候才打开，fork出来的每个读数据的进程各自打开。
+    Args:
+        pack_dir (str): pack_dataset()生成的目录
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.images = index['images']
+        # 每个分片的图片在records里的下标
+        self.shard_indexes = [[] for _ in self.shards]
+        for i, img in enumerate(self.images):
+            self.shard_indexes[img['shard']].append(i)
+        self.files = {}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getstate__(self):
+        # 传给别的进程时不带上打开的文件
+        state = self.__dict__.copy()
+        state['files'] = {}
+        return state
+
+    def records(self, catid2clsid):
+        records = []
+        for img in self.images:
+            num_bbox = len(img['gt_bbox'])
+            gt_class = np.array([[catid2clsid[catid]] for catid in img['category_id']], dtype=np.int32).reshape((num_bbox, 1))
+            coco_rec = {
+                'im_file': img['im_file'],
+                'im_id': np.array([img['im_id']]),
+                'h': img['h'],
+                'w': img['w'],
+                'is_crowd': np.array(img['is_crowd'], dtype=np.int32).reshape((num_bbox, 1)),
+                'gt_class': gt_class,
+                'anno_id': img['anno_id'],
+                'gt_bbox': np.array(img['gt_bbox'], dtype=np.float32).reshape((num_bbox, 4)),
+                'gt_score': np.ones((num_bbox, 1), dtype=np.float32),
+                'gt_poly': [],   # 打包时不保存分割标注
+            }
+            records.append(coco_rec)
+        logger.info('{} samples in packed train set.'.format(len(records)))
+        return records
+
+    def read_image(self, i):
+        '''
+        :return: 第i张图片文件的字节，给DecodeImage解码
+        '''
+        img = self.images[i]
+        shard = img['shard']
+        if shard not in self.files:
+            self.files[shard] = open(os.path.join(self.pack_dir, self.shards[shard]), 'rb')
+        f = self.files[shard]
+        f.seek(img['offset'])
+        return f.read(img['length'])
+
+    def shuffled_indexes(self, buffer_size, rng=np.random):
+        '''
+        一个epoch的顺序。分片的顺序洗乱，按顺序把分片里的图片放进容量为buffer_size的缓冲区，每次从缓冲区里随机取一张。
+        rng是随机数生成器（np.random.RandomState），默认用全局的。
+        '''
+        indexes = []
+        buffer = []
+        for shard in rng.permutation(len(self.shards)):
+            for i in self.shard_indexes[shard]:
+                buffer.append(i)
+                if len(buffer) >= buffer_size:
+                    j = rng.randint(0, len(buffer))
+                    buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                    indexes.append(buffer.pop())
+        rng.shuffle(buffer)
+        indexes += buffer
+        return indexes
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 预读队列。读数据的线程往有界阻塞队列里放批，训练/验证的主循环从里面取。
+#
+# ================================================================
+import sys
+import threading
+import queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _End(object):
+    pass
+
+
+class _Error(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class PrefetchQueue(object):
+    """
+    在后台线程里跑生成器producer(*args)，把产生的元素放进容量为depth的阻塞队列。
+    - 队列满时读数据的线程阻塞（每0.1秒检查一次是否已经close()），队列空时主循环阻塞。
+    - 读数据的线程抛出的异常会在get()里重新抛出。
+    - 生成器结束后get()抛出StopIteration，所以可以直接 for item in prefetch_queue。
+    Args:
+        producer (function): 生成器函数
+        args (tuple): producer的参数
+        depth (int): 队列容量，即最多预读多少个元素
+    """
+
+    def __init__(self, producer, args=(), depth=2, name='prefetch'):
+        assert depth > 0, "depth should be positive."
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.finished = False
+        # 统计
+        self.num_get = 0
+        self.occupancy_sum = 0   # 每次get()之前队列里的元素数之和
+        self.empty_waits = 0     # 主循环等数据的次数
+        self.full_waits = 0      # 读数据的线程等主循环的次数
+        self.thread = threading.Thread(target=self._run, args=(producer, args), name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.full_waits += 1   # 每个被阻塞的元素只记一次，不管等了多久
+        # 阻塞期间每0.1秒检查一次是否已经close()
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, producer, args):
+        try:
+            for item in producer(*args):
+                if not self._put(item):
+                    return
+            self._put(_End())
+        except BaseException:
+            self._put(_Error(sys.exc_info()))
+
+    def get(self):
+        if self.finished:
+            raise StopIteration
+        occupancy = self.queue.qsize()
+        if occupancy == 0:
+            self.empty_waits += 1
+        item = self.queue.get()
+        if isinstance(item, _End):
+            self.finished = True
+            raise StopIteration
+        if isinstance(item, _Error):
+            self.finished = True
+            exc_type, exc_value, exc_tb = item.exc_info
+            raise exc_value.with_traceback(exc_tb)
+        self.num_get += 1
+        self.occupancy_sum += occupancy
+        return item
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def stats(self):
+        mean_occupancy = self.occupancy_sum / self.num_get if self.num_get > 0 else 0.0
+        return {
+            'depth': self.depth,
+            'num_get': self.num_get,
+            'mean_occupancy': mean_occupancy,
+            'empty_waits': self.empty_waits,
+            'full_waits': self.full_waits,
+        }
+
+    def close(self):
+        '''
+        停止读数据的线程。队列里还没取走的元素被丢弃。
+        '''
+        self.stop_event.set()
+        self.finished = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+
+
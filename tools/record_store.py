@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# coding=utf-8
+# ================================================================
+#
+#   Author      : miemie2013
+#   Created date: 2020-08-21 19:33:37
+#   Description : 列式存储的训练集注解。所有图片的gt放在几个连续的大数组里，用偏移量切分，
+#                 取样本时给出数组的只读视图，不用copy.deepcopy整条注解。
+#                 大数组只有几个对象，fork出来的读数据的进程读它们不会触发写时复制。
+#
+# ================================================================
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def records_to_arrays(records):
+    '''
+    data_clean()的结果变成扁平的数组。第i张图片的gt是gt_bbox[offsets[i]:offsets[i+1]]。不保存分割标注gt_poly。
+    '''
+    num_bboxes = [len(rec['gt_bbox']) for rec in records]
+    offsets = np.zeros((len(records) + 1, ), dtype=np.int64)
+    offsets[1:] = np.cumsum(num_bboxes)
+    arrays = {
+        'offsets': offsets,
+        'im_file': np.array([rec['im_file'] for rec in records]),
+        'im_id': np.array([rec['im_id'][0] for rec in records], dtype=np.int64),
+        'h': np.array([rec['h'] for rec in records], dtype=np.float64),
+        'w': np.array([rec['w'] for rec in records], dtype=np.float64),
+        'gt_bbox': np.concatenate([rec['gt_bbox'] for rec in records] + [np.zeros((0, 4), np.float32)], 0),
+        'gt_class': np.concatenate([rec['gt_class'][:, 0] for rec in records] + [np.zeros((0, ), np.int32)], 0),
+        'is_crowd': np.concatenate([rec['is_crowd'][:, 0] for rec in records] + [np.zeros((0, ), np.int32)], 0),
+        'anno_id': np.array([anno_id for rec in records for anno_id in rec['anno_id']], dtype=np.int64),
+    }
+    return arrays
+
+
+class RecordStore(object):
+    """
+    列式存储的训练集注解，可以代替data_clean()给出的records（list）。
+    - store[i]给出第i张图片的样本dict，gt_bbox、gt_class等是大数组的只读视图。数据增强不能原地修改它们。
+    - 分割标注只有with_poly=True时才在第一次用到时从注解json里读。
+    Args:
+        arrays (dict): records_to_arrays()的结果
+        anno_path (str): 注解json文件，读分割标注用
+        with_poly (bool): 样本里是否带分割标注gt_poly
+    """
+
+    def __init__(self, arrays, anno_path=None, with_poly=False):
+        self.offsets = arrays['offsets']
+        self.im_file = arrays['im_file']
+        self.im_id = arrays['im_id']
+        self.h = arrays['h']
+        self.w = arrays['w']
+        self.gt_bbox = arrays['gt_bbox']
+        self.gt_class = arrays['gt_class'].reshape((-1, 1))
+        self.is_crowd = arrays['is_crowd'].reshape((-1, 1))
+        self.anno_id = arrays['anno_id']
+        self.gt_score = np.ones((len(self.gt_bbox), 1), dtype=np.float32)   # 得分的标注都是1
+        for array in [self.offsets, self.im_id, self.h, self.w, self.gt_bbox, self.gt_class,
+                      self.is_crowd, self.anno_id, self.gt_score]:
+            array.flags.writeable = False
+        self.anno_path = anno_path
+        self.with_poly = with_poly
+        self.segmentations = None   # anno_id -> segmentation，第一次用到时才读
+
+    @classmethod
+    def from_records(cls, records, anno_path=None, with_poly=False):
+        return cls(records_to_arrays(records), anno_path=anno_path, with_poly=with_poly)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _load_segmentations(self):
+        assert self.anno_path is not None, "anno_path is needed to load segmentations."
+        with open(self.anno_path, 'r') as f:
+            annotations = json.load(f)['annotations']
+        self.segmentations = {}
+        for anno in annotations:
+            if 'segmentation' in anno:
+                self.segmentations[anno['id']] = anno['segmentation']
+        logger.info('Load segmentations from {}.'.format(self.anno_path))
+
+    def get_poly(self, i):
+        if self.segmentations is None:
+            self._load_segmentations()
+        beg, end = self.offsets[i], self.offsets[i + 1]
+        return [self.segmentations.get(anno_id) for anno_id in self.anno_id[beg:end]]
+
+    def __getitem__(self, i):
+        '''
+        :return: 和data_clean()的一条注解格式相同的dict，每次都是新dict，数组是只读视图。
+        '''
+        beg, end = self.offsets[i], self.offsets[i + 1]
+        sample = {
+            'im_file': str(self.im_file[i]),
+            'im_id': self.im_id[i:i + 1],
+            'h': float(self.h[i]),
+            'w': float(self.w[i]),
+            'is_crowd': self.is_crowd[beg:end],
+            'gt_class': self.gt_class[beg:end],
+            'anno_id': self.anno_id[beg:end],
+            'gt_bbox': self.gt_bbox[beg:end],
+            'gt_score': self.gt_score[beg:end],
+            'gt_poly': self.get_poly(i) if self.with_poly else [],
+        }
+        return sample
@@ -9,11 +9,18 @@
 #
 # ================================================================
 import cv2
+import time
 import uuid
 import random
+import functools
+import threading
 import numpy as np
 from PIL import Image, ImageEnhance, ImageDraw
 
+from tools.image_cache import ImageCache, rescale_gt_bbox, shrink_size
+from tools import op_stats
+from tools.lru_cache import LRUCache
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -39,7 +46,35 @@ def is_poly(segm):
 
 
 
+# 当前线程里正在执行的算子层数。算子里调用别的算子（比如DecodeImage解码mixup的图片）时只统计最外层。
+_op_local = threading.local()
+
+
+def _timed(call):
+    @functools.wraps(call)
+    def wrapper(self, *args, **kwargs):
+        if not op_stats.is_enabled() or getattr(_op_local, 'depth', 0) > 0:
+            return call(self, *args, **kwargs)
+        _op_local.depth = 1
+        start = time.perf_counter()
+        try:
+            out = call(self, *args, **kwargs)
+        finally:
+            _op_local.depth = 0
+        op_stats.record(self.stats_scope, self.__class__.__name__, time.perf_counter() - start, op_stats.output_nbytes(out))
+        return out
+    return wrapper
+
+
 class BaseOperator(object):
+    stats_scope = 'train'   # 耗时统计时归到哪一组。model/decode_np.py里验证、测试用的算子改成'eval'、'test'
+
+    def __init_subclass__(cls, **kwargs):
+        # 子类自己定义的__call__都包一层耗时统计（op_stats.configure(enable=True)之后才生效）
+        super().__init_subclass__(**kwargs)
+        if '__call__' in cls.__dict__:
+            cls.__call__ = _timed(cls.__call__)
+
     def __init__(self, name=None):
         if name is None:
             name = self.__class__.__name__
@@ -59,36 +94,131 @@ class BaseOperator(object):
         return str(self._id)
 
 
+# 按1/2、1/4、1/8分辨率解码。jpg在解码时直接缩小（libjpeg的DCT缩放），又快又省内存。
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
 class DecodeImage(BaseOperator):
-    def __init__(self, to_rgb=True, with_mixup=False, with_cutmix=False):
+    def __init__(self, to_rgb=True, with_mixup=False, with_cutmix=False, image_cache=None,
+                 reduced_decode=False, target_size=0, max_size=0):
         """ Transform the image data to numpy format.
         Args:
             to_rgb (bool): whether to convert BGR to RGB
             with_mixup (bool): whether or not to mixup image and gt_bbbox/gt_score
             with_cutmix (bool): whether or not to cutmix image and gt_bbbox/gt_score
+            image_cache (str): 解码后图片的缓存目录（tools/image_cache.py），None表示不用缓存
+            reduced_decode (bool): 之后ResizeImage会缩小很多时，直接按1/2、1/4、1/8分辨率解码，gt坐标、高宽跟着缩放
+            target_size (int|list): ResizeImage的target_size。sample['target_size']优先，list时取最大的尺度
+            max_size (int): ResizeImage的max_size
         """
 
         super(DecodeImage, self).__init__()
         self.to_rgb = to_rgb
         self.with_mixup = with_mixup
         self.with_cutmix = with_cutmix
+        self.image_cache = None
+        if image_cache is not None:
+            self.image_cache = ImageCache(image_cache)
+        self.reduced_decode = reduced_decode
+        self.target_size = target_size
+        self.max_size = max_size
         if not isinstance(self.to_rgb, bool):
             raise TypeError("{}: input type is invalid.".format(self))
         if not isinstance(self.with_mixup, bool):
             raise TypeError("{}: input type is invalid.".format(self))
 
-    def __call__(self, sample, context=None):
+    def _load_from_cache(self, sample):
+        cached = self.image_cache.get(sample['im_file'])
+        if cached is None:
+            return None
+        im, orig_h, orig_w = cached   # 只读的视图，后面的数据增强都不原地修改图片
+        if self.image_cache.to_rgb != self.to_rgb:
+            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB if self.to_rgb else cv2.COLOR_RGB2BGR)
+        h, w = im.shape[:2]
+        if (h, w) != (orig_h, orig_w):
+            # 缓存里的图片被预先缩小过，gt坐标、高宽也跟着缩放
+            if 'gt_bbox' in sample:
+                sample['gt_bbox'] = rescale_gt_bbox(sample['gt_bbox'], orig_h, orig_w, h, w)
+            sample['h'] = h
+            sample['w'] = w
+        return im
+
+    def _reduce_factor(self, sample):
+        '''
+        按注解里的高宽算出能用的最大缩小倍数：缩小后的图片仍然不小于ResizeImage缩放后的尺寸，最后一步缩放总是缩小。
+        mixup的两张图片按拼接后的画布算，两张图片用同一个倍数。
+        '''
+        if not self.reduced_decode or not sample.get('h') or not sample.get('w'):
+            return 1
+        h, w = sample['h'], sample['w']
+        if self.with_mixup and 'mixup' in sample:
+            if not sample['mixup'].get('h') or not sample['mixup'].get('w'):
+                return 1
+            h = max(h, sample['mixup']['h'])
+            w = max(w, sample['mixup']['w'])
+        target_size = sample.get('target_size', self.target_size)
+        min_h, min_w = shrink_size(h, w, target_size, self.max_size)
+        factor = 1
+        for f in [2, 4, 8]:
+            if np.ceil(h / f) >= min_h and np.ceil(w / f) >= min_w:
+                factor = f
+        return factor
+
+    def _match_mixup_scale(self, sample, orig_hw, mix_orig_hw):
+        '''
+        用缓存时，mixup的两张图片可能各自被预先缩小了不同的倍数（1_build_image_cache.py按每张图片自己的高宽缩小）。
+        把缩小得少的那张再缩小到和另一张相同的倍数，两张图片的物体保持原图里的相对大小，和不用缓存时一样。
+        两张图片都不小于各自预先缩小的下限，拼接后的画布也不小于ResizeImage缩放后的尺寸，最后一步缩放仍然是缩小。
+        :param orig_hw mix_orig_hw: 解码前注解里的高宽
+        '''
+        if not all(orig_hw) or not all(mix_orig_hw):
+            return
+        mix = sample['mixup']
+        scale_h = min(sample['h'] / orig_hw[0], mix['h'] / mix_orig_hw[0])
+        scale_w = min(sample['w'] / orig_hw[1], mix['w'] / mix_orig_hw[1])
+        for s, (orig_h, orig_w) in [(sample, orig_hw), (mix, mix_orig_hw)]:
+            h = int(np.round(orig_h * scale_h))
+            w = int(np.round(orig_w * scale_w))
+            if abs(h - s['h']) <= 1 and abs(w - s['w']) <= 1:   # 取整的误差，不用再缩放
+                continue
+            s['image'] = cv2.resize(s['image'], (w, h), interpolation=cv2.INTER_AREA)
+            if 'gt_bbox' in s:
+                s['gt_bbox'] = rescale_gt_bbox(s['gt_bbox'], s['h'], s['w'], h, w)
+            s['h'] = h
+            s['w'] = w
+            s['im_info'] = np.array([h, w, 1.], dtype=np.float32)
+
+    def __call__(self, sample, context=None, reduce_factor=None):
         """ load image if 'im_file' field is not empty but 'image' is"""
-        if 'image' not in sample:
-            with open(sample['im_file'], 'rb') as f:
-                sample['image'] = f.read()
-
-        im = sample['image']
-        data = np.frombuffer(im, dtype='uint8')
-        im = cv2.imdecode(data, 1)  # BGR mode, but need RGB mode
+        orig_hw = (sample.get('h'), sample.get('w'))   # 注解里的高宽
+        if reduce_factor is None:
+            reduce_factor = self._reduce_factor(sample)
+        im = None
+        if self.image_cache is not None:   # 缓存优先，即使已经有图片文件的字节
+            im = self._load_from_cache(sample)
+        if im is None:
+            if 'image' not in sample:
+                with open(sample['im_file'], 'rb') as f:
+                    sample['image'] = f.read()
 
-        if self.to_rgb:
-            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+            im = sample['image']
+            data = np.frombuffer(im, dtype='uint8')
+            im = cv2.imdecode(data, REDUCED_DECODE_FLAGS[reduce_factor])  # BGR mode, but need RGB mode
+
+            if self.to_rgb:
+                im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+            if reduce_factor > 1:
+                # 缩小解码，gt坐标、高宽也跟着缩放。gt是按注解里的高宽标的
+                h, w = im.shape[:2]
+                if 'gt_bbox' in sample:
+                    sample['gt_bbox'] = rescale_gt_bbox(sample['gt_bbox'], sample['h'], sample['w'], h, w)
+                sample['h'] = h
+                sample['w'] = w
         sample['image'] = im
 
         if 'h' not in sample:
@@ -114,7 +244,10 @@ class DecodeImage(BaseOperator):
 
         # decode mixup image
         if self.with_mixup and 'mixup' in sample:
-            self.__call__(sample['mixup'], context)
+            mix_orig_hw = (sample['mixup'].get('h'), sample['mixup'].get('w'))
+            self.__call__(sample['mixup'], context, reduce_factor)
+            if self.image_cache is not None:
+                self._match_mixup_scale(sample, orig_hw, mix_orig_hw)
 
         # decode cutmix image
         if self.with_cutmix and 'cutmix' in sample:
@@ -213,50 +346,126 @@ class PhotometricDistort(BaseOperator):
     def __init__(self):
         super(PhotometricDistort, self).__init__()
 
-    def __call__(self, sample, context=None):
-        im = sample['image']
-
-        image = im.astype(np.float32)
-
+    def _random_params(self):
+        '''
+        抽取这一次颜色扭曲的随机参数。None表示这一项不做。PhotometricDistortLUT用同样的抽取顺序。
+        '''
+        params = {}
         # RandomBrightness
+        params['brightness'] = None
         if np.random.randint(2):
             delta = 32
-            delta = np.random.uniform(-delta, delta)
-            image += delta
+            params['brightness'] = np.random.uniform(-delta, delta)
 
+        # state == 0 时在颜色空间转换之前调整对比度，state == 1 时在之后
+        params['contrast_first'] = None
+        params['contrast_last'] = None
         state = np.random.randint(2)
         if state == 0:
             if np.random.randint(2):
                 lower = 0.5
                 upper = 1.5
-                alpha = np.random.uniform(lower, upper)
-                image *= alpha
+                params['contrast_first'] = np.random.uniform(lower, upper)
 
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        params['saturation'] = None
         if np.random.randint(2):
             lower = 0.5
             upper = 1.5
-            image[:, :, 1] *= np.random.uniform(lower, upper)
+            params['saturation'] = np.random.uniform(lower, upper)
 
+        params['hue'] = None
         if np.random.randint(2):
             delta = 18.0
-            image[:, :, 0] += np.random.uniform(-delta, delta)
-            image[:, :, 0][image[:, :, 0] > 360.0] -= 360.0
-            image[:, :, 0][image[:, :, 0] < 0.0] += 360.0
-
-        image = cv2.cvtColor(image, cv2.COLOR_HSV2RGB)
+            params['hue'] = np.random.uniform(-delta, delta)
 
         if state == 1:
             if np.random.randint(2):
                 lower = 0.5
                 upper = 1.5
-                alpha = np.random.uniform(lower, upper)
-                image *= alpha
+                params['contrast_last'] = np.random.uniform(lower, upper)
+        return params
+
+    def __call__(self, sample, context=None):
+        im = sample['image']
+        params = self._random_params()
+
+        image = im.astype(np.float32)
+
+        # RandomBrightness
+        if params['brightness'] is not None:
+            image += params['brightness']
+
+        if params['contrast_first'] is not None:
+            image *= params['contrast_first']
+
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        if params['saturation'] is not None:
+            image[:, :, 1] *= params['saturation']
+
+        if params['hue'] is not None:
+            image[:, :, 0] += params['hue']
+            image[:, :, 0][image[:, :, 0] > 360.0] -= 360.0
+            image[:, :, 0][image[:, :, 0] < 0.0] += 360.0
+
+        image = cv2.cvtColor(image, cv2.COLOR_HSV2RGB)
+
+        if params['contrast_last'] is not None:
+            image *= params['contrast_last']
 
         sample['image'] = image
         return sample
 
 
+class PhotometricDistortLUT(PhotometricDistort):
+    """
+    和PhotometricDistort抽取同样的随机参数，但是全程在uint8上用查找表（cv2.LUT）做：
+    亮度+对比度合成一张表，饱和度、色调在uint8的HSV上各用一张表，没有float32的整图副本。
+    每一步都截断到[0, 255]，所以和PhotometricDistort只是统计上一致，输出是uint8。
+    """
+
+    def __init__(self):
+        super(PhotometricDistortLUT, self).__init__()
+        self.values = np.arange(256, dtype=np.float32)
+        self.identity = np.arange(256, dtype=np.uint8)
+
+    def _lut(self, values):
+        return np.clip(np.round(values), 0, 255).astype(np.uint8)
+
+    def __call__(self, sample, context=None):
+        im = sample['image']
+        params = self._random_params()
+        if im.dtype != np.uint8:
+            im = np.clip(im, 0, 255).astype(np.uint8)
+
+        # 亮度、对比度（颜色空间转换之前的）合成一张表
+        if params['brightness'] is not None or params['contrast_first'] is not None:
+            values = self.values
+            if params['brightness'] is not None:
+                values = values + params['brightness']
+            if params['contrast_first'] is not None:
+                values = values * params['contrast_first']
+            im = cv2.LUT(im, self._lut(values))
+
+        # 饱和度、色调。uint8的HSV里 H在[0, 180)，单位是2度；S在[0, 255]
+        if params['saturation'] is not None or params['hue'] is not None:
+            hsv = cv2.cvtColor(im, cv2.COLOR_RGB2HSV)
+            lut_h = self.identity
+            lut_s = self.identity
+            if params['hue'] is not None:
+                lut_h = (np.round(self.values + params['hue'] / 2.0) % 180).astype(np.uint8)
+            if params['saturation'] is not None:
+                lut_s = self._lut(self.values * params['saturation'])
+            lut = np.stack([lut_h, lut_s, self.identity], axis=1).reshape((256, 1, 3))
+            cv2.LUT(hsv, lut, dst=hsv)
+            im = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+        if params['contrast_last'] is not None:
+            im = cv2.LUT(im, self._lut(self.values * params['contrast_last']))
+
+        sample['image'] = im
+        return sample
+
+
 class RandomCrop(BaseOperator):
     """Random crop image and bboxes.
 
@@ -468,6 +677,7 @@ class RandomFlipImage(BaseOperator):
                     return sample
                 oldx1 = gt_bbox[:, 0].copy()
                 oldx2 = gt_bbox[:, 2].copy()
+                gt_bbox = gt_bbox.copy()   # 新数组，不原地修改注解（可能是RecordStore的只读视图）
                 if self.is_normalized:
                     gt_bbox[:, 0] = 1 - oldx2
                     gt_bbox[:, 2] = 1 - oldx1
@@ -504,7 +714,7 @@ class NormalizeBox(BaseOperator):
         super(NormalizeBox, self).__init__()
 
     def __call__(self, sample, context):
-        gt_bbox = sample['gt_bbox']
+        gt_bbox = sample['gt_bbox'].copy()
         width = sample['w']
         height = sample['h']
         for i in range(gt_bbox.shape[0]):
@@ -525,7 +735,7 @@ class BboxXYXY2XYWH(BaseOperator):
 
     def __call__(self, sample, context=None):
         assert 'gt_bbox' in sample
-        bbox = sample['gt_bbox']
+        bbox = sample['gt_bbox'].copy()
         bbox[:, 2:4] = bbox[:, 2:4] - bbox[:, :2]
         bbox[:, :2] = bbox[:, :2] + bbox[:, 2:4] / 2.
         sample['gt_bbox'] = bbox
@@ -597,7 +807,7 @@ class ResizeImage(BaseOperator):
         Rescale image to the specified target size, and capped at max_size
         if max_size != 0.
         If target_size is list, selected a scale randomly as the specified
-        target size.
+        target size. sample['target_size'], if given, overrides target_size.
         Args:
             target_size (int|list): the target size of image's short side,
                 multi-scale training is adopted when type is list.
@@ -630,7 +840,10 @@ class ResizeImage(BaseOperator):
         im_shape = im.shape
         im_size_min = np.min(im_shape[0:2])
         im_size_max = np.max(im_shape[0:2])
-        if isinstance(self.target_size, list):
+        if 'target_size' in sample:
+            # 读数据时已经给这一批选好了尺度，一批图片用同一个尺度
+            selected_size = sample['target_size']
+        elif isinstance(self.target_size, list):
             # Case for multi-scale training
             selected_size = random.choice(self.target_size)   # 随机选一个尺度
         else:
@@ -807,6 +1020,159 @@ class PadBatchSingle(BaseOperator):
         return sample
 
 
+class NormalizePermutePadBatch(BaseOperator):
+    """
+    NormalizeImage、Permute、PadBatchSingle和最后的np.stack合成一步。
+    输入是ResizeImage缩放过的HWC图片（uint8或float32都可以），逐通道算 像素*scale+bias 直接写进一个预先分配的
+    [N, 3, max_h, max_w] float32数组里对应的位置，填充的部分置0。不再产生归一化、转置、填充、拼接的中间数组。
+    数组循环使用num_buffers个缓冲区：第i批和第i+num_buffers批共用一块内存，所以同时还在用的批数不能超过num_buffers。
+    Args:
+        mean, std, is_scale: 同NormalizeImage。输入是HWC格式，is_channel_first只能是False
+        to_bgr (bool): 同Permute
+        pad_to_stride (int): 同PadBatch
+        use_padded_im_info (bool): 同PadBatchSingle
+        num_buffers (int): 缓冲区个数
+    """
+
+    def __init__(self,
+                 mean=[0.485, 0.456, 0.406],
+                 std=[1, 1, 1],
+                 is_scale=True,
+                 is_channel_first=False,
+                 to_bgr=False,
+                 pad_to_stride=0,
+                 use_padded_im_info=True,
+                 num_buffers=1):
+        super(NormalizePermutePadBatch, self).__init__()
+        if not (isinstance(mean, list) and isinstance(std, list) and isinstance(is_scale, bool)):
+            raise TypeError("{}: input type is invalid.".format(self))
+        if np.prod(std) == 0:
+            raise ValueError('{}: std is invalid!'.format(self))
+        if is_channel_first:
+            raise ValueError('{}: input image should be HWC.'.format(self))
+        assert num_buffers > 0, "num_buffers should be positive."
+        # (x/255 - mean)/std = x * scale + bias
+        mean = np.array(mean, dtype=np.float64)
+        std = np.array(std, dtype=np.float64)
+        scale = 1.0 / std
+        if is_scale:
+            scale = scale / 255.0
+        bias = -mean / std
+        # 输出的第c个通道来自输入的第channels[c]个通道
+        self.channels = [2, 1, 0] if to_bgr else [0, 1, 2]
+        self.scale = [np.float32(scale[c]) for c in self.channels]
+        self.bias = [np.float32(bias[c]) for c in self.channels]
+        self.pad_to_stride = pad_to_stride
+        self.use_padded_im_info = use_padded_im_info
+        self.buffers = [None] * num_buffers
+        self.buffer_id = 0
+
+    def __getstate__(self):
+        # 传给别的进程时不带上缓冲区
+        state = self.__dict__.copy()
+        state['buffers'] = [None] * len(self.buffers)
+        return state
+
+    def _get_buffer(self, shape):
+        size = int(np.prod(shape))
+        buffer = self.buffers[self.buffer_id]
+        if buffer is None or buffer.size < size:   # 不够大才重新分配
+            buffer = np.empty((size, ), dtype=np.float32)
+            self.buffers[self.buffer_id] = buffer
+        self.buffer_id = (self.buffer_id + 1) % len(self.buffers)
+        return buffer[:size].reshape(shape)
+
+    def get_max_shape(self, samples):
+        '''
+        :return: max_shape=[3, max_h, max_w]，max_h、max_w增加到最小的能被pad_to_stride整除的数
+        '''
+        max_h = max([s['image'].shape[0] for s in samples])
+        max_w = max([s['image'].shape[1] for s in samples])
+        if self.pad_to_stride > 0:
+            max_h = int(np.ceil(max_h / self.pad_to_stride) * self.pad_to_stride)
+            max_w = int(np.ceil(max_w / self.pad_to_stride) * self.pad_to_stride)
+        return np.array([3, max_h, max_w])
+
+    def __call__(self, samples, context=None):
+        '''
+        :return: batch_images [N, 3, max_h, max_w]。每个sample['image']变成它在batch_images里的视图。
+        '''
+        max_shape = self.get_max_shape(samples)
+        max_h, max_w = max_shape[1], max_shape[2]
+        batch_images = self._get_buffer((len(samples), 3, max_h, max_w))
+        for k, sample in enumerate(samples):
+            im = sample['image']
+            if len(im.shape) != 3:
+                raise ImageError('{}: image is not 3-dimensional.'.format(self))
+            im_h, im_w = im.shape[:2]
+            out = batch_images[k]
+            for c in range(3):
+                dst = out[c, :im_h, :im_w]
+                np.multiply(im[:, :, self.channels[c]], self.scale[c], out=dst, dtype=np.float32)
+                dst += self.bias[c]
+            # 缓冲区是复用的，填充的部分每次都要重新置0
+            out[:, im_h:, :] = 0.0
+            out[:, :im_h, im_w:] = 0.0
+            sample['image'] = out
+            if self.use_padded_im_info:
+                sample['im_info'][:2] = max_shape[1:3]
+        return batch_images
+
+
+class ScaleGtBboxSingle(BaseOperator):
+    """
+    一张图片的gt坐标变成缩放后图片中对应物体的坐标，缩放方式和Gt2FCOSTargetSingle相同。
+    在模型所在的设备上计算target（model/fcos_target.py）时，代替Gt2FCOSTargetSingle作为最后一个batch_transform。
+    """
+
+    def __init__(self):
+        super(ScaleGtBboxSingle, self).__init__()
+
+    def __call__(self, sample, context=None):
+        im_info = sample['im_info']
+        bboxes = sample['gt_bbox'].astype(np.float32)   # 新建数组，不修改原来的gt_bbox
+        # bboxes的横坐标变成缩放后图片中对应物体的横坐标
+        bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * np.floor(im_info[1]) / \
+            np.floor(im_info[1] / im_info[2])
+        # bboxes的纵坐标变成缩放后图片中对应物体的纵坐标
+        bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * np.floor(im_info[0]) / \
+            np.floor(im_info[0] / im_info[2])
+        sample['gt_bbox'] = bboxes
+        return sample
+
+
+# 对齐后的尺寸种类不多（多尺度的尺度数 x 宽高比），格子中心点坐标等缓存起来各批复用
+_points_cache = LRUCache('fcos_points', capacity=64)
+
+
+def compute_fcos_points(w, h, downsample_ratios, object_sizes_of_interest):
+    """
+    对齐后高宽为(h, w)的图片上，各感受野所有格子的中心点坐标。只读，被缓存共用。
+    :return: points [所有格子数, 2]，num_points_each_level，每个格子的stride [所有格子数, ]，
+             每个格子负责的回归值区间object_scale_exp [所有格子数, 2]
+    """
+    locations = []
+    # 从小感受野stride=8遍历到大感受野stride=128。location.shape=[格子行数*格子列数, 2]，存放的是每个格子的中心点的坐标。格子顺序是第一行从左到右，第二行从左到右，...
+    for stride in downsample_ratios:
+        shift_x = np.arange(0, w, stride).astype(np.float32)
+        shift_y = np.arange(0, h, stride).astype(np.float32)
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shift_x = shift_x.flatten()
+        shift_y = shift_y.flatten()
+        location = np.stack([shift_x, shift_y], axis=1) + stride // 2
+        locations.append(location)
+    num_points_each_level = [len(location) for location in locations]   # num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
+    locations = np.concatenate(locations, axis=0)
+    strides = np.concatenate([np.full((num_pts, ), stride, dtype=np.float32)
+                              for num_pts, stride in zip(num_points_each_level, downsample_ratios)])
+    # 边界object_sizes_of_interest[i] 重复 num_pts=格子数 次
+    object_scale_exp = np.concatenate([np.tile(np.array([object_sizes_of_interest[i]]), reps=[num_pts, 1])
+                                       for i, num_pts in enumerate(num_points_each_level)], axis=0)
+    for arr in [locations, strides, object_scale_exp]:
+        arr.setflags(write=False)
+    return locations, num_points_each_level, strides, object_scale_exp
+
+
 class Gt2FCOSTarget(BaseOperator):
     """
     Generate FCOS targets by groud truth data
@@ -835,21 +1201,10 @@ class Gt2FCOSTarget(BaseOperator):
         compute the corresponding points in each feature map
         :param h: image height
         :param w: image width
-        :return: points from all feature map
+        :return: points from all feature map, num_points_each_level, 每个格子的stride [所有格子数, ]，每个格子的回归值区间 [所有格子数, 2]
         """
-        locations = []
-        # 从小感受野stride=8遍历到大感受野stride=128。location.shape=[格子行数*格子列数, 2]，存放的是每个格子的中心点的坐标。格子顺序是第一行从左到右，第二行从左到右，...
-        for stride in self.downsample_ratios:
-            shift_x = np.arange(0, w, stride).astype(np.float32)
-            shift_y = np.arange(0, h, stride).astype(np.float32)
-            shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-            shift_x = shift_x.flatten()
-            shift_y = shift_y.flatten()
-            location = np.stack([shift_x, shift_y], axis=1) + stride // 2
-            locations.append(location)
-        num_points_each_level = [len(location) for location in locations]   # num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
-        locations = np.concatenate(locations, axis=0)
-        return locations, num_points_each_level
+        key = (w, h, tuple(self.downsample_ratios), tuple(map(tuple, self.object_sizes_of_interest)))
+        return _points_cache.get(key, lambda: compute_fcos_points(w, h, self.downsample_ratios, self.object_sizes_of_interest))
 
     def _convert_xywh2xyxy(self, gt_bbox, w, h):
         """
@@ -876,7 +1231,7 @@ class Gt2FCOSTarget(BaseOperator):
         :return: the mask of points is within gt_box or not
         """
         bboxes = np.reshape(   # [gt数, 4] -> [1, gt数, 4]
-            gt_bbox, newshape=[1, gt_bbox.shape[0], gt_bbox.shape[1]])
+            gt_bbox, [1, gt_bbox.shape[0], gt_bbox.shape[1]])
         bboxes = np.tile(bboxes, reps=[xs.shape[0], 1, 1])   # [所有格子数, gt数, 4]   gt坐标
         ct_x = (bboxes[:, :, 0] + bboxes[:, :, 2]) / 2       # [所有格子数, gt数]      gt中心点x
         ct_y = (bboxes[:, :, 1] + bboxes[:, :, 3]) / 2       # [所有格子数, gt数]      gt中心点y
@@ -911,7 +1266,7 @@ class Gt2FCOSTarget(BaseOperator):
             # im, gt_bbox, gt_class, gt_score = sample
             im = sample['image']
             im_info = sample['im_info']
-            bboxes = sample['gt_bbox']
+            bboxes = sample['gt_bbox'].copy()
             gt_class = sample['gt_class']
             gt_score = sample['gt_score']
             no_gt = False
@@ -929,21 +1284,16 @@ class Gt2FCOSTarget(BaseOperator):
                 np.floor(im_info[0] / im_info[2])
             # calculate the locations
             h, w = sample['image'].shape[1:3]   # h w是这一批所有图片对齐后的高宽。
-            points, num_points_each_level = self._compute_points(w, h)   # points是所有格子中心点的坐标，num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
-            object_scale_exp = []
-            for i, num_pts in enumerate(num_points_each_level):   # 遍历每个感受野格子数
-                object_scale_exp.append(   # 边界self.object_sizes_of_interest[i] 重复 num_pts=格子数 次
-                    np.tile(
-                        np.array([self.object_sizes_of_interest[i]]),
-                        reps=[num_pts, 1]))
-            object_scale_exp = np.concatenate(object_scale_exp, axis=0)
+            # points是所有格子中心点的坐标，num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]，
+            # object_scale_exp是每个格子负责的回归值区间
+            points, num_points_each_level, _, object_scale_exp = self._compute_points(w, h)
 
             gt_area = (bboxes[:, 2] - bboxes[:, 0]) * (      # [gt数, ]   所有gt的面积
                 bboxes[:, 3] - bboxes[:, 1])
             xs, ys = points[:, 0], points[:, 1]   # 所有格子中心点的横坐标、纵坐标
-            xs = np.reshape(xs, newshape=[xs.shape[0], 1])   # [所有格子数, 1]
+            xs = np.reshape(xs, [xs.shape[0], 1])   # [所有格子数, 1]
             xs = np.tile(xs, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的横坐标重复 gt数 次
-            ys = np.reshape(ys, newshape=[ys.shape[0], 1])   # [所有格子数, 1]
+            ys = np.reshape(ys, [ys.shape[0], 1])   # [所有格子数, 1]
             ys = np.tile(ys, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的纵坐标重复 gt数 次
 
             l_res = xs - bboxes[:, 0]   # [所有格子数, gt数] - [gt数, ] = [所有格子数, gt数]     结果是所有格子中心点的横坐标 分别减去 所有gt左上角的横坐标，即所有格子需要学习 gt数 个l
@@ -994,7 +1344,7 @@ class Gt2FCOSTarget(BaseOperator):
                                   (reg_targets[:, [1, 3]].min(axis=1) / \
                                    reg_targets[:, [1, 3]].max(axis=1))).astype(np.float32)   # [所有格子数, ]  所有格子需要学习的centerness
             ctn_targets = np.reshape(
-                ctn_targets, newshape=[ctn_targets.shape[0], 1])   # [所有格子数, 1]  所有格子需要学习的centerness
+                ctn_targets, [ctn_targets.shape[0], 1])   # [所有格子数, 1]  所有格子需要学习的centerness
             ctn_targets[labels <= 0] = 0   # 负样本需要学习的centerness置为0
             pos_ind = np.nonzero(labels != 0)   # tuple=( ndarray(shape=[正样本数, ]), ndarray(shape=[正样本数, ]) )   即正样本在labels中的下标，因为labels是2维的，所以一个正样本有2个下标。
             reg_targets_pos = reg_targets[pos_ind[0], :]    # [正样本数, 4]   正样本格子需要学习 的 lrtb
@@ -1019,15 +1369,15 @@ class Gt2FCOSTarget(BaseOperator):
                         np.reshape(
                             reg_targets_by_level[lvl] / \
                             self.downsample_ratios[lvl],      # 归一化方式是除以格子边长（即下采样倍率）
-                            newshape=[grid_h, grid_w, 4])     # reshape成[grid_h, grid_w, 4]
+                            [grid_h, grid_w, 4])     # reshape成[grid_h, grid_w, 4]
                 else:
                     sample['reg_target{}'.format(lvl)] = np.reshape(
                         reg_targets_by_level[lvl],
-                        newshape=[grid_h, grid_w, 4])
+                        [grid_h, grid_w, 4])
                 sample['labels{}'.format(lvl)] = np.reshape(
-                    labels_by_level[lvl], newshape=[grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+                    labels_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
                 sample['centerness{}'.format(lvl)] = np.reshape(
-                    ctn_targets_by_level[lvl], newshape=[grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+                    ctn_targets_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
         return samples
 
 
@@ -1035,13 +1385,17 @@ class Gt2FCOSTarget(BaseOperator):
 class Gt2FCOSTargetSingle(BaseOperator):
     """
     一张图片的Gt2FCOSTarget
+    sparse=True时只保存正样本：labels{i}是int16的[grid_h, grid_w, 1]；pos_ind是正样本在这张图片所有格子（按感受野拼接）里的下标，
+    pos_reg、pos_ctn是它们的lrtb、centerness。不再给出几乎全是0的稠密reg_target{i}、centerness{i}。
     """
 
     def __init__(self,
                  object_sizes_boundary,
                  center_sampling_radius,
                  downsample_ratios,
-                 norm_reg_targets=False):
+                 norm_reg_targets=False,
+                 gt_chunk_size=16,
+                 sparse=False):
         super(Gt2FCOSTargetSingle, self).__init__()
         self.center_sampling_radius = center_sampling_radius
         self.downsample_ratios = downsample_ratios
@@ -1054,27 +1408,18 @@ class Gt2FCOSTargetSingle(BaseOperator):
             ])
         self.object_sizes_of_interest = object_sizes_of_interest
         self.norm_reg_targets = norm_reg_targets
+        self.gt_chunk_size = gt_chunk_size   # gt很多时分块处理，每块最多gt_chunk_size个gt，中间数组最大是[所有格子数, gt_chunk_size]
+        self.sparse = sparse
 
     def _compute_points(self, w, h):
         """
         compute the corresponding points in each feature map
         :param h: image height
         :param w: image width
-        :return: points from all feature map
+        :return: points from all feature map, num_points_each_level, 每个格子的stride [所有格子数, ]，每个格子的回归值区间 [所有格子数, 2]
         """
-        locations = []
-        # 从小感受野stride=8遍历到大感受野stride=128。location.shape=[格子行数*格子列数, 2]，存放的是每个格子的中心点的坐标。格子顺序是第一行从左到右，第二行从左到右，...
-        for stride in self.downsample_ratios:
-            shift_x = np.arange(0, w, stride).astype(np.float32)
-            shift_y = np.arange(0, h, stride).astype(np.float32)
-            shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-            shift_x = shift_x.flatten()
-            shift_y = shift_y.flatten()
-            location = np.stack([shift_x, shift_y], axis=1) + stride // 2
-            locations.append(location)
-        num_points_each_level = [len(location) for location in locations]   # num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
-        locations = np.concatenate(locations, axis=0)
-        return locations, num_points_each_level
+        key = (w, h, tuple(self.downsample_ratios), tuple(map(tuple, self.object_sizes_of_interest)))
+        return _points_cache.get(key, lambda: compute_fcos_points(w, h, self.downsample_ratios, self.object_sizes_of_interest))
 
     def _convert_xywh2xyxy(self, gt_bbox, w, h):
         """
@@ -1095,39 +1440,68 @@ class Gt2FCOSTargetSingle(BaseOperator):
                                     num_points_each_level):
         """
         check if points is within the clipped boxes
-        :param gt_bbox: bounding boxes
-        :param xs: horizontal coordinate of points
-        :param ys: vertical coordinate of points
-        :return: the mask of points is within gt_box or not
+        :param gt_bbox: bounding boxes, [gt数, 4]
+        :param xs: horizontal coordinate of points, [所有格子数, 1]
+        :param ys: vertical coordinate of points, [所有格子数, 1]
+        :return: the mask of points is within gt_box or not, [所有格子数, gt数]
         """
-        bboxes = np.reshape(   # [gt数, 4] -> [1, gt数, 4]
-            gt_bbox, newshape=[1, gt_bbox.shape[0], gt_bbox.shape[1]])
-        bboxes = np.tile(bboxes, reps=[xs.shape[0], 1, 1])   # [所有格子数, gt数, 4]   gt坐标
-        ct_x = (bboxes[:, :, 0] + bboxes[:, :, 2]) / 2       # [所有格子数, gt数]      gt中心点x
-        ct_y = (bboxes[:, :, 1] + bboxes[:, :, 3]) / 2       # [所有格子数, gt数]      gt中心点y
+        ct_x = (gt_bbox[:, 0] + gt_bbox[:, 2]) / 2       # [gt数, ]      gt中心点x
+        ct_y = (gt_bbox[:, 1] + gt_bbox[:, 3]) / 2       # [gt数, ]      gt中心点y
+        inside_gt_box = np.zeros((xs.shape[0], gt_bbox.shape[0]), dtype=np.bool_)
         beg = 0   # 开始=0
-        clipped_box = bboxes.copy()   # [所有格子数, gt数, 4]   gt坐标，限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
         for lvl, stride in enumerate(self.downsample_ratios):   # 遍历每个感受野，从 stride=8的感受野 到 stride=128的感受野
             end = beg + num_points_each_level[lvl]   # 结束=开始+这个感受野的格子数
             stride_exp = self.center_sampling_radius * stride   # stride_exp = 1.5 * 这个感受野的stride(的格子边长)
-            clipped_box[beg:end, :, 0] = np.maximum(
-                bboxes[beg:end, :, 0], ct_x[beg:end, :] - stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
-            clipped_box[beg:end, :, 1] = np.maximum(
-                bboxes[beg:end, :, 1], ct_y[beg:end, :] - stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
-            clipped_box[beg:end, :, 2] = np.minimum(
-                bboxes[beg:end, :, 2], ct_x[beg:end, :] + stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
-            clipped_box[beg:end, :, 3] = np.minimum(
-                bboxes[beg:end, :, 3], ct_y[beg:end, :] + stride_exp)   # 限制gt的边长，最大只能是1.5 * 2 = 3个格子边长
+            # [gt数, ]   限制gt的边长，最大只能是1.5 * 2 = 3个格子边长。同一个感受野的格子共用，不需要复制 所有格子数 份。
+            clipped_x1 = np.maximum(gt_bbox[:, 0], ct_x - stride_exp)
+            clipped_y1 = np.maximum(gt_bbox[:, 1], ct_y - stride_exp)
+            clipped_x2 = np.minimum(gt_bbox[:, 2], ct_x + stride_exp)
+            clipped_y2 = np.minimum(gt_bbox[:, 3], ct_y + stride_exp)
+            # 广播成[这个感受野的格子数, gt数]。需要学习的lrtb如果都>0，表示格子被选中。即只选取中心点落在gt内的格子。
+            xs_lvl = xs[beg:end]
+            ys_lvl = ys[beg:end]
+            inside_gt_box[beg:end] = (xs_lvl - clipped_x1 > 0) & (ys_lvl - clipped_y1 > 0) & \
+                                     (clipped_x2 - xs_lvl > 0) & (clipped_y2 - ys_lvl > 0)
             beg = end
-        # xs  [所有格子数, gt数]， 所有格子中心点的横坐标重复 gt数 次
-        l_res = xs - clipped_box[:, :, 0]   # [所有格子数, gt数]  所有格子需要学习 gt数 个l
-        r_res = clipped_box[:, :, 2] - xs   # [所有格子数, gt数]  所有格子需要学习 gt数 个r
-        t_res = ys - clipped_box[:, :, 1]   # [所有格子数, gt数]  所有格子需要学习 gt数 个t
-        b_res = clipped_box[:, :, 3] - ys   # [所有格子数, gt数]  所有格子需要学习 gt数 个b
-        clipped_box_reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)   # [所有格子数, gt数, 4]  所有格子需要学习 gt数 个lrtb
-        inside_gt_box = np.min(clipped_box_reg_targets, axis=2) > 0   # [所有格子数, gt数]  需要学习的lrtb如果都>0，表示格子被选中。即只选取中心点落在gt内的格子。
         return inside_gt_box
 
+    def _match_gt_chunk(self, bboxes, gt_area, xs, ys, num_points_each_level):
+        """
+        一块gt的正负样本判断。所有数组都是广播得到，最大只有[所有格子数, gt数]，不会出现[所有格子数, gt数, 4]。
+        :return: points2gtarea, [所有格子数, gt数]。格子是这个gt的候选正样本时为gt的面积，否则为无穷。
+        """
+        l_res = xs - bboxes[:, 0]   # [所有格子数, 1] - [gt数, ] = [所有格子数, gt数]     结果是所有格子中心点的横坐标 分别减去 所有gt左上角的横坐标，即所有格子需要学习 gt数 个l
+        r_res = bboxes[:, 2] - xs   # 所有格子需要学习 gt数 个r
+        t_res = ys - bboxes[:, 1]   # 所有格子需要学习 gt数 个t
+        b_res = bboxes[:, 3] - ys   # 所有格子需要学习 gt数 个b
+        if self.center_sampling_radius > 0:
+            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内（gt是被限制边长后的gt）。
+            # FCOS首先将gt框内的锚点（格子中心点）视为候选正样本，然后根据为每个金字塔等级定义的比例范围从候选中选择最终的正样本（而且是负责预测gt里面积最小的），最后那些未选择的锚点为负样本。
+            # (1)第1个正负样本判断依据
+            is_inside_box = self._check_inside_boxes_limited(
+                bboxes, xs, ys, num_points_each_level)
+        else:
+            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内。
+            # (1)第1个正负样本判断依据
+            is_inside_box = (l_res > 0) & (t_res > 0) & (r_res > 0) & (b_res > 0)
+        # check if the targets is inside the corresponding level
+        max_reg_targets = np.maximum(np.maximum(l_res, t_res), np.maximum(r_res, b_res))    # [所有格子数, gt数]   所有格子需要学习 gt数 个lrtb   中的最大值
+        # [所有格子数, gt数]   最大回归值如果位于区间内，就为True
+        # (2)第2个正负样本判断依据
+        is_match_current_level = np.zeros(max_reg_targets.shape, dtype=np.bool_)
+        beg = 0
+        for lvl, num_pts in enumerate(num_points_each_level):
+            end = beg + num_pts
+            lower_bound, high_bound = self.object_sizes_of_interest[lvl]
+            is_match_current_level[beg:end] = \
+                (max_reg_targets[beg:end] > lower_bound) & \
+                (max_reg_targets[beg:end] < high_bound)
+            beg = end
+        # 格子中心点落在gt外的（即负样本）、最大回归值位于区间外的（即负样本），需要学习的面积置为无穷。
+        # 这是为了求最小面积时，若某格子有最终正样本，那么就应该不让负样本的面积影响到判断。
+        points2gtarea = np.where(is_inside_box & is_match_current_level, gt_area, self.INF)
+        return points2gtarea
+
     def __call__(self, sample, context=None):
         assert len(self.object_sizes_of_interest) == len(self.downsample_ratios), \
             "object_sizes_of_interest', and 'downsample_ratios' should have same length."
@@ -1135,7 +1509,7 @@ class Gt2FCOSTargetSingle(BaseOperator):
         # im, gt_bbox, gt_class, gt_score = sample
         im = sample['image']
         im_info = sample['im_info']
-        bboxes = sample['gt_bbox']
+        bboxes = sample['gt_bbox'].copy()   # 新数组，下面缩放坐标时不原地修改注解
         gt_class = sample['gt_class']
         gt_score = sample['gt_score']
         no_gt = False
@@ -1144,7 +1518,6 @@ class Gt2FCOSTargetSingle(BaseOperator):
             bboxes = np.array([[0, 0, 100, 100]]).astype(np.float32)
             gt_class = np.array([[0]]).astype(np.int32)
             gt_score = np.array([[1]]).astype(np.float32)
-            # print('nnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnnone')
         # bboxes的横坐标变成缩放后图片中对应物体的横坐标
         bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * np.floor(im_info[1]) / \
             np.floor(im_info[1] / im_info[2])
@@ -1153,75 +1526,48 @@ class Gt2FCOSTargetSingle(BaseOperator):
             np.floor(im_info[0] / im_info[2])
         # calculate the locations
         h, w = sample['image'].shape[1:3]   # h w是这一批所有图片对齐后的高宽。
-        points, num_points_each_level = self._compute_points(w, h)   # points是所有格子中心点的坐标，num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
-        object_scale_exp = []
-        for i, num_pts in enumerate(num_points_each_level):   # 遍历每个感受野格子数
-            object_scale_exp.append(   # 边界self.object_sizes_of_interest[i] 重复 num_pts=格子数 次
-                np.tile(
-                    np.array([self.object_sizes_of_interest[i]]),
-                    reps=[num_pts, 1]))
-        object_scale_exp = np.concatenate(object_scale_exp, axis=0)
+        # points是所有格子中心点的坐标，num_points_each_level=[stride=8感受野格子数, ..., stride=128感受野格子数]
+        points, num_points_each_level, strides, _ = self._compute_points(w, h)
 
         gt_area = (bboxes[:, 2] - bboxes[:, 0]) * (      # [gt数, ]   所有gt的面积
             bboxes[:, 3] - bboxes[:, 1])
-        xs, ys = points[:, 0], points[:, 1]   # 所有格子中心点的横坐标、纵坐标
-        xs = np.reshape(xs, newshape=[xs.shape[0], 1])   # [所有格子数, 1]
-        xs = np.tile(xs, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的横坐标重复 gt数 次
-        ys = np.reshape(ys, newshape=[ys.shape[0], 1])   # [所有格子数, 1]
-        ys = np.tile(ys, reps=[1, bboxes.shape[0]])      # [所有格子数, gt数]， 所有格子中心点的纵坐标重复 gt数 次
-
-        l_res = xs - bboxes[:, 0]   # [所有格子数, gt数] - [gt数, ] = [所有格子数, gt数]     结果是所有格子中心点的横坐标 分别减去 所有gt左上角的横坐标，即所有格子需要学习 gt数 个l
-        r_res = bboxes[:, 2] - xs   # 所有格子需要学习 gt数 个r
-        t_res = ys - bboxes[:, 1]   # 所有格子需要学习 gt数 个t
-        b_res = bboxes[:, 3] - ys   # 所有格子需要学习 gt数 个b
-        reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)   # [所有格子数, gt数, 4]   所有格子需要学习 gt数 个lrtb
-        if self.center_sampling_radius > 0:
-            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内（gt是被限制边长后的gt）。
-            # FCOS首先将gt框内的锚点（格子中心点）视为候选正样本，然后根据为每个金字塔等级定义的比例范围从候选中选择最终的正样本（而且是负责预测gt里面积最小的），最后那些未选择的锚点为负样本。
-            # (1)第1个正负样本判断依据
-            is_inside_box = self._check_inside_boxes_limited(
-                bboxes, xs, ys, num_points_each_level)
-        else:
-            # [所有格子数, gt数]    True表示格子中心点（锚点）落在gt内。
-            # FCOS首先将gt框内的锚点（格子中心点）视为候选正样本，然后根据为每个金字塔等级定义的比例范围从候选中选择最终的正样本（而且是负责预测gt里面积最小的），最后那些未选择的锚点为负样本。
-            # (1)第1个正负样本判断依据
-            is_inside_box = np.min(reg_targets, axis=2) > 0
-        # check if the targets is inside the corresponding level
-        max_reg_targets = np.max(reg_targets, axis=2)    # [所有格子数, gt数]   所有格子需要学习 gt数 个lrtb   中的最大值
-        lower_bound = np.tile(    # [所有格子数, gt数]   下限重复 gt数 次
-            np.expand_dims(
-                object_scale_exp[:, 0], axis=1),
-            reps=[1, max_reg_targets.shape[1]])
-        high_bound = np.tile(     # [所有格子数, gt数]   上限重复 gt数 次
-            np.expand_dims(
-                object_scale_exp[:, 1], axis=1),
-            reps=[1, max_reg_targets.shape[1]])
-
-        # [所有格子数, gt数]   最大回归值如果位于区间内，就为True
-        # (2)第2个正负样本判断依据
-        is_match_current_level = \
-            (max_reg_targets > lower_bound) & \
-            (max_reg_targets < high_bound)
-        # [所有格子数, gt数]   所有gt的面积
-        points2gtarea = np.tile(
-            np.expand_dims(
-                gt_area, axis=0), reps=[xs.shape[0], 1])
-        points2gtarea[is_inside_box == 0] = self.INF            # 格子中心点落在gt外的（即负样本），需要学习的面积置为无穷。     这是为了points2gtarea.min(axis=1)时，若某格子有最终正样本，那么就应该不让负样本的面积影响到判断。
-        points2gtarea[is_match_current_level == 0] = self.INF   # 最大回归值如果位于区间外（即负样本），需要学习的面积置为无穷。 这是为了points2gtarea.min(axis=1)时，若某格子有最终正样本，那么就应该不让负样本的面积影响到判断。
-        points2min_area = points2gtarea.min(axis=1)          # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值
-        points2min_area_ind = points2gtarea.argmin(axis=1)   # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值的下标
+        xs = points[:, 0:1]   # [所有格子数, 1]   所有格子中心点的横坐标。和[gt数, ]的数组运算时广播，不需要复制 gt数 次。
+        ys = points[:, 1:2]   # [所有格子数, 1]   所有格子中心点的纵坐标
+        num_points = points.shape[0]
+        num_gts = bboxes.shape[0]
+
+        # 分块遍历gt，每个格子记录 目前为止 需要学习的面积的最小值、最小值的下标。
+        # 后面的块只有面积严格更小才替换，所以面积相同时和一次性argmin一样取下标最小的gt。
+        points2min_area = None      # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值
+        points2min_area_ind = None  # [所有格子数, ]   所有格子需要学习 gt数 个面积  中的最小值的下标
+        chunk_size = self.gt_chunk_size if self.gt_chunk_size > 0 else num_gts
+        for beg in range(0, num_gts, chunk_size):
+            end = min(beg + chunk_size, num_gts)
+            points2gtarea = self._match_gt_chunk(bboxes[beg:end], gt_area[beg:end], xs, ys, num_points_each_level)
+            chunk_min_area = points2gtarea.min(axis=1)
+            chunk_min_area_ind = points2gtarea.argmin(axis=1) + beg
+            if points2min_area is None:
+                points2min_area = chunk_min_area
+                points2min_area_ind = chunk_min_area_ind
+            else:
+                better = chunk_min_area < points2min_area
+                points2min_area = np.where(better, chunk_min_area, points2min_area)
+                points2min_area_ind = np.where(better, chunk_min_area_ind, points2min_area_ind)
         labels = gt_class[points2min_area_ind] + 1     # [所有格子数, 1]   所有格子需要学习 的类别id，学习的是gt中面积最小值的的类别id
         labels[points2min_area == self.INF] = 0        # [所有格子数, 1]   负样本的points2min_area肯定是self.INF，这里将负样本需要学习 的类别id 置为0
-        reg_targets = reg_targets[range(xs.shape[0]), points2min_area_ind]   # [所有格子数, 4]   所有格子需要学习 的 lrtb（负责预测gt里面积最小的）
+        # [所有格子数, 4]   所有格子需要学习 的 lrtb（负责预测gt里面积最小的）。只对选中的gt计算，不需要先算出[所有格子数, gt数, 4]。
+        matched_bboxes = bboxes[points2min_area_ind]
+        reg_targets = np.stack([xs[:, 0] - matched_bboxes[:, 0],
+                                ys[:, 0] - matched_bboxes[:, 1],
+                                matched_bboxes[:, 2] - xs[:, 0],
+                                matched_bboxes[:, 3] - ys[:, 0]], axis=1)
         ctn_targets = np.sqrt((reg_targets[:, [0, 2]].min(axis=1) / \
                               reg_targets[:, [0, 2]].max(axis=1)) * \
                               (reg_targets[:, [1, 3]].min(axis=1) / \
                                reg_targets[:, [1, 3]].max(axis=1))).astype(np.float32)   # [所有格子数, ]  所有格子需要学习的centerness
         ctn_targets = np.reshape(
-            ctn_targets, newshape=[ctn_targets.shape[0], 1])   # [所有格子数, 1]  所有格子需要学习的centerness
+            ctn_targets, [ctn_targets.shape[0], 1])   # [所有格子数, 1]  所有格子需要学习的centerness
         ctn_targets[labels <= 0] = 0   # 负样本需要学习的centerness置为0
-        pos_ind = np.nonzero(labels != 0)   # tuple=( ndarray(shape=[正样本数, ]), ndarray(shape=[正样本数, ]) )   即正样本在labels中的下标，因为labels是2维的，所以一个正样本有2个下标。
-        reg_targets_pos = reg_targets[pos_ind[0], :]    # [正样本数, 4]   正样本格子需要学习 的 lrtb
         split_sections = []   # 每一个感受野 最后一个格子 在reg_targets中的位置（第一维的位置）
         beg = 0
         for lvl in range(len(num_points_each_level)):
@@ -1230,10 +1576,11 @@ class Gt2FCOSTargetSingle(BaseOperator):
             beg = end
         if no_gt:   # 如果没有gt，labels里全部置为0（背景的类别id是0）即表示所有格子都是负样本
             labels[:, :] = 0
+        if self.sparse:
+            return self._sparse_targets(sample, labels, reg_targets, ctn_targets, num_points_each_level, strides, w, h)
         labels_by_level = np.split(labels, split_sections, axis=0)             # 一个list，根据split_sections切分，各个感受野的target切分开来。
         reg_targets_by_level = np.split(reg_targets, split_sections, axis=0)   # 一个list，根据split_sections切分，各个感受野的target切分开来。
         ctn_targets_by_level = np.split(ctn_targets, split_sections, axis=0)   # 一个list，根据split_sections切分，各个感受野的target切分开来。
-
         # 最后一步是reshape，和格子的位置对应上。
         for lvl in range(len(self.downsample_ratios)):
             grid_w = int(np.ceil(w / self.downsample_ratios[lvl]))   # 格子列数
@@ -1243,15 +1590,33 @@ class Gt2FCOSTargetSingle(BaseOperator):
                     np.reshape(
                         reg_targets_by_level[lvl] / \
                         self.downsample_ratios[lvl],      # 归一化方式是除以格子边长（即下采样倍率）
-                        newshape=[grid_h, grid_w, 4])     # reshape成[grid_h, grid_w, 4]
+                        [grid_h, grid_w, 4])     # reshape成[grid_h, grid_w, 4]
             else:
                 sample['reg_target{}'.format(lvl)] = np.reshape(
                     reg_targets_by_level[lvl],
-                    newshape=[grid_h, grid_w, 4])
+                    [grid_h, grid_w, 4])
             sample['labels{}'.format(lvl)] = np.reshape(
-                labels_by_level[lvl], newshape=[grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+                labels_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
             sample['centerness{}'.format(lvl)] = np.reshape(
-                ctn_targets_by_level[lvl], newshape=[grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+                ctn_targets_by_level[lvl], [grid_h, grid_w, 1])     # reshape成[grid_h, grid_w, 1]
+        return sample
+
+    def _sparse_targets(self, sample, labels, reg_targets, ctn_targets, num_points_each_level, strides, w, h):
+        pos_ind = np.nonzero(labels[:, 0] > 0)[0]   # [正样本数, ]
+        pos_reg = reg_targets[pos_ind]
+        if self.norm_reg_targets:   # 归一化方式是除以格子边长（即下采样倍率）
+            pos_reg = pos_reg / strides[pos_ind][:, np.newaxis]
+        sample['pos_ind'] = pos_ind.astype(np.int64)
+        sample['pos_reg'] = pos_reg.astype(np.float32)
+        sample['pos_ctn'] = ctn_targets[pos_ind].astype(np.float32)
+        beg = 0
+        for lvl in range(len(self.downsample_ratios)):
+            end = beg + num_points_each_level[lvl]
+            grid_w = int(np.ceil(w / self.downsample_ratios[lvl]))   # 格子列数
+            grid_h = int(np.ceil(h / self.downsample_ratios[lvl]))   # 格子行数
+            sample['labels{}'.format(lvl)] = np.reshape(
+                labels[beg:end], [grid_h, grid_w, 1]).astype(np.int16)
+            beg = end
         return sample
 
 
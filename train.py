@@ -9,7 +9,6 @@
 # ================================================================
 from collections import deque
 import time
-import threading
 import datetime
 from collections import OrderedDict
 import os
@@ -22,8 +21,14 @@ from model.fcos import *
 from tools.cocotools import get_classes, catid2clsid, clsid2catid
 from model.decode_np import Decode
 from tools.cocotools import eval
-from tools.data_process import data_clean, get_samples
+from tools.data_process import get_aspect_ratio_groups
+from tools.anno_cache import load_train_records
+from tools.data_loader import TrainLoader
+from tools.packed_dataset import PackedDataset
+from tools.record_store import RecordStore
+from tools.prefetch import PrefetchQueue
 from tools.transform import *
+from tools import op_stats
 from pycocotools.coco import COCO
 
 import logging
@@ -51,201 +56,46 @@ if sysstr == 'Windows':
 
 
 
-def multi_thread_op(i, num_threads, batch_size, samples, context, with_mixup, sample_transforms):
-    for k in range(i, batch_size, num_threads):
-        for sample_transform in sample_transforms:
-            if isinstance(sample_transform, MixupImage):
-                if with_mixup:
-                    samples[k] = sample_transform(samples[k], context)
-            else:
-                samples[k] = sample_transform(samples[k], context)
-
-
-def multi_thread_op_batch_transforms(i, num_threads, batch_size, samples, context, batch_transforms, max_shape,
-                    batch_images, batch_labels0, batch_reg_target0, batch_centerness0, batch_labels1, batch_reg_target1, batch_centerness1,
-                    batch_labels2, batch_reg_target2, batch_centerness2, batch_labels3, batch_reg_target3, batch_centerness3,
-                    batch_labels4, batch_reg_target4, batch_centerness4, n_features):
-    for k in range(i, batch_size, num_threads):
-        for batch_transform in batch_transforms:
-            if isinstance(batch_transform, PadBatchSingle):
-                samples[k] = batch_transform(max_shape, samples[k], context)
-            else:
-                samples[k] = batch_transform(samples[k], context)
-
-        # 整理成ndarray
-        batch_images[k] = np.expand_dims(samples[k]['image'].astype(np.float32), 0)
-        batch_labels0[k] = np.expand_dims(samples[k]['labels0'].astype(np.int32), 0)
-        batch_reg_target0[k] = np.expand_dims(samples[k]['reg_target0'].astype(np.float32), 0)
-        batch_centerness0[k] = np.expand_dims(samples[k]['centerness0'].astype(np.float32), 0)
-        batch_labels1[k] = np.expand_dims(samples[k]['labels1'].astype(np.int32), 0)
-        batch_reg_target1[k] = np.expand_dims(samples[k]['reg_target1'].astype(np.float32), 0)
-        batch_centerness1[k] = np.expand_dims(samples[k]['centerness1'].astype(np.float32), 0)
-        batch_labels2[k] = np.expand_dims(samples[k]['labels2'].astype(np.int32), 0)
-        batch_reg_target2[k] = np.expand_dims(samples[k]['reg_target2'].astype(np.float32), 0)
-        batch_centerness2[k] = np.expand_dims(samples[k]['centerness2'].astype(np.float32), 0)
-        if n_features == 5:
-            batch_labels3[k] = np.expand_dims(samples[k]['labels3'].astype(np.int32), 0)
-            batch_reg_target3[k] = np.expand_dims(samples[k]['reg_target3'].astype(np.float32), 0)
-            batch_centerness3[k] = np.expand_dims(samples[k]['centerness3'].astype(np.float32), 0)
-            batch_labels4[k] = np.expand_dims(samples[k]['labels4'].astype(np.int32), 0)
-            batch_reg_target4[k] = np.expand_dims(samples[k]['reg_target4'].astype(np.float32), 0)
-            batch_centerness4[k] = np.expand_dims(samples[k]['centerness4'].astype(np.float32), 0)
-
-
 def read_train_data(cfg,
+                    train_loader,
                     train_indexes,
                     train_steps,
-                    train_records,
-                    batch_size,
                     _iter_id,
-                    train_dic,
                     use_gpu,
-                    n_features,
-                    context, with_mixup, sample_transforms, batch_transforms):
-    iter_id = _iter_id
-    num_threads = cfg.train_cfg['num_threads']
-    while True:   # 无限个epoch
-        # 每个epoch之前洗乱
-        np.random.shuffle(train_indexes)
-        for step in range(train_steps):
-            iter_id += 1
-
-            key_list = list(train_dic.keys())
-            key_len = len(key_list)
-            while key_len >= cfg.train_cfg['max_batch']:
-                time.sleep(0.01)
-                key_list = list(train_dic.keys())
-                key_len = len(key_list)
-
-            # ==================== train ====================
-            batch_images = [None] * batch_size
-            batch_labels0 = [None] * batch_size
-            batch_reg_target0 = [None] * batch_size
-            batch_centerness0 = [None] * batch_size
-            batch_labels1 = [None] * batch_size
-            batch_reg_target1 = [None] * batch_size
-            batch_centerness1 = [None] * batch_size
-            batch_labels2 = [None] * batch_size
-            batch_reg_target2 = [None] * batch_size
-            batch_centerness2 = [None] * batch_size
-            batch_labels3 = [None] * batch_size
-            batch_reg_target3 = [None] * batch_size
-            batch_centerness3 = [None] * batch_size
-            batch_labels4 = [None] * batch_size
-            batch_reg_target4 = [None] * batch_size
-            batch_centerness4 = [None] * batch_size
-
-            samples = get_samples(train_records, train_indexes, step, batch_size, with_mixup)
-            # sample_transforms用多线程
-            threads = []
-            for i in range(num_threads):
-                t = threading.Thread(target=multi_thread_op, args=(i, num_threads, batch_size, samples, context, with_mixup, sample_transforms))
-                threads.append(t)
-                t.start()
-            # 等待所有线程任务结束。
-            for t in threads:
-                t.join()
-
-            # batch_transforms。需要先同步PadBatch
-            coarsest_stride = cfg.padBatch['pad_to_stride']
-            max_shape = np.array([data['image'].shape for data in samples]).max(
-                axis=0)  # max_shape=[3, max_h, max_w]
-            max_shape[1] = int(  # max_h增加到最小的能被coarsest_stride=128整除的数
-                np.ceil(max_shape[1] / coarsest_stride) * coarsest_stride)
-            max_shape[2] = int(  # max_w增加到最小的能被coarsest_stride=128整除的数
-                np.ceil(max_shape[2] / coarsest_stride) * coarsest_stride)
-
-            threads = []
-            for i in range(num_threads):
-                t = threading.Thread(target=multi_thread_op_batch_transforms, args=(i, num_threads, batch_size, samples, context, batch_transforms, max_shape,
-                                                                   batch_images, batch_labels0, batch_reg_target0, batch_centerness0, batch_labels1, batch_reg_target1, batch_centerness1,
-                                                                   batch_labels2, batch_reg_target2, batch_centerness2, batch_labels3, batch_reg_target3, batch_centerness3,
-                                                                   batch_labels4, batch_reg_target4, batch_centerness4, n_features))
-                threads.append(t)
-                t.start()
-            # 等待所有线程任务结束。
-            for t in threads:
-                t.join()
-
-
-            batch_images = np.concatenate(batch_images, 0)
-            batch_labels0 = np.concatenate(batch_labels0, 0)
-            batch_reg_target0 = np.concatenate(batch_reg_target0, 0)
-            batch_centerness0 = np.concatenate(batch_centerness0, 0)
-            batch_labels1 = np.concatenate(batch_labels1, 0)
-            batch_reg_target1 = np.concatenate(batch_reg_target1, 0)
-            batch_centerness1 = np.concatenate(batch_centerness1, 0)
-            batch_labels2 = np.concatenate(batch_labels2, 0)
-            batch_reg_target2 = np.concatenate(batch_reg_target2, 0)
-            batch_centerness2 = np.concatenate(batch_centerness2, 0)
-            if n_features == 5:
-                batch_labels3 = np.concatenate(batch_labels3, 0)
-                batch_reg_target3 = np.concatenate(batch_reg_target3, 0)
-                batch_centerness3 = np.concatenate(batch_centerness3, 0)
-                batch_labels4 = np.concatenate(batch_labels4, 0)
-                batch_reg_target4 = np.concatenate(batch_reg_target4, 0)
-                batch_centerness4 = np.concatenate(batch_centerness4, 0)
-
-            batch_images = torch.Tensor(batch_images)
-            batch_labels0 = torch.Tensor(batch_labels0)
-            batch_reg_target0 = torch.Tensor(batch_reg_target0)
-            batch_centerness0 = torch.Tensor(batch_centerness0)
-            batch_labels1 = torch.Tensor(batch_labels1)
-            batch_reg_target1 = torch.Tensor(batch_reg_target1)
-            batch_centerness1 = torch.Tensor(batch_centerness1)
-            batch_labels2 = torch.Tensor(batch_labels2)
-            batch_reg_target2 = torch.Tensor(batch_reg_target2)
-            batch_centerness2 = torch.Tensor(batch_centerness2)
-            if n_features == 5:
-                batch_labels3 = torch.Tensor(batch_labels3)
-                batch_reg_target3 = torch.Tensor(batch_reg_target3)
-                batch_centerness3 = torch.Tensor(batch_centerness3)
-                batch_labels4 = torch.Tensor(batch_labels4)
-                batch_reg_target4 = torch.Tensor(batch_reg_target4)
-                batch_centerness4 = torch.Tensor(batch_centerness4)
-            if use_gpu:
-                batch_images = batch_images.cuda()
-                batch_labels0 = batch_labels0.cuda()
-                batch_reg_target0 = batch_reg_target0.cuda()
-                batch_centerness0 = batch_centerness0.cuda()
-                batch_labels1 = batch_labels1.cuda()
-                batch_reg_target1 = batch_reg_target1.cuda()
-                batch_centerness1 = batch_centerness1.cuda()
-                batch_labels2 = batch_labels2.cuda()
-                batch_reg_target2 = batch_reg_target2.cuda()
-                batch_centerness2 = batch_centerness2.cuda()
-                if n_features == 5:
-                    batch_labels3 = batch_labels3.cuda()
-                    batch_reg_target3 = batch_reg_target3.cuda()
-                    batch_centerness3 = batch_centerness3.cuda()
-                    batch_labels4 = batch_labels4.cuda()
-                    batch_reg_target4 = batch_reg_target4.cuda()
-                    batch_centerness4 = batch_centerness4.cuda()
-
-            dic = {}
-            dic['batch_images'] = batch_images
-            dic['batch_labels0'] = batch_labels0
-            dic['batch_reg_target0'] = batch_reg_target0
-            dic['batch_centerness0'] = batch_centerness0
-            dic['batch_labels1'] = batch_labels1
-            dic['batch_reg_target1'] = batch_reg_target1
-            dic['batch_centerness1'] = batch_centerness1
-            dic['batch_labels2'] = batch_labels2
-            dic['batch_reg_target2'] = batch_reg_target2
-            dic['batch_centerness2'] = batch_centerness2
-            if n_features == 5:
-                dic['batch_labels3'] = batch_labels3
-                dic['batch_reg_target3'] = batch_reg_target3
-                dic['batch_centerness3'] = batch_centerness3
-                dic['batch_labels4'] = batch_labels4
-                dic['batch_reg_target4'] = batch_reg_target4
-                dic['batch_centerness4'] = batch_centerness4
-            train_dic['%.8d'%iter_id] = dic
-
-            # ==================== exit ====================
-            if iter_id == cfg.train_cfg['max_iters']:
-                return 0
-
+                    n_features):
+    for iter_id, batch in train_loader.batches(train_indexes, train_steps, _iter_id, cfg.train_cfg['max_iters']):
+        if 'op_stats' in batch:
+            op_stats.merge(batch.pop('op_stats'))   # 工作进程里算子耗时的增量
+        op_stats.report(iter_id, 'train')
+        dic = {}
+        dic['batch_images'] = torch.from_numpy(batch['batch_images'])   # 和批数组共用内存，不复制
+        dic['pad_ratio'] = batch['pad_ratio']
+        if cfg.train_cfg['target_on_device']:
+            dic['batch_gt_bbox'] = torch.Tensor(batch['batch_gt_bbox'])
+            dic['batch_gt_class'] = torch.from_numpy(batch['batch_gt_class']).long()
+            dic['batch_gt_num'] = torch.from_numpy(batch['batch_gt_num']).long()
+        elif cfg.train_cfg['sparse_targets']:
+            # 稀疏的target，只传正样本
+            for i in range(n_features):
+                dic['batch_labels%d' % i] = torch.from_numpy(batch['batch_labels%d' % i])
+            dic['batch_pos_ind'] = torch.from_numpy(batch['batch_pos_ind'])
+            dic['batch_pos_reg'] = torch.from_numpy(batch['batch_pos_reg'])
+            dic['batch_pos_ctn'] = torch.from_numpy(batch['batch_pos_ctn'])
+        else:
+            for i in range(n_features):
+                dic['batch_labels%d' % i] = torch.Tensor(batch['batch_labels%d' % i])
+                dic['batch_reg_target%d' % i] = torch.Tensor(batch['batch_reg_target%d' % i])
+                dic['batch_centerness%d' % i] = torch.Tensor(batch['batch_centerness%d' % i])
+        if use_gpu:
+            for k in dic.keys():
+                dic[k] = dic[k].cuda()
+        yield iter_id, dic
+
+
+
+def state_path(model_path):
+    # 检查点的附属文件，存优化器、读数据的状态等。./weights/step00001000.pt -> ./weights/step00001000.state
+    return os.path.splitext(model_path)[0] + '.state'
 
 
 def load_weights(model, model_path):
@@ -272,6 +122,7 @@ if __name__ == '__main__':
         cfg = FCOS_RT_R50_FPN_4x_Config()
     elif config_file == 2:
         cfg = FCOS_RT_DLA34_FPN_4x_Config()
+    op_stats.configure(**cfg.op_stats_cfg)
 
     class_names = get_classes(cfg.classes_path)
     num_classes = len(class_names)
@@ -292,6 +143,8 @@ if __name__ == '__main__':
     _decode = Decode(fcos, class_names, use_gpu, cfg, for_test=False)
 
     # 加载权重
+    train_state = None   # 检查点的附属文件里存的训练状态
+    backbone_frozen = False
     if cfg.train_cfg['model_path'] is not None:
         # 加载参数, 跳过形状不匹配的。
         load_weights(fcos, cfg.train_cfg['model_path'])
@@ -300,8 +153,16 @@ if __name__ == '__main__':
         if len(strs) == 2:
             iter_id = int(strs[1][:8])
 
-        # 冻结，使得需要的显存减少。低显存的卡建议这样配置。
-        backbone.freeze()
+        # 有附属文件时恢复优化器、读数据的状态，接着训练的结果和不中断时一样。
+        if os.path.exists(state_path(cfg.train_cfg['model_path'])):
+            train_state = torch.load(state_path(cfg.train_cfg['model_path']))
+            iter_id = train_state['iter_id']
+            logger.info('Resume from {}, iter {}.'.format(cfg.train_cfg['model_path'], iter_id))
+
+        # 冻结，使得需要的显存减少。低显存的卡建议这样配置。恢复训练时和中断之前保持一致。
+        if train_state is None or train_state['backbone_frozen']:
+            backbone.freeze()
+            backbone_frozen = True
 
     if use_gpu:   # 如果有gpu可用，模型（包括了权重weight）存放在gpu显存里
         fcos = fcos.cuda()
@@ -316,9 +177,12 @@ if __name__ == '__main__':
             _catid2clsid[k] = k
             _clsid2catid[k] = k
     # 训练集
-    train_dataset = COCO(cfg.train_path)
-    train_img_ids = train_dataset.getImgIds()
-    train_records = data_clean(train_dataset, train_img_ids, _catid2clsid, cfg.train_pre_path)
+    packed_dataset = None
+    if cfg.train_pack_dir is not None:   # 打包的数据集
+        packed_dataset = PackedDataset(cfg.train_pack_dir)
+        train_records = RecordStore.from_records(packed_dataset.records(_catid2clsid))
+    else:
+        train_records = load_train_records(cfg.train_path, cfg.train_pre_path, _catid2clsid, cfg.anno_cache_dir)
     num_train = len(train_records)
     train_indexes = [i for i in range(num_train)]
     # 验证集
@@ -337,16 +201,26 @@ if __name__ == '__main__':
     context = cfg.context
     # 预处理
     # sample_transforms
-    decodeImage = DecodeImage(**cfg.decodeImage)   # 对图片解码。最开始的一步。
+    decodeImage = DecodeImage(target_size=cfg.resizeImage['target_size'],
+                              max_size=cfg.resizeImage['max_size'],
+                              **cfg.decodeImage)   # 对图片解码。最开始的一步。缩小解码时要知道ResizeImage的尺度。
     mixupImage = MixupImage()                      # mixup增强
-    photometricDistort = PhotometricDistort()      # 颜色扭曲
+    if cfg.photometricDistort['use_lut']:
+        photometricDistort = PhotometricDistortLUT()   # 颜色扭曲，uint8查找表版本
+    else:
+        photometricDistort = PhotometricDistort()      # 颜色扭曲
     randomFlipImage = RandomFlipImage(**cfg.randomFlipImage)  # 随机翻转
-    normalizeImage = NormalizeImage(**cfg.normalizeImage)     # 先除以255归一化，再减均值除以标准差
     resizeImage = ResizeImage(**cfg.resizeImage)   # 多尺度训练，随机选一个尺度，不破坏原始宽高比地缩放。具体见代码。
-    permute = Permute(**cfg.permute)    # 图片从HWC格式变成CHW格式
     # batch_transforms
-    padBatch = PadBatchSingle(use_padded_im_info=cfg.padBatch['use_padded_im_info'])    # 由于ResizeImage()的机制特殊，这一批所有的图片的尺度不一定全相等，所以这里对齐。
-    gt2FCOSTarget = Gt2FCOSTargetSingle(**cfg.gt2FCOSTarget)   # 填写target张量。
+    # 先除以255归一化，再减均值除以标准差；图片从HWC格式变成CHW格式；由于ResizeImage()的机制特殊，这一批所有的图片的尺度不一定全相等，所以这里对齐。
+    # 三步合成一步，直接写进复用的批数组。预读队列里的批、读数据的线程正在做的批、训练正在用的批不能共用缓冲区。
+    normalizePermutePad = NormalizePermutePadBatch(to_bgr=cfg.permute['to_bgr'],
+                                                   pad_to_stride=cfg.padBatch['pad_to_stride'],
+                                                   use_padded_im_info=cfg.padBatch['use_padded_im_info'],
+                                                   num_buffers=cfg.train_cfg['prefetch_depth'] + 2,
+                                                   **cfg.normalizeImage)
+    gt2FCOSTarget = Gt2FCOSTargetSingle(sparse=cfg.train_cfg['sparse_targets'], **cfg.gt2FCOSTarget)   # 填写target张量。
+    scaleGtBbox = ScaleGtBboxSingle()   # target在模型所在的设备上计算时，读数据的进程只缩放gt坐标。
 
     # 输出几个特征图
     n_features = len(cfg.gt2FCOSTarget['downsample_ratios'])
@@ -356,158 +230,180 @@ if __name__ == '__main__':
     sample_transforms.append(mixupImage)
     sample_transforms.append(photometricDistort)
     sample_transforms.append(randomFlipImage)
-    sample_transforms.append(normalizeImage)
     sample_transforms.append(resizeImage)
-    sample_transforms.append(permute)
 
     batch_transforms = []
-    batch_transforms.append(padBatch)
-    batch_transforms.append(gt2FCOSTarget)
+    batch_transforms.append(normalizePermutePad)
+    if cfg.train_cfg['target_on_device']:
+        batch_transforms.append(scaleGtBbox)
+    else:
+        batch_transforms.append(gt2FCOSTarget)
+
+    # 在模型所在的设备上批量计算target
+    target_assigner = None
+    if cfg.train_cfg['target_on_device']:
+        target_assigner = FCOSTargetAssigner(**cfg.gt2FCOSTarget)
 
     # 保存模型的目录
     if not os.path.exists('./weights'): os.mkdir('./weights')
 
     optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, fcos.parameters()), lr=cfg.train_cfg['lr'])   # requires_grad==True 的参数才可以被更新
+    if train_state is not None:
+        optimizer.load_state_dict(train_state['optimizer'])
+        torch.set_rng_state(train_state['torch_rng'])
 
     time_stat = deque(maxlen=20)
+    pad_stat = deque(maxlen=20)
     start_time = time.time()
     end_time = time.time()
 
     # 一轮的步数。丢弃最后几个样本。
     train_steps = num_train // batch_size
 
-    # 读数据的线程
-    train_dic ={}
-    thr = threading.Thread(target=read_train_data,
-                           args=(cfg,
-                                 train_indexes,
-                                 train_steps,
-                                 train_records,
-                                 batch_size,
-                                 iter_id,
-                                 train_dic,
-                                 use_gpu,
-                                 n_features,
-                                 context, with_mixup, sample_transforms, batch_transforms))
-    thr.start()
+    # 按宽高比分组凑批，减少PadBatch填充的像素。
+    group_ids = None
+    if cfg.train_cfg['group_by_aspect_ratio']:
+        group_ids = get_aspect_ratio_groups(train_records, cfg.train_cfg['aspect_ratio_bins'])
+    # 多尺度训练时一批图片用同一个尺度，不会因为一张大尺度的图片把整批都填充大。
+    batch_target_sizes = None
+    if cfg.train_cfg['batch_multiscale'] and isinstance(cfg.resizeImage['target_size'], list):
+        batch_target_sizes = cfg.resizeImage['target_size']
+
+    # 读数据的进程池
+    train_loader = TrainLoader(train_records, batch_size, context, with_mixup, sample_transforms, batch_transforms, n_features,
+                               num_workers=cfg.train_cfg['num_workers'], seed=cfg.train_cfg['seed'],
+                               group_ids=group_ids, batch_target_sizes=batch_target_sizes,
+                               packed_dataset=packed_dataset, shuffle_buffer=cfg.train_cfg['shuffle_buffer'])
+    if train_state is not None:
+        train_loader.load_state_dict(train_state['loader'])   # 洗乱、数据增强的随机种子
+    logger.info('Data loader seed: {}'.format(train_loader.seed))
+
+    # 读数据的线程。读好的批放进有界阻塞队列。
+    train_queue = PrefetchQueue(read_train_data,
+                                args=(cfg,
+                                      train_loader,
+                                      train_indexes,
+                                      train_steps,
+                                      iter_id,
+                                      use_gpu,
+                                      n_features),
+                                depth=cfg.train_cfg['prefetch_depth'])
 
 
     best_ap_list = [0.0, 0]  #[map, iter]
-    while True:   # 无限个epoch
-        # 每个epoch之前洗乱
-        np.random.shuffle(train_indexes)
-        for step in range(train_steps):
-            iter_id += 1
-
-            key_list = list(train_dic.keys())
-            key_len = len(key_list)
-            while key_len == 0:
-                time.sleep(0.01)
-                key_list = list(train_dic.keys())
-                key_len = len(key_list)
-            dic = train_dic.pop('%.8d'%iter_id)
-
-            # 估计剩余时间
-            start_time = end_time
-            end_time = time.time()
-            time_stat.append(end_time - start_time)
-            time_cost = np.mean(time_stat)
-            eta_sec = (cfg.train_cfg['max_iters'] - iter_id) * time_cost
-            eta = str(datetime.timedelta(seconds=int(eta_sec)))
-
-            # ==================== train ====================
-            batch_images = dic['batch_images']
-            batch_labels0 = dic['batch_labels0']
-            batch_reg_target0 = dic['batch_reg_target0']
-            batch_centerness0 = dic['batch_centerness0']
-            batch_labels1 = dic['batch_labels1']
-            batch_reg_target1 = dic['batch_reg_target1']
-            batch_centerness1 = dic['batch_centerness1']
-            batch_labels2 = dic['batch_labels2']
-            batch_reg_target2 = dic['batch_reg_target2']
-            batch_centerness2 = dic['batch_centerness2']
-            if n_features == 5:
-                batch_labels3 = dic['batch_labels3']
-                batch_reg_target3 = dic['batch_reg_target3']
-                batch_centerness3 = dic['batch_centerness3']
-                batch_labels4 = dic['batch_labels4']
-                batch_reg_target4 = dic['batch_reg_target4']
-                batch_centerness4 = dic['batch_centerness4']
-            if n_features == 3:
-                tag_labels = [batch_labels0, batch_labels1, batch_labels2]
-                tag_bboxes = [batch_reg_target0, batch_reg_target1, batch_reg_target2]
-                tag_center = [batch_centerness0, batch_centerness1, batch_centerness2]
-            elif n_features == 5:
-                tag_labels = [batch_labels0, batch_labels1, batch_labels2, batch_labels3, batch_labels4]
-                tag_bboxes = [batch_reg_target0, batch_reg_target1, batch_reg_target2, batch_reg_target3, batch_reg_target4]
-                tag_center = [batch_centerness0, batch_centerness1, batch_centerness2, batch_centerness3, batch_centerness4]
-
-            losses = fcos(batch_images, None, False, tag_labels, tag_bboxes, tag_center)
-            loss_centerness = losses['loss_centerness']
-            loss_cls = losses['loss_cls']
-            loss_box = losses['loss_box']
-            all_loss = loss_cls + loss_box + loss_centerness
-
-            _all_loss = all_loss.cpu().data.numpy()
-            _loss_cls = loss_cls.cpu().data.numpy()
-            _loss_box = loss_box.cpu().data.numpy()
-            _loss_centerness = loss_centerness.cpu().data.numpy()
-
-            # 更新权重
-            optimizer.zero_grad()  # 清空上一步的残余更新参数值
-            all_loss.backward()  # 误差反向传播, 计算参数更新值
-            optimizer.step()  # 将参数更新值施加到 net 的 parameters 上
+    if train_state is not None:
+        best_ap_list = train_state['best_ap']
+    for iter_id, dic in train_queue:   # 无限个epoch，直到max_iters。洗乱在读数据的线程里做。
+        # 估计剩余时间
+        start_time = end_time
+        end_time = time.time()
+        time_stat.append(end_time - start_time)
+        time_cost = np.mean(time_stat)
+        eta_sec = (cfg.train_cfg['max_iters'] - iter_id) * time_cost
+        eta = str(datetime.timedelta(seconds=int(eta_sec)))
+
+        # ==================== train ====================
+        batch_images = dic['batch_images']
+        pad_stat.append(dic['pad_ratio'])
+        tag_pos_ind = None
+        if target_assigner is not None:
+            h, w = batch_images.shape[2:4]
+            tag_labels, tag_bboxes, tag_center = target_assigner(dic['batch_gt_bbox'], dic['batch_gt_class'], dic['batch_gt_num'], h, w)
+        elif 'batch_pos_ind' in dic:
+            tag_labels = [dic['batch_labels%d' % i] for i in range(n_features)]
+            tag_bboxes = dic['batch_pos_reg']
+            tag_center = dic['batch_pos_ctn']
+            tag_pos_ind = dic['batch_pos_ind']
+        else:
+            tag_labels = [dic['batch_labels%d' % i] for i in range(n_features)]
+            tag_bboxes = [dic['batch_reg_target%d' % i] for i in range(n_features)]
+            tag_center = [dic['batch_centerness%d' % i] for i in range(n_features)]
+
+        losses = fcos(batch_images, None, False, tag_labels, tag_bboxes, tag_center, tag_pos_ind)
+        loss_centerness = losses['loss_centerness']
+        loss_cls = losses['loss_cls']
+        loss_box = losses['loss_box']
+        all_loss = loss_cls + loss_box + loss_centerness
+
+        _all_loss = all_loss.cpu().data.numpy()
+        _loss_cls = loss_cls.cpu().data.numpy()
+        _loss_box = loss_box.cpu().data.numpy()
+        _loss_centerness = loss_centerness.cpu().data.numpy()
+
+        # 更新权重
+        optimizer.zero_grad()  # 清空上一步的残余更新参数值
+        all_loss.backward()  # 误差反向传播, 计算参数更新值
+        optimizer.step()  # 将参数更新值施加到 net 的 parameters 上
+        if cfg.use_ema:
+            fcos.update_ema_state_dict(iter_id - 1)   # 更新ema_state_dict
+
+        # ==================== log ====================
+        if iter_id % 20 == 0:
+            strs = 'Train iter: {}, all_loss: {:.6f}, giou_loss: {:.6f}, conf_loss: {:.6f}, cent_loss: {:.6f}, eta: {}'.format(
+                iter_id, _all_loss, _loss_box, _loss_cls, _loss_centerness, eta)
+            logger.info(strs)
+            queue_stats = train_queue.stats()
+            logger.info('Prefetch queue: mean occupancy {:.2f}/{}, consumer waits: {}, producer waits: {}'.format(
+                queue_stats['mean_occupancy'], queue_stats['depth'], queue_stats['empty_waits'], queue_stats['full_waits']))
+            logger.info('Padding ratio: {:.3f}, step time: {:.3f}s'.format(np.mean(pad_stat), time_cost))
+
+        # ==================== eval ====================
+        if iter_id % cfg.train_cfg['eval_iter'] == 0:
+            if cfg.use_ema:
+                fcos.apply_ema_state_dict()
+            fcos.eval()   # 切换到验证模式
+            box_ap = eval(_decode, val_images, cfg.val_pre_path, cfg.val_path, cfg.eval_cfg['eval_batch_size'], _clsid2catid, cfg.eval_cfg['draw_image'], cfg.eval_cfg['draw_thresh'], cfg.eval_cfg['prefetch_depth'])
+            logger.info("box ap: %.3f" % (box_ap[0], ))
+            fcos.train()  # 切换到训练模式
+
+            # 以box_ap作为标准
+            ap = box_ap
+            if ap[0] > best_ap_list[0]:
+                best_ap_list[0] = ap[0]
+                best_ap_list[1] = iter_id
+                torch.save(fcos.state_dict(), './weights/best_model.pt')
+            if cfg.use_ema:
+                fcos.restore_current_state_dict()
+            logger.info("Best test ap: {}, in iter: {}".format(best_ap_list[0], best_ap_list[1]))
+
+        # ==================== save ====================
+        if iter_id % cfg.train_cfg['save_iter'] == 0:
+            if cfg.use_ema:
+                fcos.apply_ema_state_dict()
+            save_path = './weights/step%.8d.pt' % iter_id
+            torch.save(fcos.state_dict(), save_path)
             if cfg.use_ema:
-                fcos.update_ema_state_dict(iter_id - 1)   # 更新ema_state_dict
-
-            # ==================== log ====================
-            if iter_id % 20 == 0:
-                strs = 'Train iter: {}, all_loss: {:.6f}, giou_loss: {:.6f}, conf_loss: {:.6f}, cent_loss: {:.6f}, eta: {}'.format(
-                    iter_id, _all_loss, _loss_box, _loss_cls, _loss_centerness, eta)
-                logger.info(strs)
-
-            # ==================== save ====================
-            if iter_id % cfg.train_cfg['save_iter'] == 0:
-                if cfg.use_ema:
-                    fcos.apply_ema_state_dict()
-                save_path = './weights/step%.8d.pt' % iter_id
-                torch.save(fcos.state_dict(), save_path)
-                if cfg.use_ema:
-                    fcos.restore_current_state_dict()
-                path_dir = os.listdir('./weights')
-                steps = []
-                names = []
-                for name in path_dir:
-                    if name[len(name) - 2:len(name)] == 'pt' and name[0:4] == 'step':
-                        step = int(name[4:12])
-                        steps.append(step)
-                        names.append(name)
-                if len(steps) > 10:
-                    i = steps.index(min(steps))
-                    os.remove('./weights/'+names[i])
-                logger.info('Save model to {}'.format(save_path))
-
-            # ==================== eval ====================
-            if iter_id % cfg.train_cfg['eval_iter'] == 0:
-                if cfg.use_ema:
-                    fcos.apply_ema_state_dict()
-                fcos.eval()   # 切换到验证模式
-                box_ap = eval(_decode, val_images, cfg.val_pre_path, cfg.val_path, cfg.eval_cfg['eval_batch_size'], _clsid2catid, cfg.eval_cfg['draw_image'], cfg.eval_cfg['draw_thresh'])
-                logger.info("box ap: %.3f" % (box_ap[0], ))
-                fcos.train()  # 切换到训练模式
-
-                # 以box_ap作为标准
-                ap = box_ap
-                if ap[0] > best_ap_list[0]:
-                    best_ap_list[0] = ap[0]
-                    best_ap_list[1] = iter_id
-                    torch.save(fcos.state_dict(), './weights/best_model.pt')
-                if cfg.use_ema:
-                    fcos.restore_current_state_dict()
-                logger.info("Best test ap: {}, in iter: {}".format(best_ap_list[0], best_ap_list[1]))
-
-            # ==================== exit ====================
-            if iter_id == cfg.train_cfg['max_iters']:
-                logger.info('Done.')
-                exit(0)
+                fcos.restore_current_state_dict()
+            # 附属文件。权重文件还是只有模型参数，eval.py、demo.py照常读。
+            # 在eval之后保存，best_ap包括这一步eval的结果，恢复训练后不会用更差的模型覆盖best_model.pt
+            train_state = {
+                'iter_id': iter_id,
+                'loader': train_loader.state_dict(iter_id, train_steps),
+                'optimizer': optimizer.state_dict(),
+                'torch_rng': torch.get_rng_state(),
+                'backbone_frozen': backbone_frozen,
+                'best_ap': best_ap_list,
+            }
+            torch.save(train_state, state_path(save_path))
+            path_dir = os.listdir('./weights')
+            steps = []
+            names = []
+            for name in path_dir:
+                if name[len(name) - 2:len(name)] == 'pt' and name[0:4] == 'step':
+                    step = int(name[4:12])
+                    steps.append(step)
+                    names.append(name)
+            if len(steps) > 10:
+                i = steps.index(min(steps))
+                os.remove('./weights/'+names[i])
+                if os.path.exists(state_path('./weights/'+names[i])):
+                    os.remove(state_path('./weights/'+names[i]))
+            logger.info('Save model to {}'.format(save_path))
+
+        # ==================== exit ====================
+        if iter_id == cfg.train_cfg['max_iters']:
+            break
+    train_queue.close()
+    train_loader.close()
+    logger.info('Done.')
 